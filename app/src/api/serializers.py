@@ -2,6 +2,7 @@ from rest_framework import serializers
 
 from core import models as core_models
 from journal import models as journal_models
+from search import related as search_related
 from submission import models as submission_models
 
 
@@ -39,7 +40,7 @@ class ArticleSerializer(serializers.HyperlinkedModelSerializer):
         model = submission_models.Article
         fields = ('pk', 'title', 'subtitle', 'abstract', 'language', 'license', 'keywords', 'section',
                   'is_remote', 'remote_url', 'frozenauthors', 'date_submitted', 'date_accepted',
-                  'date_published', 'render_galley', 'galleys')
+                  'date_published', 'render_galley', 'galleys', 'related')
 
     license = LicenceSerializer()
     keywords = KeywordsSerializer(
@@ -61,6 +62,10 @@ class ArticleSerializer(serializers.HyperlinkedModelSerializer):
         source='galley_set',
         many=True
     )
+    related = serializers.SerializerMethodField()
+
+    def get_related(self, article):
+        return search_related.get_related_ids(article)
 
 
 class IssueSerializer(serializers.HyperlinkedModelSerializer):
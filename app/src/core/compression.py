@@ -0,0 +1,205 @@
+__copyright__ = "Copyright 2017 Birkbeck, University of London"
+__author__ = "Martin Paul Eve & Andy Byers"
+__license__ = "AGPL v3"
+__maintainer__ = "Birkbeck Centre for Technology and Publishing"
+
+import gzip
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+
+from django.utils.cache import patch_vary_headers
+
+from utils import background
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = (
+    'text/html',
+    'text/xml',
+    'application/xml',
+    'text/css',
+    'text/csv',
+    'text/plain',
+    'application/json',
+)
+
+# preferred encodings first, with the suffix each is stored under
+ENCODINGS = (
+    ('br', '.br'),
+    ('gzip', '.gz'),
+)
+# raw deflate data of a file that can be spliced into a gzip response between other content, see splice_gzip()
+FRAGMENT_SUFFIX = '.deflate'
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+def is_compressible(mime_type):
+    return mime_type in COMPRESSIBLE_MIMETYPES
+
+
+def available_encodings():
+    return [(encoding, suffix) for encoding, suffix in ENCODINGS if encoding != 'br' or brotli]
+
+
+def is_current(path, variant_path):
+    """ A stored encoding is only used if it was written after the last change to the original file. """
+    try:
+        return os.path.getmtime(variant_path) >= os.path.getmtime(path)
+    except OSError:
+        return False
+
+
+def precompress(path, fragment=False):
+    """ Writes gzip, and brotli if it is installed, encodings of a file alongside it. Encodings that are already
+    up to date are left alone.
+
+    :param path: the path to the original file
+    :param fragment: also write a fragment for splice_gzip()
+    :return: a list of the encoded paths
+    """
+    if not os.path.isfile(path):
+        return []
+
+    written = []
+    variants = available_encodings() + ([('fragment', FRAGMENT_SUFFIX)] if fragment else [])
+
+    for encoding, suffix in variants:
+        variant_path = path + suffix
+
+        if not is_current(path, variant_path):
+            handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+
+            with open(path, 'rb') as original, os.fdopen(handle, 'wb') as variant:
+                if encoding == 'gzip':
+                    with gzip.GzipFile(fileobj=variant, mode='wb', compresslevel=9) as gzip_variant:
+                        shutil.copyfileobj(original, gzip_variant)
+                elif encoding == 'br':
+                    variant.write(brotli.compress(original.read(), quality=11))
+                else:
+                    variant.write(deflate_fragment(original.read(), level=9))
+
+            os.replace(temp_path, variant_path)
+
+        written.append(variant_path)
+
+    return written
+
+
+def queue_precompress(path, fragment=False):
+    return background.submit_once('compression', path, precompress, path, fragment, durable=True)
+
+
+def deflate_fragment(data, level=6):
+    """ Compresses data as raw deflate blocks ending on a byte boundary without a final block, so that more deflate
+    data can follow it. The blocks only refer back to data inside the fragment, so they decode the same whatever
+    comes before them.
+
+    :param data: bytes
+    :param level: the zlib compression level
+    :return: bytes
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def splice_gzip(prefix, path, suffix):
+    """ Builds a gzip encoding of prefix, the contents of a file and suffix, reusing the file's stored fragment so
+    that only the prefix and suffix are compressed. Used to send a page built around a large stored render.
+
+    :param prefix: bytes to send before the file
+    :param path: the path to a file with a current fragment, see precompress()
+    :param suffix: bytes to send after the file
+    :return: bytes of gzip data
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    parts = [GZIP_HEADER, deflate_fragment(prefix)]
+
+    with open(path + FRAGMENT_SUFFIX, 'rb') as fragment_file:
+        parts.append(fragment_file.read())
+
+    parts.append(compressor.compress(suffix) + compressor.flush())
+
+    # the checksum and length in the trailer cover the uncompressed content
+    with open(path, 'rb') as original:
+        content = original.read()
+
+    checksum = zlib.crc32(suffix, zlib.crc32(content, zlib.crc32(prefix)))
+    length = len(prefix) + len(content) + len(suffix)
+    parts.append(struct.pack('<II', checksum & 0xffffffff, length & 0xffffffff))
+
+    return b''.join(parts)
+
+
+def accepted_encodings(request):
+    """ Parses the Accept-Encoding header into the set of encodings the client will take.
+
+    :param request: HttpRequest object
+    :return: a set of encoding names
+    """
+    accepted = set()
+
+    for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        encoding, _, parameters = part.strip().partition(';')
+        quality = parameters.strip()
+
+        if quality.startswith('q='):
+            try:
+                if float(quality[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+
+        if encoding:
+            accepted.add(encoding.strip().lower())
+
+    return accepted
+
+
+def negotiate(request, path, mime_type):
+    """ Picks the stored encoding of a file to send to a client. When the file should have encodings but they are
+    missing or out of date they are queued for generation and the original is sent this time.
+
+    :param request: HttpRequest object
+    :param path: the path to the original file
+    :param mime_type: the mime type of the file
+    :return: a tuple of the path to send and its content encoding, which is None for the original
+    """
+    if request is None or not is_compressible(mime_type):
+        return path, None
+
+    accepted = accepted_encodings(request)
+    chosen, stale = (path, None), False
+
+    for encoding, suffix in available_encodings():
+        if not is_current(path, path + suffix):
+            stale = True
+        elif encoding in accepted and chosen[1] is None:
+            chosen = (path + suffix, encoding)
+
+    if stale:
+        queue_precompress(path)
+
+    return chosen
+
+
+def set_encoding_headers(response, mime_type, encoding):
+    """ Marks a response built from a stored encoding, GZipMiddleware leaves responses with a Content-Encoding alone.
+
+    :param response: an HttpResponse
+    :param mime_type: the mime type of the original file
+    :param encoding: the content encoding sent, or None
+    :return: the response
+    """
+    if encoding:
+        response['Content-Encoding'] = encoding
+
+    if is_compressible(mime_type):
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+    return response
@@ -92,7 +92,9 @@ INSTALLED_APPS = [
 INSTALLED_APPS += plugin_installed_apps.load_plugin_apps()
 INSTALLED_APPS += plugin_installed_apps.load_homepage_element_apps()
 
+# existing settings files need InstrumentationMiddleware added at the top of this list for requests to be sampled
 MIDDLEWARE_CLASSES = (
+    'core.middleware.InstrumentationMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
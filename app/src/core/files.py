@@ -5,24 +5,30 @@ __maintainer__ = "Birkbeck Centre for Technology and Publishing"
 
 import mimetypes as mime
 import os
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import PurePath
 from uuid import uuid4
 from wsgiref.util import FileWrapper
-from bs4 import BeautifulSoup
 from lxml import etree
-import re
 import shutil
 import magic
 import tempfile
 import hashlib
+import zipfile
+import threading
+import time
 
 from django.conf import settings
 from django.contrib import messages
+from django.core.cache import cache
 from django.http import StreamingHttpResponse, HttpResponseRedirect, HttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils.text import slugify
 from django.http import Http404
 from django.views.decorators.cache import cache_control
 
+from core import compression, render_profiling
 from utils import models as util_models
 
 
@@ -42,6 +48,15 @@ IMAGE_MIMETYPES = (
     'image/tiff',
 )
 
+# libmagic only needs the start of a file to identify it, so we never hand it more than this
+MIME_SNIFF_BYTES = 8192
+# except for zip containers, eg. DOCX, XLSX and ODT, whose type depends on entries that may come after the header
+ZIP_SIGNATURE = b'PK\x03\x04'
+MIME_CACHE_SIZE = 1024
+
+# Maps the checksum of a file header to the mime type libmagic found for it
+_mime_cache = OrderedDict()
+
 
 def mkdirs(path):
     if not os.path.exists(path):
@@ -153,7 +168,14 @@ def guess_mime(filename):
     :param filename: the filename of which to guess the type
     :return: the MIME type
     """
-    file_mime = mime.guess_type(filename)
+    # the guess is based on the file's suffixes alone, so uuid filenames with the same extensions share a cache entry
+    suffixes = ''.join(PurePath(str(filename)).suffixes[-2:])
+    return _guess_mime_from_suffixes(suffixes)
+
+
+@lru_cache(maxsize=256)
+def _guess_mime_from_suffixes(suffixes):
+    file_mime = mime.guess_type('file{0}'.format(suffixes))
 
     try:
         file_mime = file_mime[0]
@@ -165,14 +187,55 @@ def guess_mime(filename):
     return file_mime
 
 
+def mime_from_header(header):
+    """ Detects the MIME type of a file from its first bytes, caching the result by the checksum of those bytes.
+
+    :param header: a bytes object holding (at most) the first MIME_SNIFF_BYTES of a file
+    :return: the MIME type
+    """
+    key = hashlib.md5(header).hexdigest()
+    file_mime = _mime_cache.get(key)
+
+    if file_mime is None:
+        file_mime = magic.from_buffer(header, mime=True)
+        _mime_cache[key] = file_mime
+
+        if len(_mime_cache) > MIME_CACHE_SIZE:
+            _mime_cache.popitem(last=False)
+
+    return file_mime
+
+
 def file_path_mime(file_path):
-    mime = magic.from_file(file_path, mime=True)
-    return mime
+    with open(file_path, 'rb') as file_to_sniff:
+        header = file_to_sniff.read(MIME_SNIFF_BYTES)
+
+    if header.startswith(ZIP_SIGNATURE):
+        return magic.from_file(file_path, mime=True)
+
+    return mime_from_header(header)
 
 
 def check_in_memory_mime(in_memory_file):
-    mime = magic.from_buffer(in_memory_file.read(), mime=True)
-    return mime
+    """ Detects the MIME type of an uploaded file by sniffing its first few KB, or the whole file for zip containers,
+    then rewinds the file so that it can be saved as normal.
+
+    :param in_memory_file: an UploadedFile object
+    :return: the MIME type
+    """
+    in_memory_file.seek(0)
+    header = in_memory_file.read(MIME_SNIFF_BYTES)
+    in_memory_file.seek(0)
+
+    if header.startswith(ZIP_SIGNATURE):
+        if hasattr(in_memory_file, 'temporary_file_path'):
+            return magic.from_file(in_memory_file.temporary_file_path(), mime=True)
+
+        file_mime = magic.from_buffer(in_memory_file.read(), mime=True)
+        in_memory_file.seek(0)
+        return file_mime
+
+    return mime_from_header(header)
 
 
 def copy_file_to_folder(file_to_handle, filename, folder_structure):
@@ -224,6 +287,11 @@ def save_file_to_disk(file_to_handle, filename, folder_structure):
 
     path = os.path.join(folder_structure, str(filename))
 
+    # completed chunked uploads are already on disk, so move them into place rather than copying them
+    if hasattr(file_to_handle, 'move_to'):
+        file_to_handle.move_to(path)
+        return
+
     # write the file to disk
     with open(path, 'wb') as fd:
         for chunk in file_to_handle.chunks():
@@ -252,6 +320,71 @@ def get_file(file_to_get, article):
             return content
 
 
+# Compiled XSLT transformers, lxml's XSLT objects are not thread safe so each thread keeps its own
+_xslt_local = threading.local()
+_xslt_generation = [0]
+
+
+def journal_xsl_path(journal):
+    """ Returns the path to the XSLT used to render a journal's XML galleys, its own if it has uploaded one.
+
+    :param journal: a Journal object
+    :return: a path string
+    """
+    if journal.has_xslt:
+        return os.path.join(settings.BASE_DIR, 'files', 'journals', str(journal.id), 'journal.xslt')
+    else:
+        return os.path.join(settings.BASE_DIR, 'transform', 'xsl', "article.xsl")
+
+
+def get_xslt_transform(xsl_path):
+    """ Returns a compiled XSLT transformer for the current thread, compiling the stylesheet only when this thread
+    hasn't seen this version of it before. The version is the file's modification time and size, so an uploaded
+    journal.xslt is picked up by every process without a restart.
+
+    :param xsl_path: the path to an XSLT file
+    :return: an etree.XSLT object
+    """
+    stat = os.stat(xsl_path)
+    version = (stat.st_mtime_ns, stat.st_size, _xslt_generation[0])
+
+    transforms = getattr(_xslt_local, 'transforms', None)
+    if transforms is None:
+        transforms = _xslt_local.transforms = {}
+
+    cached = transforms.get(xsl_path)
+
+    if cached is None or cached[0] != version:
+        cached = (version, etree.XSLT(etree.parse(xsl_path)))
+        transforms[xsl_path] = cached
+
+    return cached[1]
+
+
+def xml_parser():
+    """ Returns a parser for article XML. Entities, DTDs and network access are disabled so that an uploaded file
+    can't pull in local files or remote resources, and huge_tree lifts libxml2's depth and text node limits that
+    large JATS documents can hit. Malformed markup is recovered from rather than refusing to render the galley.
+
+    :return: an etree.XMLParser
+    """
+    return etree.XMLParser(resolve_entities=False, load_dtd=False, no_network=True, huge_tree=True, recover=True)
+
+
+def parse_xml(path):
+    """ Parses an XML file straight from disk into an lxml tree.
+
+    :param path: the path to the XML file
+    :return: an etree.ElementTree
+    """
+    return etree.parse(path, xml_parser())
+
+
+def clear_xslt_cache():
+    """ Drops the compiled XSLT transformers held by every thread in this process. """
+    _xslt_generation[0] += 1
+
+
 def render_xml(file_to_render, article, galley=None):
     """Renders JATS and TEI XML into HTML for inline article display.
 
@@ -269,27 +402,40 @@ def render_xml(file_to_render, article, galley=None):
                                        level='Error', actor=None, target=article)
         return ""
 
-    if article.journal.has_xslt:
-        xsl_path = os.path.join(settings.BASE_DIR, 'files', 'journals', str(article.journal.id), 'journal.xslt')
-    else:
-        xsl_path = os.path.join(settings.BASE_DIR, 'transform', 'xsl', "article.xsl")
+    xsl_path = journal_xsl_path(article.journal)
 
     if not os.path.isfile(xsl_path):
         util_models.LogEntry.add_entry(types='Error', description='The required XSLT file {0} was not found'.format(xsl_path),
                                        level='Error', actor=None, target=article)
         return ""
 
-    with open(path, "rb") as xml_file_contents:
-        xml = BeautifulSoup(xml_file_contents, "lxml-xml")
-
-        transform = etree.XSLT(etree.parse(xsl_path))
-
-        # remove the <?xml version="1.0" encoding="utf-8"?> line (or similar) if it exists
-        regex = re.compile(r'<\?xml version="1.0" encoding=".+"\?>')
-        xml_string = str(xml)
-        xml_string = re.sub(regex, '', xml_string, count=1)
+    transform = get_xslt_transform(xsl_path)
+    mode = render_profiling.profiling_mode()
+
+    if not mode:
+        return transform(parse_xml(path))
+
+    start = time.time()
+    document = parse_xml(path)
+    parsed = time.time()
+    result = transform(document, profile_run=mode == 'xslt')
+    transformed = time.time()
+
+    render_profiling.record(
+        'render',
+        galley=galley.pk if galley else None,
+        file=file_to_render.pk,
+        article=article.pk,
+        journal=article.journal.code,
+        xsl=xsl_path,
+        input_size=os.path.getsize(path),
+        output_size=len(str(result)),
+        parse_ms=(parsed - start) * 1000,
+        transform_ms=(transformed - parsed) * 1000,
+        templates=render_profiling.template_stats(result.xslt_profile) if mode == 'xslt' else [],
+    )
 
-        return transform(etree.XML(xml_string))
+    return result
 
 
 def serve_file(request, file_to_serve, article, public=False):
@@ -305,38 +451,40 @@ def serve_file(request, file_to_serve, article, public=False):
     file_path = os.path.join(settings.BASE_DIR, 'files', 'articles', str(article.id), str(file_to_serve.uuid_filename))
 
     try:
-        return serve_file_to_browser(file_path, file_to_serve, public=public)
+        return serve_file_to_browser(file_path, file_to_serve, public=public, request=request)
     except IOError:
         messages.add_message(request, messages.ERROR, 'File not found. {0}'.format(file_path))
         raise Http404
 
 
 @cache_control(max_age=600)
-def serve_file_to_browser(file_path, file_to_serve, public=False):
+def serve_file_to_browser(file_path, file_to_serve, public=False, request=None):
     """ Stream a file to the browser in a safe way
 
     :param file_path: the path on disk to the file
     :param file_to_serve: the core.models.File object to serve
     :param public: boolean
+    :param request: optional HttpRequest, when given a stored gzip or brotli encoding of a text file may be sent
     :return: HttpStreamingResponse object
     """
     # stream the response to the browser
     # we use the UUID filename to avoid any security risks of putting user content in headers
     # we set a chunk size of 8192 so that the entire file isn't loaded into memory if it's large
     filename, extension = os.path.splitext(file_to_serve.original_filename)
+    serve_path, encoding = compression.negotiate(request, file_path, file_to_serve.mime_type)
 
     if file_to_serve.mime_type in IMAGE_MIMETYPES:
-        response = HttpResponse(FileWrapper(open(file_path, 'rb'), 8192), content_type=file_to_serve.mime_type)
+        response = HttpResponse(FileWrapper(open(serve_path, 'rb'), 8192), content_type=file_to_serve.mime_type)
     else:
-        response = StreamingHttpResponse(FileWrapper(open(file_path, 'rb'), 8192), content_type=file_to_serve.mime_type)
+        response = StreamingHttpResponse(FileWrapper(open(serve_path, 'rb'), 8192), content_type=file_to_serve.mime_type)
 
-    response['Content-Length'] = os.path.getsize(file_path)
+    response['Content-Length'] = os.path.getsize(serve_path)
     if public:
         response['Content-Disposition'] = 'attachment; filename="{0}"'.format(file_to_serve.public_download_name())
     else:
         response['Content-Disposition'] = 'attachment; filename="{0}{1}"'.format(slugify(filename), extension)
 
-    return response
+    return compression.set_encoding_headers(response, file_to_serve.mime_type, encoding)
 
 
 def delete_file(article_object, file_object):
@@ -514,6 +662,9 @@ def save_file_to_journal(request, file_to_handle, label, description, xslt=False
 
     save_file_to_disk(file_to_handle, filename, folder_structure)
 
+    if xslt:
+        clear_xslt_cache()
+
     file_mime = guess_mime(filename)
 
     from core import models
@@ -542,6 +693,9 @@ def unlink_journal_file(request, file=None, xslt=False):
     if os.path.isfile(full_path):
         os.unlink(full_path)
 
+    if xslt:
+        clear_xslt_cache()
+
 
 def save_file_to_press(request, file_to_handle, label, description, public=False):
     original_filename = str(file_to_handle.name)
@@ -611,35 +765,179 @@ def file_children(file):
     return children
 
 
-def zip_files(files):
-    file_name = '{0}.zip'.format(uuid4())
+# Mime types that are already compressed, deflating them again wastes CPU for no gain
+COMPRESSED_MIMETYPES = IMAGE_MIMETYPES + (
+    'application/pdf',
+    'application/zip',
+    'application/epub+zip',
+    'application/gzip',
+    'application/x-gzip',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/vnd.oasis.opendocument.text',
+    'audio/mpeg',
+    'video/mp4',
+)
+
+
+class ZipStreamBuffer(object):
+    """ A write-only, unseekable file-like object that zipfile writes into and that we drain after each write so
+    that zip chunks can be yielded to the client as soon as they are produced.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def zip_compression_type(mime_type):
+    """ Returns the zipfile compression constant to use for a given mime type.
+
+    :param mime_type: a mime type string
+    :return: zipfile.ZIP_STORED or zipfile.ZIP_DEFLATED
+    """
+    if mime_type in COMPRESSED_MIMETYPES:
+        return zipfile.ZIP_STORED
+
+    return zipfile.ZIP_DEFLATED
 
-    # Copy files into a temp dir
-    _dir = os.path.join(settings.BASE_DIR, 'files/temp', str(uuid4()))
-    os.makedirs(_dir, 0o775)
+
+def zip_entries_for_files(files):
+    """ Builds a list of zip entries for a set of article File objects, making sure that files sharing an original
+    filename do not overwrite each other in the archive.
+
+    :param files: an iterable of core.models.File objects
+    :return: a list of (path on disk, name in archive, mime type) tuples
+    """
+    entries = []
+    seen_names = set()
 
     for file in files:
-        shutil.copy(file.self_article_path(), _dir)
+        name = file.original_filename or file.uuid_filename
+        root, extension = os.path.splitext(name)
+        counter = 1
+
+        while name in seen_names:
+            name = '{root}-{counter}{extension}'.format(root=root, counter=counter, extension=extension)
+            counter += 1
+
+        seen_names.add(name)
+        entries.append((file.self_article_path(), name, file.mime_type))
+
+    return entries
+
+
+def zip_stream(entries, chunk_size=8192):
+    """ Generates a zip archive on the fly from files on disk without copying them anywhere first.
+
+    :param entries: an iterable of (path on disk, name in archive, mime type) tuples. Missing files are skipped.
+    :param chunk_size: the size of the reads made against the source files
+    :return: a generator of bytes that together make up the zip archive
+    """
+    buffer = ZipStreamBuffer()
+
+    with zipfile.ZipFile(buffer, mode='w') as archive:
+        for path, name, mime_type in entries:
+            if not path or not os.path.isfile(path):
+                continue
+
+            file_size = os.path.getsize(path)
+            zip_info = zipfile.ZipInfo.from_file(path, arcname=name)
+            zip_info.compress_type = zip_compression_type(mime_type)
+
+            with open(path, 'rb') as source, \
+                    archive.open(zip_info, mode='w', force_zip64=file_size > zipfile.ZIP64_LIMIT) as destination:
+                for chunk in iter(lambda: source.read(chunk_size), b''):
+                    destination.write(chunk)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+
+            # the local file header's data descriptor is written when the entry is closed
+            yield buffer.drain()
 
-    zip_path = '{dir}.zip'.format(dir=_dir)
+    # closing the archive writes the central directory
+    yield buffer.drain()
+
+
+def serve_zip_stream(entries, file_name):
+    """ Streams a zip archive built from the given entries to the browser.
+
+    :param entries: an iterable of (path on disk, name in archive, mime type) tuples
+    :param file_name: the name of the zip file presented to the user
+    :return: a StreamingHttpResponse
+    """
+    filename, extension = os.path.splitext(file_name)
+
+    response = StreamingHttpResponse(zip_stream(entries), content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename="{0}{1}"'.format(slugify(filename), extension or '.zip')
+
+    return response
+
+
+def serve_zip_files(files, file_name=None):
+    """ Streams a zip archive of a set of article File objects to the browser.
+
+    :param files: an iterable of core.models.File objects
+    :param file_name: optional name of the zip file presented to the user
+    :return: a StreamingHttpResponse
+    """
+    if not file_name:
+        file_name = '{0}.zip'.format(uuid4())
+
+    return serve_zip_stream(zip_entries_for_files(files), file_name)
+
+
+def zip_files(files):
+    """ Writes a zip of a set of article File objects to the temp folder, for callers that need a file on disk.
+    Views should prefer serve_zip_files, which never touches the disk.
+
+    :param files: an iterable of core.models.File objects
+    :return: a list containing the path to the zip file and its name
+    """
+    file_name = '{0}.zip'.format(uuid4())
+    folder_structure = os.path.join(settings.BASE_DIR, 'files', 'temp')
+    mkdirs(folder_structure)
+    zip_path = os.path.join(folder_structure, file_name)
+
+    with open(zip_path, 'wb') as zip_file:
+        for chunk in zip_stream(zip_entries_for_files(files)):
+            zip_file.write(chunk)
 
-    shutil.make_archive(_dir, 'zip', _dir)
-    shutil.rmtree(_dir)
     return zip_path, file_name
 
 
-def serve_temp_file(file_path, file_name):
+def serve_temp_file(file_path, file_name, unlink=True, request=None):
     filename, extension = os.path.splitext(file_name)
     mime_type = guess_mime(file_name)
 
-    response = StreamingHttpResponse(FileWrapper(open(file_path, 'rb'), 8192), content_type=mime_type)
+    # only files that are kept around have stored encodings
+    serve_path, encoding = compression.negotiate(None if unlink else request, file_path, mime_type)
+
+    response = StreamingHttpResponse(FileWrapper(open(serve_path, 'rb'), 8192), content_type=mime_type)
 
-    response['Content-Length'] = os.path.getsize(file_path)
+    response['Content-Length'] = os.path.getsize(serve_path)
     response['Content-Disposition'] = 'attachment; filename="{0}{1}"'.format(slugify(filename), extension)
 
-    unlink_temp_file(file_path)
+    if unlink:
+        unlink_temp_file(file_path)
 
-    return response
+    return compression.set_encoding_headers(response, mime_type, encoding)
 
 
 def unlink_temp_file(file_path):
@@ -653,3 +951,21 @@ def checksum(file_path):
         for chunk in iter(lambda: f.read(4096), b""):
             hash_md5.update(chunk)
     return hash_md5.hexdigest()
+
+
+def cached_checksum(file_path):
+    """ Returns the checksum of a file, cached against its path, size and modification time so that each version of
+    a file is only hashed once.
+
+    :param file_path: the path to the file
+    :return: an md5 hex digest
+    """
+    stat = os.stat(file_path)
+    key = 'file_checksum_{0}_{1}_{2}'.format(file_path, stat.st_size, stat.st_mtime)
+    digest = cache.get(key)
+
+    if digest is None:
+        digest = checksum(file_path)
+        cache.set(key, digest, None)
+
+    return digest
@@ -0,0 +1,282 @@
+__copyright__ = "Copyright 2017 Birkbeck, University of London"
+__author__ = "Martin Paul Eve & Andy Byers"
+__license__ = "AGPL v3"
+__maintainer__ = "Birkbeck Centre for Technology and Publishing"
+
+import json
+import os
+import tempfile
+from wsgiref.util import FileWrapper
+
+from PIL import Image
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, Http404
+from django.views.decorators.cache import cache_control
+
+from core import files
+from utils import background, function_cache
+
+# The ladder of widths we generate for every cover, thumbnail and figure
+DERIVATIVE_WIDTHS = (160, 320, 640, 1024, 1600)
+DERIVATIVE_FOLDER = os.path.join(settings.BASE_DIR, 'files', 'derivatives')
+
+DERIVATIVE_FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'png': ('PNG', 'image/png'),
+}
+
+
+def webp_supported():
+    Image.init()
+    return 'WEBP' in Image.SAVE
+
+
+def derivative_path(checksum, width, image_format):
+    return os.path.join(DERIVATIVE_FOLDER, checksum[:2], '{0}-{1}.{2}'.format(checksum, width, image_format))
+
+
+def widths_path(checksum):
+    return os.path.join(DERIVATIVE_FOLDER, checksum[:2], '{0}.json'.format(checksum))
+
+
+def fallback_format(source_mime):
+    """ The non-WebP format we offer alongside WebP, PNG where the source may have transparency, otherwise JPEG. """
+    if source_mime in ('image/png', 'image/gif'):
+        return 'png'
+
+    return 'jpeg'
+
+
+def generate_derivatives(source_path, source_mime=None):
+    """ Generates the full ladder of derivatives for an image. Widths larger than the original are skipped, as are
+    derivatives that already exist.
+
+    :param source_path: the path to the original image
+    :param source_mime: the mime type of the original image
+    :return: a list of the paths generated
+    """
+    if not os.path.isfile(source_path):
+        return []
+
+    checksum = files.cached_checksum(source_path)
+    formats = [fallback_format(source_mime)]
+
+    if webp_supported():
+        formats.append('webp')
+
+    generated = []
+    widths = []
+
+    for width in DERIVATIVE_WIDTHS:
+        for image_format in formats:
+            path = generate_derivative(source_path, checksum, width, image_format)
+            if path:
+                generated.append(path)
+                if width not in widths:
+                    widths.append(width)
+
+    # record which widths exist so that srcsets and lookups don't offer or look for ones wider than the original
+    files.mkdirs(os.path.dirname(widths_path(checksum)))
+    write_widths(checksum, widths)
+
+    return generated
+
+
+def write_widths(checksum, widths):
+    path = widths_path(checksum)
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+
+    with os.fdopen(handle, 'w') as widths_file:
+        json.dump(widths, widths_file)
+    os.replace(temp_path, path)
+
+    cache.set('derivative_widths_{0}'.format(checksum), widths, None)
+
+
+def derivative_widths(source_path, source_mime=None):
+    """ Returns the widths that derivatives of an image were generated at. If they have not been generated yet,
+    generation is queued and None is returned.
+
+    :param source_path: the path to the original image
+    :param source_mime: the mime type of the original image
+    :return: a list of widths, smallest first, or None
+    """
+    if not os.path.isfile(source_path):
+        return []
+
+    checksum = files.cached_checksum(source_path)
+    key = 'derivative_widths_{0}'.format(checksum)
+    widths = cache.get(key)
+
+    if widths is None:
+        try:
+            with open(widths_path(checksum), 'r') as widths_file:
+                widths = json.load(widths_file)
+        except (IOError, ValueError):
+            queue_derivatives(source_path, source_mime)
+            return None
+
+        cache.set(key, widths, None)
+
+    return widths
+
+
+@function_cache.cache(60 * 60, key=lambda file_object, path: (file_object.pk, path, file_object.date_modified),
+                      local=True)
+def file_derivative_widths(file_object, path):
+    """ Returns the derivative widths of a core.models.File, keyed on the file rather than its checksum so that
+    listings showing many images skip the stat and checksum lookups of derivative_widths(). Widths are not cached
+    until the derivatives have been generated.
+
+    :param file_object: a File object
+    :param path: the path to the file on disk
+    :return: a list of widths, smallest first, or None
+    """
+    return derivative_widths(path, file_object.mime_type)
+
+
+def generate_derivative(source_path, checksum, width, image_format):
+    """ Generates a single derivative of an image.
+
+    :param source_path: the path to the original image
+    :param checksum: the checksum of the original image
+    :param width: the width to resize to, height is scaled to keep the aspect ratio
+    :param image_format: a key of DERIVATIVE_FORMATS
+    :return: the path to the derivative, or None if it could not be generated
+    """
+    path = derivative_path(checksum, width, image_format)
+
+    if os.path.isfile(path):
+        return path
+
+    try:
+        img = Image.open(source_path)
+    except (IOError, OSError):
+        return None
+
+    if img.size[0] < width:
+        return None
+
+    if image_format == 'jpeg' and img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    elif img.mode not in ('RGB', 'RGBA', 'L'):
+        img = img.convert('RGBA')
+
+    # the original height never limits the resize, so the result is exactly the requested width
+    img.thumbnail((width, img.size[1]), Image.ANTIALIAS)
+
+    files.mkdirs(os.path.dirname(path))
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    os.close(handle)
+
+    try:
+        img.save(temp_path, format=DERIVATIVE_FORMATS[image_format][0], quality=82)
+        os.replace(temp_path, path)
+    except (IOError, OSError, KeyError):
+        files.unlink_temp_file(temp_path)
+        return None
+
+    return path
+
+
+def queue_derivatives(source_path, source_mime=None):
+    """ Generates the ladder of derivatives for an image in the background.
+
+    :param source_path: the path to the original image
+    :param source_mime: the mime type of the original image
+    :return: a Future
+    """
+    return background.submit_once('images', source_path, generate_derivatives, source_path, source_mime,
+                                  durable=True)
+
+
+def queue_file_derivatives(file_object, path=None):
+    """ Queues derivatives for a core.models.File if it is an image.
+
+    :param file_object: a File object
+    :param path: optional path to the file, defaults to its article path
+    :return: None
+    """
+    if file_object.mime_type in files.IMAGE_MIMETYPES:
+        queue_derivatives(path or file_object.self_article_path(), file_object.mime_type)
+
+
+def find_derivative(source_path, width, image_format, source_mime=None):
+    """ Returns the path to the smallest derivative at least as wide as the requested width, or the largest there is
+    when the original was narrower than that. If derivatives have not been generated yet, generation is queued and
+    None is returned so that the caller can serve the original.
+
+    :param source_path: the path to the original image
+    :param width: the requested width
+    :param image_format: a key of DERIVATIVE_FORMATS
+    :param source_mime: the mime type of the original image
+    :return: a path or None
+    """
+    if image_format not in DERIVATIVE_FORMATS:
+        return None
+
+    widths = derivative_widths(source_path, source_mime)
+
+    if not widths:
+        return None
+
+    checksum = files.cached_checksum(source_path)
+    candidates = [ladder_width for ladder_width in widths if ladder_width >= int(width)] or widths[-1:]
+
+    for ladder_width in candidates:
+        path = derivative_path(checksum, ladder_width, image_format)
+        if os.path.isfile(path):
+            return path
+
+    return None
+
+
+def serve_file_or_derivative(request, file_object, path):
+    """ Serves an article image, or a resized copy of it when a width (and optionally format) is in the query string,
+    eg. figure.png?width=640&format=webp
+
+    :param request: HttpRequest object
+    :param file_object: a core.models.File object, used for the mime type and download name
+    :param path: the path to the image on disk
+    :return: a response containing the image
+    """
+    width = request.GET.get('width', '')
+
+    if width.isdigit() and file_object.mime_type in files.IMAGE_MIMETYPES:
+        image_format = request.GET.get('format', fallback_format(file_object.mime_type))
+        derivative = find_derivative(path, width, image_format, source_mime=file_object.mime_type)
+
+        if derivative:
+            return serve_derivative(derivative, image_format)
+
+    try:
+        return files.serve_file_to_browser(path, file_object)
+    except IOError:
+        raise Http404
+
+
+@cache_control(max_age=60 * 60 * 24 * 30)
+def serve_derivative(path, image_format):
+    """ Serves a derivative, these are keyed by checksum so they can be cached for a long time.
+
+    :param path: the path to the derivative
+    :param image_format: a key of DERIVATIVE_FORMATS
+    :return: HttpResponse object
+    """
+    response = HttpResponse(FileWrapper(open(path, 'rb'), 8192), content_type=DERIVATIVE_FORMATS[image_format][1])
+    response['Content-Length'] = os.path.getsize(path)
+
+    return response
+
+
+def srcset(url_for_width, widths):
+    """ Builds a srcset attribute value for an image served through a derivative URL.
+
+    :param url_for_width: a function taking a width and returning the URL of that derivative
+    :param widths: the widths that exist, see derivative_widths(), an empty srcset is returned for None
+    :return: a string eg. '/cover/160w.webp 160w, /cover/320w.webp 320w'
+    """
+    return ', '.join('{0} {1}w'.format(url_for_width(width), width) for width in widths or [])
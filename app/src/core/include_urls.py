@@ -44,6 +44,7 @@ urlpatterns = [
     url(r'^$', press_views.index, name='website_index'),
     url(r'^journals/$', press_views.journals, name='press_journals'),
     url(r'^kanban/$', core_views.kanban, name='kanban'),
+    url(r'^suggest/$', core_views.suggest, name='core_suggest'),
     url(r'^login/$', core_views.user_login, name='core_login'),
     url(r'^login/orcid/$', core_views.user_login_orcid, name='core_login_orcid'),
     url(r'^register/step/1/$', core_views.register, name='core_register'),
@@ -167,6 +168,7 @@ urlpatterns = [
 
     # Cache
     url(r'^manager/cache/flush/$', core_views.flush_cache, name='core_flush_cache'),
+    url(r'^manager/instrumentation/$', core_views.instrumentation_report, name='core_instrumentation'),
 
     url(r'^edit/article/(?P<article_id>\d+)/metadata/$', submission_views.edit_metadata, name='edit_metadata'),
     url(r'^edit/article/(?P<article_id>\d+)/authors/order/$', submission_views.order_authors, name='order_authors'),
@@ -183,6 +185,12 @@ urlpatterns = [
     url(r'^sitemap/$', journal_views.sitemap, name='journal_sitemap'),
 
     url(r'^download/file/(?P<file_id>\d+)/$', journal_views.download_journal_file, name='journal_file'),
+
+    # Chunked uploads
+    url(r'^upload/chunked/$', core_views.chunked_upload_start, name='core_chunked_upload_start'),
+    url(r'^upload/chunked/(?P<upload_id>[0-9a-f-]+)/$', core_views.chunked_upload, name='core_chunked_upload'),
+    url(r'^upload/chunked/(?P<upload_id>[0-9a-f-]+)/complete/$', core_views.chunked_upload_complete,
+        name='core_chunked_upload_complete'),
 ]
 
 # Journal homepage block loading
@@ -0,0 +1,319 @@
+__copyright__ = "Copyright 2017 Birkbeck, University of London"
+__author__ = "Martin Paul Eve & Andy Byers"
+__license__ = "AGPL v3"
+__maintainer__ = "Birkbeck Centre for Technology and Publishing"
+
+import bisect
+import json
+import os
+import random
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.template.backends import django as django_backend
+
+from core import files
+from utils import function_cache
+
+INSTRUMENTATION_FOLDER = os.path.join(settings.BASE_DIR, 'files', 'instrumentation')
+SAMPLE_RATE_KEY = 'instrumentation_sample_rate'
+RESET_KEY = 'instrumentation_reset'
+# the proportion of requests measured unless a different rate has been set with set_sample_rate()
+DEFAULT_SAMPLE_RATE = 0.01
+# how often each process reads the sample rate from the cache and writes its totals to disk
+REFRESH_SECONDS = 10
+FLUSH_SECONDS = 60
+# upper bounds of the latency histogram, in milliseconds, used to estimate percentiles
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+# the summary values views can be ordered by
+SORT_KEYS = ('requests', 'errors', 'latency_ms', 'p95_latency_ms', 'max_latency_ms', 'queries', 'max_queries',
+             'query_ms', 'template_ms', 'cache_hits', 'cache_misses')
+
+_local = threading.local()
+_lock = threading.Lock()
+_views = {}
+_state = {'rate': DEFAULT_SAMPLE_RATE, 'refreshed': 0, 'flushed': time.time(), 'started': time.time()}
+
+
+def sample_rate():
+    """ Returns the proportion of requests to measure. It is held in the cache so that it can be changed for every
+    process without a restart, and each process only looks it up every REFRESH_SECONDS.
+
+    :return: a float between 0 and 1
+    """
+    now = time.time()
+
+    if now - _state['refreshed'] > REFRESH_SECONDS:
+        _state['refreshed'] = now
+        rate = cache.get(SAMPLE_RATE_KEY)
+        _state['rate'] = DEFAULT_SAMPLE_RATE if rate is None else rate
+
+    return _state['rate']
+
+
+def set_sample_rate(rate, minutes=60):
+    if rate is None:
+        cache.delete(SAMPLE_RATE_KEY)
+    else:
+        cache.set(SAMPLE_RATE_KEY, rate, minutes * 60)
+
+
+def reset():
+    """ Deletes the recorded totals. Running processes drop theirs the next time they write them. """
+    cache.set(RESET_KEY, time.time(), None)
+
+    if os.path.isdir(INSTRUMENTATION_FOLDER):
+        for name in os.listdir(INSTRUMENTATION_FOLDER):
+            files.unlink_temp_file(os.path.join(INSTRUMENTATION_FOLDER, name))
+
+
+def timed_render(render):
+    # only the outermost render is timed, templates rendered from inside another are part of its time
+    def render_and_time(self, *args, **kwargs):
+        measurement = getattr(_local, 'measurement', None)
+
+        if measurement is None or measurement['rendering']:
+            return render(self, *args, **kwargs)
+
+        measurement['rendering'] = True
+        start = time.time()
+
+        try:
+            return render(self, *args, **kwargs)
+        finally:
+            measurement['template_ms'] += (time.time() - start) * 1000
+            measurement['rendering'] = False
+
+    return render_and_time
+
+
+django_backend.Template.render = timed_render(django_backend.Template.render)
+
+
+def start(request):
+    """ Decides whether to measure a request and, if so, starts recording its queries and cache lookups. Queries
+    are only recorded for measured requests, so the cost of the rest is one random number.
+
+    :param request: HttpRequest object
+    :return: None
+    """
+    discard()
+
+    if random.random() >= sample_rate():
+        return
+
+    measurement = {
+        'start': time.time(),
+        'template_ms': 0,
+        'rendering': False,
+        'cache': function_cache.collect(),
+        'connections': [],
+    }
+
+    for connection in connections.all():
+        measurement['connections'].append((connection, connection.force_debug_cursor, len(connection.queries_log)))
+        connection.force_debug_cursor = True
+
+    _local.measurement = measurement
+
+
+def discard():
+    """ Drops this thread's measurement without counting it, eg. one left behind by a request that never reached
+    finish(), and puts its connections back as they were.
+
+    :return: None
+    """
+    measurement = getattr(_local, 'measurement', None)
+    _local.measurement = None
+    function_cache.stop_collecting()
+
+    if measurement is not None:
+        for connection, force_debug_cursor, logged in measurement['connections']:
+            connection.force_debug_cursor = force_debug_cursor
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match else 'unresolved'
+
+
+def finish(request, response):
+    """ Adds a measured request to this process's totals for its view.
+
+    :param request: HttpRequest object
+    :param response: the HttpResponse, views that raise an exception are counted by their 500 response
+    :return: None
+    """
+    measurement = getattr(_local, 'measurement', None)
+
+    if measurement is None:
+        return
+
+    _local.measurement = None
+    function_cache.stop_collecting()
+    queries, query_ms = 0, 0.0
+
+    for connection, force_debug_cursor, logged in measurement['connections']:
+        connection.force_debug_cursor = force_debug_cursor
+        new_queries = list(connection.queries_log)[logged:]
+        queries += len(new_queries)
+        query_ms += sum(float(query['time']) for query in new_queries) * 1000
+
+    latency = (time.time() - measurement['start']) * 1000
+    name = view_name(request)
+
+    with _lock:
+        totals = _views.setdefault(name, new_totals())
+        totals['requests'] += 1
+        totals['errors'] += 1 if response.status_code >= 500 else 0
+        totals['latency_ms'] += latency
+        totals['max_latency_ms'] = max(totals['max_latency_ms'], latency)
+        totals['latency_buckets'][bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+        totals['queries'] += queries
+        totals['max_queries'] = max(totals['max_queries'], queries)
+        totals['query_ms'] += query_ms
+        totals['template_ms'] += measurement['template_ms']
+
+        for (namespace, counter), count in measurement['cache'].items():
+            totals['cache'].setdefault(namespace, {})
+            totals['cache'][namespace][counter] = totals['cache'][namespace].get(counter, 0) + count
+
+    if time.time() - _state['flushed'] > FLUSH_SECONDS:
+        flush()
+
+
+def new_totals():
+    return {
+        'requests': 0,
+        'errors': 0,
+        'latency_ms': 0.0,
+        'max_latency_ms': 0.0,
+        'latency_buckets': [0] * (len(LATENCY_BUCKETS) + 1),
+        'queries': 0,
+        'max_queries': 0,
+        'query_ms': 0.0,
+        'template_ms': 0.0,
+        'cache': {},
+    }
+
+
+def process_path():
+    return os.path.join(INSTRUMENTATION_FOLDER, '{0}-{1}.json'.format(socket.gethostname(), os.getpid()))
+
+
+def flush():
+    """ Writes this process's totals to its own file, replacing what it wrote before.
+
+    :return: None
+    """
+    _state['flushed'] = time.time()
+    reset_at = cache.get(RESET_KEY)
+
+    with _lock:
+        if reset_at and reset_at > _state['started']:
+            _views.clear()
+            _state['started'] = time.time()
+
+        snapshot = json.dumps({'started': _state['started'], 'views': _views})
+
+    files.mkdirs(INSTRUMENTATION_FOLDER)
+    path = process_path()
+    temp_path = '{0}.{1}.tmp'.format(path, threading.get_ident())
+
+    with open(temp_path, 'w') as snapshot_file:
+        snapshot_file.write(snapshot)
+    os.replace(temp_path, path)
+
+
+def merge(totals, other):
+    for key in ('requests', 'errors', 'latency_ms', 'queries', 'query_ms', 'template_ms'):
+        totals[key] += other[key]
+
+    totals['max_latency_ms'] = max(totals['max_latency_ms'], other['max_latency_ms'])
+    totals['max_queries'] = max(totals['max_queries'], other['max_queries'])
+    totals['latency_buckets'] = [count + other_count for count, other_count
+                                 in zip(totals['latency_buckets'], other['latency_buckets'])]
+
+    for namespace, counts in other['cache'].items():
+        merged = totals['cache'].setdefault(namespace, {})
+        for counter, count in counts.items():
+            merged[counter] = merged.get(counter, 0) + count
+
+
+def percentile(totals, fraction):
+    """ Estimates a percentile of latency from the histogram, as the upper bound of the bucket it falls in.
+
+    :param totals: a view's totals
+    :param fraction: eg. 0.95
+    :return: milliseconds, or None if there are no requests
+    """
+    buckets = totals['latency_buckets']
+    total = sum(buckets)
+
+    if not total:
+        return None
+
+    seen = 0
+    for index, count in enumerate(buckets):
+        seen += count
+
+        if seen >= total * fraction:
+            return LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else totals['max_latency_ms']
+
+
+def summarise(hours=24, sort='latency_ms'):
+    """ Merges the totals written by every process in the last few hours into a summary per view. Processes write
+    theirs every FLUSH_SECONDS, call flush() first to include this process's latest.
+
+    :param hours: ignore processes that haven't written their totals for this long
+    :param sort: the summary value to order views by, highest first
+    :return: a list of dictionaries, one per view
+    """
+    views = {}
+    cutoff = time.time() - hours * 60 * 60
+
+    names = os.listdir(INSTRUMENTATION_FOLDER) if os.path.isdir(INSTRUMENTATION_FOLDER) else []
+
+    for name in names:
+        path = os.path.join(INSTRUMENTATION_FOLDER, name)
+
+        if not name.endswith('.json') or os.path.getmtime(path) < cutoff:
+            continue
+
+        try:
+            with open(path, 'r') as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except (IOError, ValueError):
+            continue
+
+        for view, totals in snapshot['views'].items():
+            merge(views.setdefault(view, new_totals()), totals)
+
+    summaries = []
+
+    for view, totals in views.items():
+        requests = totals['requests']
+        cache_hits = sum(counts.get('hits', 0) + counts.get('local_hits', 0) for counts in totals['cache'].values())
+        cache_misses = sum(counts.get('misses', 0) for counts in totals['cache'].values())
+
+        summaries.append({
+            'view': view,
+            'requests': requests,
+            'errors': totals['errors'],
+            'latency_ms': totals['latency_ms'] / requests,
+            'p95_latency_ms': percentile(totals, 0.95),
+            'max_latency_ms': totals['max_latency_ms'],
+            'queries': totals['queries'] / requests,
+            'max_queries': totals['max_queries'],
+            'query_ms': totals['query_ms'] / requests,
+            'template_ms': totals['template_ms'] / requests,
+            'cache_hits': cache_hits / requests,
+            'cache_misses': cache_misses / requests,
+            'cache': totals['cache'],
+        })
+
+    return sorted(summaries, key=lambda summary: summary.get(sort) or 0, reverse=True)
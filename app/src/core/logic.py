@@ -20,8 +20,8 @@ from django.utils import timezone
 from django.template.loader import get_template
 from django.db.models import Q
 
-from core import models, files, plugin_installed_apps
-from utils.function_cache import cache
+from core import models, files, images, plugin_installed_apps
+from utils.function_cache import cache, tag
 from review import models as review_models
 from utils import render_template, notify_helpers, setting_handler
 from submission import models as submission_models
@@ -120,7 +120,7 @@ def settings_for_context(request):
         return {}
 
 
-@cache(600)
+@cache(600, tags=lambda journal, language: [tag('journal', journal), tag('settings', journal)], local=True)
 def cached_settings_for_context(journal, language):
     setting_groups = ['general', 'crosscheck']
     _dict = {group: {} for group in setting_groups}
@@ -294,6 +294,8 @@ def handle_default_thumbnail(request, journal, attr_form):
         journal.thumbnail_image = new_file
         journal.save()
 
+        images.queue_file_derivatives(new_file, path=new_file.journal_path(journal))
+
         return new_file
 
     return None
@@ -335,6 +337,7 @@ def handle_article_large_image_file(uploaded_file, article, request):
         article.save()
 
     resize_and_crop(new_file.self_article_path(), [750, 324], 'middle')
+    images.queue_file_derivatives(new_file)
 
 
 def handle_article_thumb_image_file(uploaded_file, article, request):
@@ -348,6 +351,8 @@ def handle_article_thumb_image_file(uploaded_file, article, request):
         article.thumbnail_image_file = new_file
         article.save()
 
+    images.queue_file_derivatives(new_file)
+
 
 def handle_email_change(request, email_address):
     request.user.email = email_address
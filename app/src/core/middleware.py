@@ -16,7 +16,7 @@ from django.conf import settings
 
 from press import models as press_models
 from utils import models as util_models, setting_handler
-from core import models as core_models
+from core import instrumentation, models as core_models
 
 
 def set_journal(request, site):
@@ -135,12 +135,14 @@ class PressMiddleware(object):
         elif request.press:
             allowed_urls = [
                 'core_manager', 'core_manager_news', 'core_manager_edit_news', 'core_news_list', 'core_news_item',
-                'news_file_download', 'core_flush_cache', 'core_login', 'core_login_orcid', 'core_register',
+                'news_file_download', 'core_flush_cache', 'core_instrumentation',
+                'core_login', 'core_login_orcid', 'core_register',
                 'core_confirm_account', 'core_orcid_registration', 'core_get_reset_token', 'core_reset_password',
                 'core_edit_profile', 'core_logout', 'press_cover_download', 'core_manager_index',
                 'django_summernote-editor', 'django_summernote-upload_attachment', 'cms_index', 'cms_page_new',
                 'cms_page_edit', 'cms_page', 'cms_nav', 'website_index', 'core_journal_contacts',
                 'core_journal_contact', 'core_journal_contacts_order', 'contact', 'core_edit_settings_group',
+                'core_chunked_upload_start', 'core_chunked_upload', 'core_chunked_upload_complete',
             ]
             allowed_pattern = 'press_'
 
@@ -178,3 +180,18 @@ class GlobalRequestMiddleware(object):
         except KeyError:
             pass
         return response
+
+
+class InstrumentationMiddleware(object):
+    """ Measures a sample of requests, see core.instrumentation. Listed first so that its latency covers every other
+    middleware.
+    """
+
+    @staticmethod
+    def process_request(request):
+        instrumentation.start(request)
+
+    @staticmethod
+    def process_response(request, response):
+        instrumentation.finish(request, response)
+        return response
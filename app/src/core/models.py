@@ -4,6 +4,7 @@ __license__ = "AGPL v3"
 __maintainer__ = "Birkbeck Centre for Technology and Publishing"
 
 import os
+import time
 import uuid
 import statistics
 import json
@@ -12,6 +13,7 @@ from bs4 import BeautifulSoup
 from hvad.models import TranslatableModel, TranslatedFields
 
 from django.conf import settings
+from django.core.cache import cache
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
 from django.core.files.storage import FileSystemStorage
 from django.db import models
@@ -20,7 +22,7 @@ from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.sites.models import Site
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.dispatch import receiver
 from django.urls import reverse
 
@@ -31,10 +33,12 @@ if settings.URL_CONFIG == 'path':
     urls.reverse = reverse
     urls.base.reverse = reverse
 
-from core import files
+from core import compression, files, render_profiling, renders
 from review import models as review_models
+from search import documents as search_documents, extraction as search_extraction, suggest as search_suggest
 from copyediting import models as copyediting_models
 from submission import models as submission_models
+from utils import function_cache
 
 fs = FileSystemStorage(location=settings.MEDIA_ROOT)
 
@@ -741,6 +745,7 @@ class Galley(models.Model):
             'graphic': 'xlink:href'
         }
 
+        figures = self.figure_manifest()['figures']
         missing_elements = []
 
         # iterate over all found elements
@@ -752,12 +757,7 @@ class Galley(models.Model):
                 # attempt to pull a URL from the specified attribute
                 url = os.path.basename(val.get(attribute, None))
 
-                try:
-                    try:
-                        self.images.get(original_filename=url)
-                    except File.MultipleObjectsReturned:
-                        self.images.filter(original_filename=url).first()
-                except File.DoesNotExist:
+                if url not in figures:
                     missing_elements.append(url)
 
         if not missing_elements:
@@ -765,13 +765,103 @@ class Galley(models.Model):
         else:
             return missing_elements
 
+    @staticmethod
+    def figure_manifest_key(galley_id):
+        return 'galley_figure_manifest_{0}'.format(galley_id)
+
+    @staticmethod
+    def get_figure_manifest(galley_id):
+        """ Returns the figure manifest of a galley from the cache, only touching the database when it is cold.
+
+        :param galley_id: a Galley PK
+        :return: a manifest dictionary, see build_figure_manifest
+        """
+        manifest = cache.get(Galley.figure_manifest_key(galley_id))
+
+        if manifest is None:
+            manifest = Galley.objects.select_related('article').get(pk=galley_id).build_figure_manifest()
+
+        return manifest
+
+    def figure_manifest(self):
+        manifest = cache.get(Galley.figure_manifest_key(self.pk))
+
+        if manifest is None:
+            manifest = self.build_figure_manifest()
+
+        return manifest
+
+    def build_figure_manifest(self):
+        """ Builds and caches a map of this galley's images, keyed by the filename used to reference them in the
+        galley, so that figure requests don't have to search the images table.
+
+        :return: a dictionary with the galley and article IDs and a 'figures' dictionary of filename to file details
+        """
+        figures = {}
+
+        for image in self.images.all():
+            # the first image with a given name wins, as it always has when looking figures up
+            if image.original_filename in figures:
+                continue
+
+            path = os.path.join(settings.BASE_DIR, 'files', 'articles', str(self.article_id), str(image.uuid_filename))
+
+            if os.path.isfile(path):
+                size, checksum = os.path.getsize(path), files.checksum(path)
+            else:
+                size, checksum = None, None
+
+            figures[image.original_filename] = {
+                'pk': image.pk,
+                'uuid_filename': image.uuid_filename,
+                'path': path,
+                'mime_type': image.mime_type,
+                'size': size,
+                'checksum': checksum,
+            }
+
+        manifest = {
+            'galley_id': self.pk,
+            'article_id': self.article_id,
+            'is_preprint': self.article.is_preprint if self.article else False,
+            'figures': figures,
+        }
+
+        cache.set(Galley.figure_manifest_key(self.pk), manifest, None)
+
+        return manifest
+
+    @staticmethod
+    def figure_from_manifest(manifest, file_name):
+        """ Returns an unsaved File carrying just enough of a figure's details to serve it, or None.
+
+        :param manifest: a galley figure manifest
+        :param file_name: the filename the figure is referenced by
+        :return: a File object or None
+        """
+        figure = manifest['figures'].get(file_name)
+
+        if not figure:
+            return None
+
+        return File(pk=figure['pk'], article_id=manifest['article_id'], mime_type=figure['mime_type'],
+                    original_filename=file_name, uuid_filename=figure['uuid_filename'])
+
     def file_content(self, dont_render=False):
         if self.file.mime_type == "text/html" or dont_render:
             # get raw HTML and render
             return self.file.get_file(self.article)
-        elif self.file.mime_type == "application/xml" or self.file.mime_type == 'text/xml':
-            # perform an XSLT render
-            return self.file.render_xml(self.article, galley=self)
+        elif renders.is_xml_galley(self):
+            # serve the stored XSLT render of this version of the galley, rendering it if need be
+            if not render_profiling.profiling_mode():
+                return renders.get_rendered_galley(self)
+
+            start = time.time()
+            content = renders.get_rendered_galley(self)
+            render_profiling.record('file_content', galley=self.pk, article=self.article_id,
+                                    total_ms=(time.time() - start) * 1000)
+
+            return content
 
     def path(self):
         url = reverse('article_download_galley', kwargs={'article_id': self.article.pk,
@@ -1052,3 +1142,75 @@ def setup_default_workflow(sender, instance, created, **kwargs):
     if created and not instance.signature:
         instance.signature = instance.full_name()
         instance.save()
+
+
+@receiver(post_save, sender=Account)
+@receiver(post_delete, sender=Account)
+def invalidate_account_suggestions(sender, instance, update_fields=None, **kwargs):
+    # logging in only updates last_login, which suggestions don't show
+    if update_fields is None or not set(update_fields) <= {'last_login'}:
+        search_suggest.queue_invalidate(search_suggest.ACCOUNTS)
+
+
+@receiver(post_save, sender=AccountRole)
+@receiver(post_delete, sender=AccountRole)
+def invalidate_account_role_suggestions(sender, instance, **kwargs):
+    # account suggestions on a journal are limited to accounts with a role on it
+    search_suggest.queue_invalidate(search_suggest.ACCOUNTS)
+
+
+@receiver(m2m_changed, sender=Galley.images.through)
+def reset_galley_figure_manifest(sender, instance, action, reverse, pk_set, **kwargs):
+    # clears are handled before they happen, while we can still see which galleys are affected
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    if reverse:
+        # the change was made from the File side, so every galley touched needs resetting
+        galley_ids = pk_set or instance.images.values_list('pk', flat=True)
+        cache.delete_many([Galley.figure_manifest_key(galley_id) for galley_id in galley_ids])
+    else:
+        cache.delete(Galley.figure_manifest_key(instance.pk))
+
+
+@receiver(post_save, sender=File)
+def reset_file_figure_manifests(sender, instance, created, **kwargs):
+    if not created:
+        galley_ids = Galley.objects.filter(images=instance).values_list('pk', flat=True)
+        cache.delete_many([Galley.figure_manifest_key(galley_id) for galley_id in galley_ids])
+
+
+@receiver(post_save, sender=Galley)
+def prerender_saved_galley(sender, instance, **kwargs):
+    renders.queue_galley_render(instance)
+
+
+@receiver(post_save, sender=Galley)
+def precompress_saved_galley(sender, instance, **kwargs):
+    if instance.file_id and compression.is_compressible(instance.file.mime_type):
+        compression.queue_precompress(instance.file.get_file_path(instance.article))
+
+
+@receiver(post_save, sender=Galley)
+def extract_saved_galley_text(sender, instance, **kwargs):
+    if instance.article_id:
+        search_extraction.queue_galley_extraction(instance)
+
+
+@receiver(post_delete, sender=Galley)
+def remove_deleted_galley_text(sender, instance, **kwargs):
+    search_extraction.remove_galley_text(instance.pk)
+
+    if instance.article_id:
+        search_documents.queue_article_index(instance.article_id)
+
+
+@receiver(post_delete, sender=Galley)
+def reset_deleted_galley_figure_manifest(sender, instance, **kwargs):
+    cache.delete(Galley.figure_manifest_key(instance.pk))
+
+
+@receiver(post_save, sender=SettingValue)
+@receiver(post_delete, sender=SettingValue)
+def invalidate_setting_caches(sender, instance, **kwargs):
+    function_cache.invalidate_tags(function_cache.tag('settings', instance.journal_id))
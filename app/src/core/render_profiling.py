@@ -0,0 +1,185 @@
+__copyright__ = "Copyright 2017 Birkbeck, University of London"
+__author__ = "Martin Paul Eve & Andy Byers"
+__license__ = "AGPL v3"
+__maintainer__ = "Birkbeck Centre for Technology and Publishing"
+
+import fcntl
+import json
+import os
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+
+PROFILE_FOLDER = os.path.join(settings.BASE_DIR, 'files', 'render_profiles')
+PROFILING_MODE_KEY = 'render_profiling_mode'
+
+# 'timing' records parse and transform times, 'xslt' also runs lxml's XSLT profiler which slows rendering down
+PROFILING_MODES = ('timing', 'xslt')
+# how often each process reads the profiling mode from the cache
+REFRESH_SECONDS = 10
+# daily profile files older than this are removed, the report cannot look further back
+PROFILE_DAYS = 7
+
+_state = {'mode': None, 'refreshed': 0}
+
+
+def profiling_mode():
+    """ Returns the current profiling mode. It is held in the cache so that it can be switched on for every process
+    without a restart, and switches itself off when it expires. Each process only looks it up every REFRESH_SECONDS.
+
+    :return: 'timing', 'xslt' or None
+    """
+    now = time.time()
+
+    if now - _state['refreshed'] > REFRESH_SECONDS:
+        _state['refreshed'] = now
+        _state['mode'] = cache.get(PROFILING_MODE_KEY)
+
+    return _state['mode']
+
+
+def set_profiling_mode(mode, minutes=60):
+    if mode:
+        cache.set(PROFILING_MODE_KEY, mode, minutes * 60)
+    else:
+        cache.delete(PROFILING_MODE_KEY)
+
+    # this process sees the change straight away, others within REFRESH_SECONDS
+    _state['refreshed'] = 0
+
+
+def profile_day(days_ago=0):
+    return time.strftime('%Y-%m-%d', time.localtime(time.time() - days_ago * 24 * 60 * 60))
+
+
+def profile_path(day=None):
+    return os.path.join(PROFILE_FOLDER, '{0}.jsonl'.format(day or profile_day()))
+
+
+def prune_profiles(days=PROFILE_DAYS):
+    """ Removes the daily profile files that fall outside the report window.
+
+    :param days: the number of days to keep, including today
+    :return: None
+    """
+    oldest = '{0}.jsonl'.format(profile_day(days - 1))
+
+    for filename in os.listdir(PROFILE_FOLDER):
+        if filename.endswith('.jsonl') and filename < oldest:
+            try:
+                os.unlink(os.path.join(PROFILE_FOLDER, filename))
+            except FileNotFoundError:
+                pass
+
+
+def record(kind, **entry):
+    """ Appends a profile entry to today's profile file.
+
+    :param kind: 'render' for an XSLT render, 'file_content' for a galley content lookup
+    :param entry: the values to record
+    :return: None
+    """
+    entry.update(kind=kind, timestamp=time.time())
+    os.makedirs(PROFILE_FOLDER, exist_ok=True)
+    path = profile_path()
+
+    # the first entry of each day clears out the files that have dropped out of the report window
+    if not os.path.isfile(path):
+        prune_profiles()
+
+    with open(path, 'a') as profile_file:
+        fcntl.flock(profile_file, fcntl.LOCK_EX)
+        profile_file.write(json.dumps(entry) + '\n')
+
+
+def template_stats(xslt_profile, limit=20):
+    """ Converts lxml's XSLT profile document into a list of the most expensive templates.
+
+    :param xslt_profile: the xslt_profile of a result tree rendered with profile_run=True
+    :param limit: the number of templates to keep
+    :return: a list of dictionaries of match, name, mode, calls and time in libxslt ticks
+    """
+    if xslt_profile is None:
+        return []
+
+    templates = [{
+        'match': template.get('match'),
+        'name': template.get('name'),
+        'mode': template.get('mode'),
+        'calls': int(template.get('calls', 0)),
+        'time': int(template.get('time', 0)),
+    } for template in xslt_profile.getroot().iter('template')]
+
+    return sorted(templates, key=lambda template: template['time'], reverse=True)[:limit]
+
+
+def read_profiles(days=PROFILE_DAYS):
+    """ Reads the profile entries recorded over the last few days.
+
+    :param days: the number of days to read, including today, at most PROFILE_DAYS are kept
+    :return: a generator of entry dictionaries
+    """
+    for offset in range(days):
+        path = profile_path(profile_day(offset))
+
+        if not os.path.isfile(path):
+            continue
+
+        with open(path, 'r') as profile_file:
+            for line in profile_file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def summarise(entries):
+    """ Aggregates profile entries per galley and per XSLT template.
+
+    :param entries: an iterable of profile entries
+    :return: a dictionary of 'galleys', 'templates' and 'lookups' summaries
+    """
+    galleys = {}
+    templates = defaultdict(lambda: {'calls': 0, 'time': 0, 'renders': 0})
+    lookups = []
+
+    for entry in entries:
+        if entry['kind'] == 'file_content':
+            lookups.append(entry['total_ms'])
+            continue
+
+        key = entry.get('galley') or 'file {0}'.format(entry.get('file'))
+        summary = galleys.setdefault(key, {'galley': key, 'article': entry.get('article'), 'xsl': entry.get('xsl'),
+                                           'renders': 0, 'parse_ms': 0, 'transform_ms': 0, 'max_ms': 0,
+                                           'input_size': entry.get('input_size'), 'output_size': 0})
+        summary['renders'] += 1
+        summary['parse_ms'] += entry['parse_ms']
+        summary['transform_ms'] += entry['transform_ms']
+        summary['max_ms'] = max(summary['max_ms'], entry['parse_ms'] + entry['transform_ms'])
+        summary['output_size'] = entry.get('output_size')
+
+        for template in entry.get('templates', []):
+            stats = templates[(entry.get('xsl'), template['match'], template['name'], template['mode'])]
+            stats['calls'] += template['calls']
+            stats['time'] += template['time']
+            stats['renders'] += 1
+
+    for summary in galleys.values():
+        summary['mean_ms'] = (summary['parse_ms'] + summary['transform_ms']) / summary['renders']
+
+    lookups.sort()
+
+    return {
+        'galleys': sorted(galleys.values(), key=lambda summary: summary['mean_ms'], reverse=True),
+        'templates': sorted(
+            [dict(stats, xsl=xsl, match=match, name=name, mode=mode)
+             for (xsl, match, name, mode), stats in templates.items()],
+            key=lambda template: template['time'], reverse=True),
+        'lookups': {
+            'count': len(lookups),
+            'median_ms': lookups[len(lookups) // 2] if lookups else None,
+            'p95_ms': lookups[int(len(lookups) * 0.95)] if lookups else None,
+        },
+    }
@@ -0,0 +1,527 @@
+__copyright__ = "Copyright 2017 Birkbeck, University of London"
+__author__ = "Martin Paul Eve & Andy Byers"
+__license__ = "AGPL v3"
+__maintainer__ = "Birkbeck Centre for Technology and Publishing"
+
+import csv
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+from wsgiref.util import FileWrapper
+
+from lxml import html as lxml_html
+
+from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponse, StreamingHttpResponse
+
+from core import compression, files
+from utils import background, function_cache
+
+RENDER_FOLDER = os.path.join(settings.BASE_DIR, 'files', 'rendered')
+XML_MIMETYPES = ('application/xml', 'text/xml')
+# bump this when the contents of the index change so that stored indexes are rebuilt from their stored renders
+INDEX_FORMAT = 2
+WORDS_PER_MINUTE = 230
+HEADINGS = ('h2', 'h3', 'h4', 'h5', 'h6')
+# stored versions that no galley points to are removed by clean_render_folder() once they are this old
+STALE_VERSION_SECONDS = 24 * 60 * 60
+STORED_VERSION = re.compile(r'^([0-9a-f]+-[0-9a-f]+)[.-]')
+
+
+def is_xml_galley(galley):
+    return galley.file.mime_type in XML_MIMETYPES
+
+
+def render_version(galley):
+    """ Identifies a version of a galley's rendered output by the checksums of its XML file and of the XSLT it is
+    transformed with, so that replacing either produces a new version.
+
+    :param galley: a Galley object
+    :return: a string, or None if either file is missing
+    """
+    xml_path = galley.file.get_file_path(galley.article)
+    xsl_path = files.journal_xsl_path(galley.article.journal)
+
+    try:
+        return '{0}-{1}'.format(files.cached_checksum(xml_path), files.cached_checksum(xsl_path))
+    except FileNotFoundError:
+        return None
+
+
+def render_path(version):
+    return os.path.join(RENDER_FOLDER, version[:2], '{0}.html'.format(version))
+
+
+# stands in for the galley in a rendered article page until its stored render is spliced in
+CONTENT_MARKER = '<!-- stored galley render -->'
+
+
+def index_path(version):
+    return os.path.join(RENDER_FOLDER, version[:2], '{0}.json'.format(version))
+
+
+def structure_path(version):
+    return os.path.join(RENDER_FOLDER, version[:2], '{0}-structure-{1}.json'.format(version, INDEX_FORMAT))
+
+
+def table_folder(version):
+    return os.path.join(RENDER_FOLDER, version[:2], '{0}-tables'.format(version))
+
+
+def write_atomically(path, content):
+    files.mkdirs(os.path.dirname(path))
+    # a unique temp file, renders of the same version can be written by several threads at once
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+
+    with os.fdopen(handle, 'w', encoding='utf-8') as output_file:
+        output_file.write(content)
+
+    os.replace(temp_path, path)
+
+
+def get_rendered_galley(galley):
+    """ Returns the rendered HTML of an XML galley, rendering and storing it if this version hasn't been rendered yet.
+
+    :param galley: a Galley object
+    :return: a string of HTML
+    """
+    version = render_version(galley)
+
+    if version is None:
+        # let render_xml log which file is missing
+        return galley.file.render_xml(galley.article, galley=galley)
+
+    try:
+        with open(render_path(version), 'r', encoding='utf-8') as rendered_file:
+            return rendered_file.read()
+    except FileNotFoundError:
+        return render_galley(galley, version)
+
+
+def render_galley(galley, version=None):
+    """ Renders an XML galley and stores the output and its table and figure index. Galleys with the same XML and
+    XSLT share a version, so the galley's previous version is left for clean_render_folder() to remove.
+
+    :param galley: a Galley object
+    :param version: the galley's render version, if already known
+    :return: a string of HTML
+    """
+    version = version or render_version(galley)
+    html = str(galley.file.render_xml(galley.article, galley=galley))
+
+    if not version or not html:
+        return html
+
+    write_atomically(render_path(version), html)
+    compression.queue_precompress(render_path(version), fragment=True)
+    build_galley_index(html, version)
+
+    return html
+
+
+def current_versions():
+    """ Returns the render version of every XML galley.
+
+    :return: a set of version strings
+    """
+    from core import models
+
+    galleys = models.Galley.objects.filter(file__mime_type__in=XML_MIMETYPES).select_related(
+        'file', 'article__journal')
+
+    return {version for version in (render_version(galley) for galley in galleys.iterator()) if version}
+
+
+def clean_render_folder(max_age=STALE_VERSION_SECONDS):
+    """ Removes the stored renders, indexes and table CSVs of versions that no galley points to any more, along with
+    abandoned temp files. Recently written files are kept, their galley may not have been saved yet.
+
+    :param max_age: the age in seconds after which an unused version is removed
+    :return: None
+    """
+    if not os.path.isdir(RENDER_FOLDER):
+        return
+
+    versions = current_versions()
+    cutoff = time.time() - max_age
+
+    for folder in os.listdir(RENDER_FOLDER):
+        folder_path = os.path.join(RENDER_FOLDER, folder)
+
+        if not os.path.isdir(folder_path):
+            continue
+
+        for name in os.listdir(folder_path):
+            path = os.path.join(folder_path, name)
+            match = STORED_VERSION.match(name)
+
+            if not (name.endswith('.tmp') or (match and match.group(1) not in versions)):
+                continue
+
+            if os.path.getmtime(path) >= cutoff:
+                continue
+
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                files.unlink_temp_file(path)
+
+
+def element_text(element):
+    return ' '.join(element.text_content().split())
+
+
+def first_text(element, class_name):
+    """ Returns the text of the first descendant of an element with the given class, or an empty string. """
+    matches = element.xpath('.//*[contains(concat(" ", normalize-space(@class), " "), " {0} ")]'.format(class_name))
+    return element_text(matches[0]) if matches else ''
+
+
+def empty_index():
+    return {'format': INDEX_FORMAT, 'tables': [], 'figures': [], 'sections': [], 'reference_count': 0,
+            'word_count': 0, 'reading_time': 0}
+
+
+def extract_structure(document):
+    """ Extracts the section headings of a rendered galley along with its reference and word counts. A heading's
+    anchor is its own id or, failing that, the id of the section it heads.
+
+    :param document: an lxml HTML element
+    :return: a dictionary of sections, reference_count, word_count and reading_time in minutes
+    """
+    sections = []
+
+    for heading in document.iter(*HEADINGS):
+        title = element_text(heading)
+
+        if not title:
+            continue
+
+        parent = heading.getparent()
+        anchor = heading.get('id') or (parent.get('id') if parent is not None and parent.tag == 'div' else None)
+
+        sections.append({'title': title, 'level': int(heading.tag[1]), 'anchor': anchor})
+
+    reference_lists = document.xpath('//div[@id="reflist"]')
+    reference_count = sum(len(reference_list.xpath('./*[@id]')) for reference_list in reference_lists)
+
+    words = len(document.text_content().split())
+    words -= sum(len(reference_list.text_content().split()) for reference_list in reference_lists)
+
+    return {
+        'sections': sections,
+        'reference_count': reference_count,
+        'word_count': words,
+        'reading_time': -(-words // WORDS_PER_MINUTE),
+    }
+
+
+def extract_index(html):
+    """ Extracts the tables, figures and structure of rendered galley HTML. A table is identified by the nearest
+    enclosing div with an id, which is the id used in table download links.
+
+    :param html: a string of rendered HTML
+    :return: a dictionary of tables, figures and structure, tables include their header and row cells
+    """
+    index = empty_index()
+
+    if not html.strip():
+        return index
+
+    document = lxml_html.fromstring(html)
+    seen = set()
+
+    for table in document.iter('table'):
+        wrapper = next((div for div in table.iterancestors('div') if div.get('id')), None)
+
+        if wrapper is None or wrapper.get('id') in seen:
+            continue
+
+        seen.add(wrapper.get('id'))
+        container = next((div for div in table.iterancestors('div') if 'table-wrap' in div.get('class', '').split()),
+                         wrapper)
+
+        index['tables'].append({
+            'id': wrapper.get('id'),
+            'label': first_text(container, 'table-label'),
+            'caption': first_text(container, 'table-caption'),
+            'headers': [element_text(cell) for cell in table.iter('th')],
+            'rows': [[element_text(cell) for cell in row.findall('td')]
+                     for row in table.iter('tr') if row.find('td') is not None],
+        })
+
+    for figure in document.xpath('//div[contains(concat(" ", normalize-space(@class), " "), " fig ")]'):
+        identified = figure.xpath('descendant-or-self::*[@id]')
+        images = figure.xpath('.//img')
+
+        index['figures'].append({
+            'id': identified[0].get('id') if identified else None,
+            'label': first_text(figure, 'fig-label'),
+            'caption': first_text(figure, 'fig-caption'),
+            'image': (images[0].get('data-img') or images[0].get('src')) if images else None,
+        })
+
+    index.update(extract_structure(document))
+
+    return index
+
+
+def build_galley_index(html, version):
+    """ Indexes the tables and figures of a rendered galley, writing each table out as a CSV alongside a JSON index.
+
+    :param html: a string of rendered HTML
+    :param version: the galley's render version
+    :return: the index dictionary
+    """
+    index = extract_index(html)
+    folder = table_folder(version)
+    files.mkdirs(folder)
+
+    for position, table in enumerate(index['tables']):
+        table['csv'] = 'table-{0}.csv'.format(position)
+
+        with open(os.path.join(folder, table['csv']), 'w', encoding='utf-8', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(table['headers'])
+            writer.writerows(table['rows'])
+
+        compression.queue_precompress(os.path.join(folder, table['csv']))
+
+    write_atomically(index_path(version), json.dumps(index))
+    write_atomically(structure_path(version), json.dumps(structure_of(index)))
+
+    return index
+
+
+def get_galley_index(galley):
+    """ Returns the index of an XML galley's tables, figures and structure, rendering the galley first if needs be.
+
+    :param galley: a Galley object
+    :return: a dictionary, see extract_index
+    """
+    version = render_version(galley)
+
+    if version is None:
+        return empty_index()
+
+    try:
+        with open(index_path(version), 'r', encoding='utf-8') as index_file:
+            index = json.load(index_file)
+
+        if index.get('format') == INDEX_FORMAT:
+            return index
+    except FileNotFoundError:
+        pass
+
+    html = get_rendered_galley(galley)
+
+    if not html:
+        return empty_index()
+
+    return build_galley_index(html, version)
+
+
+def structure_of(index):
+    return {key: index[key] for key in ('sections', 'reference_count', 'word_count', 'reading_time')}
+
+
+@function_cache.cache(60 * 60, local=True)
+def read_structure(version):
+    """ Reads the stored structure of a render version, which never changes once written.
+
+    :param version: a render version
+    :return: a dictionary, or None if it hasn't been stored
+    """
+    try:
+        with open(structure_path(version), 'r', encoding='utf-8') as structure_file:
+            return json.load(structure_file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def get_article_structure(article):
+    """ Returns the sections, reference count, word count and reading time of an article's render galley. These are
+    stored apart from the table and figure index so that article pages don't have to read the whole index.
+
+    :param article: an Article object
+    :return: a dictionary, or None if the article has no XML render galley
+    """
+    galley = article.get_render_galley
+
+    if not galley or not is_xml_galley(galley):
+        return None
+
+    version = render_version(galley)
+
+    if version is None:
+        return structure_of(empty_index())
+
+    structure = read_structure(version)
+
+    if structure is None:
+        structure = structure_of(get_galley_index(galley))
+        write_atomically(structure_path(version), json.dumps(structure))
+
+    return structure
+
+
+def get_table_csv_path(galley, table_id):
+    """ Returns the path to the precomputed CSV of a galley's table.
+
+    :param galley: a Galley object
+    :param table_id: the id of the table in the rendered HTML, eg. T1
+    :return: a path, or None if the galley has no such table
+    """
+    for table in get_galley_index(galley)['tables']:
+        if table['id'] == table_id:
+            return os.path.join(table_folder(render_version(galley)), table['csv'])
+
+    return None
+
+
+def serve_rendered_galley(request, galley):
+    """ Serves the stored render of an XML galley on its own, in a stored gzip or brotli encoding where the client
+    accepts one.
+
+    :param request: HttpRequest object
+    :param galley: an XML Galley
+    :return: a StreamingHttpResponse
+    """
+    html = get_rendered_galley(galley)
+    version = render_version(galley)
+
+    if not version or not os.path.isfile(render_path(version)):
+        return HttpResponse(html, content_type='text/html')
+
+    serve_path, encoding = compression.negotiate(request, render_path(version), 'text/html')
+    response = StreamingHttpResponse(FileWrapper(open(serve_path, 'rb'), 8192), content_type='text/html')
+    response['Content-Length'] = os.path.getsize(serve_path)
+
+    return compression.set_encoding_headers(response, 'text/html', encoding)
+
+
+def stored_render_path(request, galley):
+    """ Returns the path of a galley's stored render if it can be spliced into a gzip encoded article page for this
+    client, see splice_rendered_galley(). Missing or out of date fragments are queued for generation.
+
+    :param request: HttpRequest object
+    :param galley: the article's render Galley or None
+    :return: a path or None
+    """
+    if not galley or not is_xml_galley(galley) or 'gzip' not in compression.accepted_encodings(request):
+        return None
+
+    version = render_version(galley)
+
+    if not version or not os.path.isfile(render_path(version)):
+        return None
+
+    path = render_path(version)
+
+    if not compression.is_current(path, path + compression.FRAGMENT_SUFFIX):
+        compression.queue_precompress(path, fragment=True)
+        return None
+
+    return path
+
+
+def splice_rendered_galley(response, path):
+    """ Replaces CONTENT_MARKER in a rendered article page with a stored render, gzip encoding the page around the
+    render's stored fragment so that the render itself isn't compressed again.
+
+    :param response: an HttpResponse of a page rendered with CONTENT_MARKER in place of the galley
+    :param path: the path from stored_render_path()
+    :return: the response
+    """
+    marker = CONTENT_MARKER.encode('utf-8')
+    content = response.content
+
+    if content.count(marker) != 1:
+        with open(path, 'rb') as rendered_file:
+            response.content = content.replace(marker, rendered_file.read())
+        return response
+
+    prefix, suffix = content.split(marker)
+    response.content = compression.splice_gzip(prefix, path, suffix)
+    response['Content-Length'] = len(response.content)
+
+    return compression.set_encoding_headers(response, 'text/html', 'gzip')
+
+
+def prerender_galley(galley_id):
+    """ Renders a galley unless its current version has already been stored, used by the background queue.
+
+    :param galley_id: the pk of a Galley
+    :return: None
+    """
+    from core import models
+
+    try:
+        galley = models.Galley.objects.select_related('file', 'article__journal').get(pk=galley_id)
+    except models.Galley.DoesNotExist:
+        return
+
+    version = render_version(galley)
+
+    if version and not os.path.isfile(render_path(version)):
+        render_galley(galley, version)
+    elif version:
+        get_galley_index(galley)
+
+
+def timed_render(galley_id, force=False):
+    """ Renders a galley and times it, used by bulk re-renders where each call may run in a worker process.
+
+    :param galley_id: the pk of a Galley
+    :param force: render even if the galley's current version is already stored
+    :return: a tuple of galley pk, article pk, seconds taken, whether it was rendered and an error message or None
+    """
+    from core import models
+
+    start = time.time()
+
+    try:
+        galley = models.Galley.objects.select_related('file', 'article__journal').get(pk=galley_id)
+        version = render_version(galley)
+
+        if version is None:
+            return galley_id, galley.article_id, time.time() - start, False, 'Galley XML or XSLT file is missing.'
+
+        if not force and os.path.isfile(render_path(version)):
+            # brings an index written in an older format up to date without rendering again
+            get_galley_index(galley)
+            return galley_id, galley.article_id, time.time() - start, False, None
+
+        if not render_galley(galley, version):
+            return galley_id, galley.article_id, time.time() - start, False, 'The render produced no output.'
+    except Exception as e:
+        return galley_id, None, time.time() - start, False, '{0}: {1}'.format(type(e).__name__, e)
+
+    return galley_id, galley.article_id, time.time() - start, True, None
+
+
+def queue_galley_render(galley):
+    """ Queues a background render of an XML galley once the current transaction has committed.
+
+    :param galley: a Galley object
+    :return: None
+    """
+    if galley.file_id and is_xml_galley(galley):
+        transaction.on_commit(
+            lambda: background.submit_once('render', ('galley', galley.pk), prerender_galley, galley.pk,
+                                           durable=True)
+        )
+
+
+def queue_article_renders(article):
+    """ Queues background renders of all of an article's XML galleys.
+
+    :param article: an Article object
+    :return: None
+    """
+    for galley in article.galley_set.select_related('file'):
+        queue_galley_render(galley)
@@ -1,11 +1,8 @@
-import os
-
 from django import template
 from django.template.defaultfilters import filesizeformat
+from django.urls import reverse
 
-from bs4 import BeautifulSoup
-
-from core import models
+from core import images
 
 register = template.Library()
 
@@ -20,30 +17,7 @@ def file_size(file, article):
 
 @register.simple_tag()
 def has_missing_supplements(galley):
-    xml_file_contents = galley.file.get_file(galley.article)
-
-    souped_xml = BeautifulSoup(xml_file_contents, 'lxml')
-
-    elements = {
-        'img': 'src',
-        'graphic': 'xlink:href'
-    }
-
-    missing_elements = []
-
-    # iterate over all found elements
-    for element, attribute in elements.items():
-        images = souped_xml.findAll(element)
-
-        # iterate over all found elements of each type in the elements dictionary
-        for idx, val in enumerate(images):
-            # attempt to pull a URL from the specified attribute
-            url = os.path.basename(val.get(attribute, None))
-
-            try:
-                galley.images.get(original_filename=url)
-            except models.File.DoesNotExist:
-                missing_elements.append(url)
+    missing_elements = galley.has_missing_image_files()
 
     if not missing_elements:
         return False
@@ -79,3 +53,35 @@ def file_type(article, file):
     if file in review_files:
         return 'Review Comment'
     return 'Other'
+
+
+@register.simple_tag()
+def webp_supported():
+    """ Whether WebP derivatives are generated here, use as {% webp_supported as webp %} before offering them. """
+    return images.webp_supported()
+
+
+@register.simple_tag()
+def article_image_srcset(article, file, image_format=None):
+    """ Returns a srcset of resized copies of an article image, as JPEG or PNG unless a format is given. """
+    image_format = image_format or images.fallback_format(file.mime_type)
+
+    return images.srcset(lambda width: reverse('article_file_derivative', kwargs={
+        'identifier_type': 'id',
+        'identifier': article.pk,
+        'file_id': file.pk,
+        'width': width,
+        'image_format': image_format,
+    }), images.file_derivative_widths(file, file.self_article_path()))
+
+
+@register.simple_tag(takes_context=True)
+def journal_cover_srcset(context, image_format=None):
+    """ Returns a srcset of resized copies of the current journal's cover image. """
+    journal = context['request'].journal
+    image_format = image_format or images.fallback_format(journal.thumbnail_image.mime_type)
+
+    return images.srcset(lambda width: reverse('journal_cover_derivative', kwargs={
+        'width': width,
+        'image_format': image_format,
+    }), images.file_derivative_widths(journal.thumbnail_image, journal.thumbnail_image.journal_path(journal)))
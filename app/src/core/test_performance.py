@@ -0,0 +1,223 @@
+__copyright__ = "Copyright 2017 Birkbeck, University of London"
+__author__ = "Martin Paul Eve & Andy Byers"
+__license__ = "AGPL v3"
+__maintainer__ = "Birkbeck Centre for Technology and Publishing"
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import namedtuple
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from core import models as core_models
+from journal import models as journal_models
+from review import models as review_models
+from search import backends as search_backends, documents as search_documents
+from submission import models as submission_models
+from utils import function_cache, setting_handler
+from utils.testing import setup
+
+# a view may make at most queries + per_article * the number of fixture articles it could list with a cold cache.
+# Public listings have no per article allowance, so a query added per listed article fails straight away. Render
+# times vary too much between machines to assert on, they are only reported
+Budget = namedtuple('Budget', ['queries', 'per_article'])
+
+ARTICLES_PER_ISSUE = 10
+ISSUES = 3
+
+BUDGETS = {
+    'website_index': Budget(40, 0),
+    'journal_articles': Budget(40, 0),
+    'journal_issue': Budget(40, 0),
+    'article_view': Budget(60, 0),
+    'search': Budget(40, 0),
+    'journal_sitemap': Budget(15, 0),
+    'core_dashboard': Budget(80, 2),
+    'kanban': Budget(80, 2),
+    'article-list': Budget(25, 0),
+    'OAI_list_records': Budget(20, 0),
+}
+
+# filled as the tests run and printed once they have all finished
+RESULTS = {}
+
+
+class PerformanceBudgetTests(TestCase):
+    """
+    Guards the query counts of the busiest pages, and reports their render times, against a journal with issues,
+    sections, published articles with authors, keywords and galleys, articles in review and reviewers.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        setup.create_press()
+        cls.journal, _ = setup.create_journals()
+        setup.create_roles(['reviewer', 'editor', 'author', 'section-editor', 'production', 'copyeditor',
+                            'typesetter', 'proofreader', 'proofing_manager'])
+
+        setting_handler.save_setting('general', 'journal_name', cls.journal, 'Performance Journal')
+        setting_handler.save_setting('general', 'journal_issn', cls.journal, '0000-0000')
+
+        cls.editor = setup.create_editor(cls.journal)
+        cls.author = setup.create_author(cls.journal)
+        cls.reviewers = [setup.create_user('reviewer{0}@example.com'.format(index), ['reviewer'],
+                                           journal=cls.journal) for index in range(3)]
+
+        sections = submission_models.Section.objects.language('en')
+        cls.sections = [sections.create(journal=cls.journal, name=name, plural='{0}s'.format(name))
+                        for name in ('Article', 'Review', 'Editorial')]
+        keywords = [submission_models.Keyword.objects.create(word=word)
+                    for word in ('open access', 'publishing', 'peer review', 'metadata')]
+
+        cls.issues = []
+        cls.articles = []
+
+        for number in range(1, ISSUES + 1):
+            issue = journal_models.Issue.objects.create(journal=cls.journal, volume=1, issue=number,
+                                                        issue_title='Issue {0}'.format(number),
+                                                        issue_description='An issue', order=number)
+            cls.issues.append(issue)
+
+            for index in range(ARTICLES_PER_ISSUE):
+                article = cls.create_article('Article {0}.{1}'.format(number, index), submission_models.STAGE_PUBLISHED,
+                                             cls.sections[index % len(cls.sections)], issue, keywords)
+                cls.articles.append(article)
+
+        for index in range(5):
+            article = cls.create_article('Submission {0}'.format(index), submission_models.STAGE_UNDER_REVIEW,
+                                         cls.sections[0])
+
+            for reviewer in cls.reviewers:
+                review_models.ReviewAssignment.objects.create(article=article, reviewer=reviewer, editor=cls.editor,
+                                                              date_due=timezone.now())
+
+        # the published articles are indexed into a throwaway index so that search ranks and lists real results
+        cls.search_folder = tempfile.mkdtemp()
+        cls.search_backend = list(search_backends._backend)
+        search_backends._backend[:] = [search_backends.SQLiteFTSBackend(os.path.join(cls.search_folder,
+                                                                                     'index.sqlite3'))]
+        search_documents.index_articles([article.pk for article in cls.articles])
+
+    @classmethod
+    def create_article(cls, title, stage, section, issue=None, keywords=None):
+        article = submission_models.Article.objects.create(
+            owner=cls.author, correspondence_author=cls.author, title=title, abstract='An abstract about {0}'.format(
+                title), stage=stage, journal=cls.journal, section=section, primary_issue=issue,
+            date_published=timezone.now() if stage == submission_models.STAGE_PUBLISHED else None,
+        )
+        article.authors.add(cls.author)
+        submission_models.FrozenAuthor.objects.create(article=article, author=cls.author, first_name='Author',
+                                                      last_name=title, institution='Birkbeck')
+
+        if keywords:
+            article.keywords.add(*keywords)
+
+        if issue:
+            issue.articles.add(article)
+            galley_file = core_models.File.objects.create(article_id=article.pk, mime_type='application/pdf',
+                                                          original_filename='article.pdf',
+                                                          uuid_filename='{0}.pdf'.format(article.pk),
+                                                          owner=cls.author, is_galley=True)
+            core_models.Galley.objects.create(article=article, file=galley_file, label='PDF', type='pdf')
+
+        return article
+
+    @classmethod
+    def tearDownClass(cls):
+        super(PerformanceBudgetTests, cls).tearDownClass()
+        search_backends._backend[:] = cls.search_backend
+        shutil.rmtree(cls.search_folder, ignore_errors=True)
+
+        if not RESULTS:
+            return
+
+        # the fixture's setup replaces sys.stdout, so the report is written to the real one
+        output = sys.__stdout__
+        output.write('\n{0:<20} {1:>8} {2:>8} {3:>8} {4:>10} {5:>10}\n'.format(
+            'View', 'Queries', 'Warm', 'Budget', 'Cold (ms)', 'Warm (ms)'))
+
+        for name in sorted(RESULTS):
+            queries, warm_queries, budget_queries, ms, warm_ms = RESULTS[name]
+            output.write('{0:<20} {1:>8} {2:>8} {3:>8} {4:>10.0f} {5:>10.0f}{6}\n'.format(
+                name, queries, warm_queries, budget_queries, ms, warm_ms,
+                '  over budget' if queries > budget_queries else ''))
+
+        output.flush()
+
+    def measure(self, name, url, user=None, articles=0):
+        """ Requests a page with a cold cache and again with a warm one, records the queries and times of both and
+        checks the cold request's queries against its budget.
+
+        :param name: the URL name, a key of BUDGETS
+        :param url: the URL to request
+        :param user: optional, the Account to log in as
+        :param articles: the number of fixture articles the page could list
+        :return: None
+        """
+        budget = BUDGETS[name]
+        budget_queries = budget.queries + budget.per_article * articles
+
+        if user:
+            self.client.force_login(user)
+
+        cache.clear()
+        function_cache._near.clear()
+
+        with CaptureQueriesContext(connection) as cold:
+            start = time.time()
+            response = self.client.get(url)
+            ms = (time.time() - start) * 1000
+
+        self.assertEqual(response.status_code, 200, '{0} returned {1}'.format(name, response.status_code))
+
+        with CaptureQueriesContext(connection) as warm:
+            start = time.time()
+            self.client.get(url)
+            warm_ms = (time.time() - start) * 1000
+
+        RESULTS[name] = (len(cold), len(warm), budget_queries, ms, warm_ms)
+
+        self.assertLessEqual(len(cold), budget_queries, '{0} made {1} queries, its budget is {2}'.format(
+            name, len(cold), budget_queries))
+
+    def test_journal_home(self):
+        self.measure('website_index', reverse('website_index'))
+
+    def test_articles(self):
+        self.measure('journal_articles', reverse('journal_articles'), articles=len(self.articles))
+
+    def test_issue(self):
+        self.measure('journal_issue', reverse('journal_issue', kwargs={'issue_id': self.issues[0].pk}),
+                     articles=ARTICLES_PER_ISSUE)
+
+    def test_article(self):
+        self.measure('article_view', reverse('article_view', kwargs={'identifier_type': 'id',
+                                                                     'identifier': self.articles[0].pk}))
+
+    def test_search(self):
+        self.measure('search', '{0}?q=article'.format(reverse('search')), articles=len(self.articles))
+        self.assertGreater(search_backends.get_backend().count(search_documents.ARTICLE, self.journal.pk, 'article'),
+                           0, 'The fixture articles should have been indexed.')
+
+    def test_sitemap(self):
+        self.measure('journal_sitemap', reverse('journal_sitemap'), articles=len(self.articles))
+
+    def test_dashboard(self):
+        self.measure('core_dashboard', reverse('core_dashboard'), user=self.editor, articles=5)
+
+    def test_kanban(self):
+        self.measure('kanban', reverse('kanban'), user=self.editor, articles=5)
+
+    def test_api_article_list(self):
+        self.measure('article-list', reverse('article-list'), articles=len(self.articles))
+
+    def test_oai(self):
+        self.measure('OAI_list_records', reverse('OAI_list_records'), articles=len(self.articles))
@@ -0,0 +1,152 @@
+__copyright__ = "Copyright 2017 Birkbeck, University of London"
+__author__ = "Martin Paul Eve & Andy Byers"
+__license__ = "AGPL v3"
+__maintainer__ = "Birkbeck Centre for Technology and Publishing"
+
+import hashlib
+import io
+import json
+import zipfile
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory, TestCase
+from django.urls import reverse
+
+from core import files, uploads
+from submission import models as submission_models
+from utils.testing import setup
+
+
+class ChunkedUploadTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        setup.create_press()
+        cls.journal_one, cls.journal_two = setup.create_journals()
+        setup.create_roles(['author'])
+        cls.author = setup.create_author(cls.journal_one)
+        cls.regular_user = setup.create_regular_user()
+        cls.article = submission_models.Article.objects.create(owner=cls.author, title='A Test Article',
+                                                               journal=cls.journal_one)
+        cls.content = b'0123456789' * 1000
+
+    def setUp(self):
+        self.client.force_login(self.author)
+
+    def start_upload(self, checksum=None):
+        data = {'filename': 'dataset.csv', 'size': len(self.content)}
+        if checksum:
+            data['checksum'] = checksum
+
+        response = self.client.post(reverse('core_chunked_upload_start'), data)
+        self.assertEqual(response.status_code, 201)
+
+        return json.loads(response.content.decode())['upload_id']
+
+    def send_chunk(self, upload_id, offset, chunk, checksum=None):
+        url = '{0}?offset={1}'.format(reverse('core_chunked_upload', kwargs={'upload_id': upload_id}), offset)
+        return self.client.put(url, data=chunk, content_type='application/octet-stream',
+                               HTTP_X_CHUNK_CHECKSUM=checksum or hashlib.md5(chunk).hexdigest())
+
+    def test_out_of_order_chunks_assemble_into_article_file(self):
+        upload_id = self.start_upload(checksum=hashlib.md5(self.content).hexdigest())
+
+        self.assertEqual(self.send_chunk(upload_id, 4000, self.content[4000:]).status_code, 200)
+
+        status = json.loads(self.client.get(reverse('core_chunked_upload',
+                                                    kwargs={'upload_id': upload_id})).content.decode())
+        self.assertEqual(status['offset'], 0, 'Resume offset should stay at 0 until the first chunk arrives.')
+
+        self.assertEqual(self.send_chunk(upload_id, 0, self.content[:4000]).status_code, 200)
+
+        response = self.client.post(reverse('core_chunked_upload_complete', kwargs={'upload_id': upload_id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(json.loads(response.content.decode())['complete'])
+
+        upload = uploads.ChunkedUpload.get(upload_id, self.author)
+        new_file = files.save_file_to_article(upload.as_uploaded_file(), self.article, self.author)
+
+        with open(new_file.self_article_path(), 'rb') as saved_file:
+            self.assertEqual(saved_file.read(), self.content)
+        self.assertEqual(new_file.original_filename, 'dataset.csv')
+        self.assertRaises(uploads.ChunkedUploadError, uploads.ChunkedUpload.get, upload_id, self.author)
+
+        new_file.unlink_file()
+
+    def test_chunk_with_bad_checksum_is_rejected(self):
+        upload_id = self.start_upload()
+
+        response = self.send_chunk(upload_id, 0, self.content[:4000], checksum='0' * 32)
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post(reverse('core_chunked_upload_complete', kwargs={'upload_id': upload_id}))
+        self.assertEqual(response.status_code, 400)
+
+        uploads.ChunkedUpload.get(upload_id, self.author).discard()
+
+    def test_upload_is_private_to_its_owner(self):
+        upload_id = self.start_upload()
+
+        self.client.force_login(self.regular_user)
+        response = self.client.get(reverse('core_chunked_upload', kwargs={'upload_id': upload_id}))
+        self.assertEqual(response.status_code, 404)
+
+        uploads.ChunkedUpload.get(upload_id, self.author).discard()
+
+    def test_open_uploads_are_capped_per_user(self):
+        upload_ids = [self.start_upload() for _ in range(uploads.MAX_OPEN_UPLOADS)]
+
+        response = self.client.post(reverse('core_chunked_upload_start'),
+                                    {'filename': 'dataset.csv', 'size': len(self.content)})
+        self.assertEqual(response.status_code, 400)
+
+        self.client.force_login(self.regular_user)
+        response = self.client.post(reverse('core_chunked_upload_start'),
+                                    {'filename': 'dataset.csv', 'size': len(self.content)})
+        self.assertEqual(response.status_code, 201, 'Other users should not be affected by the cap.')
+
+        uploads.ChunkedUpload.get(json.loads(response.content.decode())['upload_id'], self.regular_user).discard()
+
+        for upload_id in upload_ids:
+            uploads.ChunkedUpload.get(upload_id, self.author).discard()
+
+    def test_unsaved_assembled_uploads_are_closed_with_the_request(self):
+        upload_id = self.start_upload()
+        self.send_chunk(upload_id, 0, self.content)
+        self.client.post(reverse('core_chunked_upload_complete', kwargs={'upload_id': upload_id}))
+
+        request = RequestFactory().post('/', {'file-upload-id': upload_id})
+        request.user = self.author
+
+        uploaded_file = uploads.get_uploaded_file(request, 'file')
+        self.assertFalse(uploaded_file.closed)
+
+        request.close()
+        self.assertTrue(uploaded_file.closed)
+
+        uploads.ChunkedUpload.get(upload_id, self.author).discard()
+
+
+class MimeSniffingTests(TestCase):
+
+    @staticmethod
+    def office_document():
+        # the entry that identifies a DOCX starts after the first MIME_SNIFF_BYTES of the file
+        content = io.BytesIO()
+
+        with zipfile.ZipFile(content, 'w', zipfile.ZIP_STORED) as document:
+            document.writestr('[Content_Types].xml', '<Types>{0}</Types>'.format(' ' * 5000))
+            document.writestr('_rels/.rels', '<Relationships>{0}</Relationships>'.format(' ' * 5000))
+            document.writestr('word/document.xml', '<w:document/>')
+
+        return content.getvalue()
+
+    def test_office_documents_are_not_sniffed_as_zip(self):
+        content = self.office_document()
+        self.assertGreater(content.index(b'word/document.xml'), files.MIME_SNIFF_BYTES)
+
+        upload = SimpleUploadedFile('article.docx', content)
+
+        self.assertEqual(files.check_in_memory_mime(upload),
+                         'application/vnd.openxmlformats-officedocument.wordprocessingml.document')
+        self.assertEqual(upload.read(), content)
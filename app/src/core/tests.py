@@ -4,13 +4,31 @@ __license__ = "AGPL v3"
 __maintainer__ = "Birkbeck Centre for Technology and Publishing"
 
 import datetime
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
 
+from lxml import etree
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
 from django.urls import reverse
 from django.core.management import call_command
+from django.utils import timezone
 
-from utils.tests.setup import create_user, create_journals, create_roles, create_press
-from core import models
+from utils.testing.setup import create_user, create_journals, create_roles, create_press
+from core import compression, files, instrumentation, models, renders
+from identifiers import models as identifier_models
+from journal import models as journal_models
+from submission import models as submission_models
+from utils import function_cache
 
 
 class CoreTests(TestCase):
@@ -66,3 +84,290 @@ class CoreTests(TestCase):
         self.press = create_press()
         self.press.save()
         call_command('sync_journals_to_sites')
+
+
+class ZipStreamTests(TestCase):
+
+    class ArticleFile(object):
+        # stands in for the parts of core.models.File that zip_entries_for_files reads
+        def __init__(self, path, original_filename, mime_type):
+            self.path, self.original_filename, self.mime_type = path, original_filename, mime_type
+            self.uuid_filename = os.path.basename(path)
+
+        def self_article_path(self):
+            return self.path
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.contents = {}
+
+        for name, content in (('text.xml', b'<article>text</article>' * 2000), ('figure.png', os.urandom(50000)),
+                              ('other.xml', b'<article>other</article>')):
+            self.contents[name] = content
+
+            with open(os.path.join(self.folder, name), 'wb') as content_file:
+                content_file.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_stream_holds_every_file_and_skips_missing_ones(self):
+        data = b''.join(files.zip_stream([
+            (os.path.join(self.folder, 'text.xml'), 'text.xml', 'application/xml'),
+            (os.path.join(self.folder, 'figure.png'), 'figure.png', 'image/png'),
+            (os.path.join(self.folder, 'missing.xml'), 'missing.xml', 'application/xml'),
+        ], chunk_size=1024))
+
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.namelist(), ['text.xml', 'figure.png'])
+            self.assertEqual(archive.read('text.xml'), self.contents['text.xml'])
+            self.assertEqual(archive.read('figure.png'), self.contents['figure.png'])
+            self.assertEqual(archive.getinfo('text.xml').compress_type, zipfile.ZIP_DEFLATED)
+            self.assertEqual(archive.getinfo('figure.png').compress_type, zipfile.ZIP_STORED)
+
+    def test_served_files_with_the_same_name_are_all_kept(self):
+        article_files = [self.ArticleFile(os.path.join(self.folder, name), 'article.xml', 'application/xml')
+                         for name in ('text.xml', 'other.xml')]
+
+        response = files.serve_zip_files(article_files, 'Article files.zip')
+
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="article-files.zip"')
+
+        with zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))) as archive:
+            self.assertEqual(archive.namelist(), ['article.xml', 'article-1.xml'])
+            self.assertEqual(archive.read('article.xml'), self.contents['text.xml'])
+            self.assertEqual(archive.read('article-1.xml'), self.contents['other.xml'])
+
+
+class GalleyFigureTests(TestCase):
+
+    def setUp(self):
+        create_press()
+        self.journal, _ = create_journals()
+        create_roles(['author'])
+        author = create_user('figureauthor@example.com', ['author'], journal=self.journal)
+
+        self.article = submission_models.Article.objects.create(owner=author, title='An Article With Figures',
+                                                                journal=self.journal, date_published=timezone.now(),
+                                                                stage=submission_models.STAGE_PUBLISHED)
+        issue = journal_models.Issue.objects.create(journal=self.journal, issue_title='Issue 1',
+                                                    issue_description='An issue')
+        issue.articles.add(self.article)
+        identifier_models.Identifier.objects.create(id_type='doi', identifier='10.1234/figures', article=self.article)
+
+        xml_file = models.File.objects.create(article_id=self.article.pk, mime_type='application/xml',
+                                              original_filename='article.xml', uuid_filename='article.xml',
+                                              owner=author, is_galley=True)
+        self.galley = models.Galley.objects.create(article=self.article, file=xml_file, label='XML', type='xml')
+
+        self.folder = os.path.join(settings.BASE_DIR, 'files', 'articles', str(self.article.pk))
+        self.paths = []
+        self.figure = self.add_image('figure1.png')
+
+        cache.clear()
+        function_cache._near.clear()
+
+    def tearDown(self):
+        # the article folder may hold files from elsewhere, so only the images written here are removed
+        for path in self.paths:
+            os.remove(path)
+
+    def add_image(self, name):
+        image = models.File.objects.create(article_id=self.article.pk, mime_type='image/png', original_filename=name,
+                                           uuid_filename='figure-test-{0}-{1}'.format(self.galley.pk, name),
+                                           owner=self.article.owner)
+        path = os.path.join(self.folder, image.uuid_filename)
+
+        files.mkdirs(self.folder)
+        with open(path, 'wb') as image_file:
+            image_file.write(name.encode() * 100)
+
+        self.paths.append(path)
+        self.galley.images.add(image)
+
+        return image
+
+    def figure_names(self):
+        return sorted(models.Galley.get_figure_manifest(self.galley.pk)['figures'])
+
+    def test_manifest_describes_each_image(self):
+        path = self.paths[0]
+        figure = self.galley.figure_manifest()['figures']['figure1.png']
+
+        self.assertEqual(figure['pk'], self.figure.pk)
+        self.assertEqual(figure['path'], path)
+        self.assertEqual(figure['size'], os.path.getsize(path))
+        self.assertEqual(figure['checksum'], files.checksum(path))
+
+    def test_manifest_is_reset_when_images_change(self):
+        self.assertEqual(self.figure_names(), ['figure1.png'])
+
+        second_figure = self.add_image('figure2.png')
+        self.assertEqual(self.figure_names(), ['figure1.png', 'figure2.png'])
+
+        self.galley.images.remove(self.figure)
+        self.assertEqual(self.figure_names(), ['figure2.png'])
+
+        second_figure.original_filename = 'renamed.png'
+        second_figure.save()
+        self.assertEqual(self.figure_names(), ['renamed.png'])
+
+    def test_figure_urls_are_served_from_the_manifest(self):
+        article_url = reverse('article_figure', kwargs={'article_id': self.article.pk, 'galley_id': self.galley.pk,
+                                                        'file_name': 'figure1.png'})
+        identifier_url = reverse('article_figure', kwargs={'identifier_type': 'doi', 'identifier': '10.1234/figures',
+                                                           'file_name': 'figure1.png'})
+
+        for url in (article_url, identifier_url):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, b'figure1.png' * 100)
+
+        wrong_article_url = reverse('article_figure', kwargs={'article_id': self.article.pk + 1,
+                                                              'galley_id': self.galley.pk, 'file_name': 'figure1.png'})
+        self.assertEqual(self.client.get(wrong_article_url).status_code, 404)
+
+        self.galley.images.remove(self.figure)
+        self.assertEqual(self.client.get(identifier_url).status_code, 404)
+
+
+class XsltTransformTests(TestCase):
+
+    STYLESHEET = '<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">' \
+                 '<xsl:template match="/"><p>{0}</p></xsl:template></xsl:stylesheet>'
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'article.xsl')
+        self.write_stylesheet('first')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def write_stylesheet(self, text):
+        with open(self.path, 'w') as stylesheet:
+            stylesheet.write(self.STYLESHEET.format(text))
+
+    def render(self, transform):
+        return str(transform(etree.fromstring('<article/>'))).strip()
+
+    def assert_recompiled(self, transform):
+        new_transform = files.get_xslt_transform(self.path)
+        self.assertIsNot(new_transform, transform)
+
+        return new_transform
+
+    def test_unchanged_stylesheet_is_compiled_once_per_thread(self):
+        transform = files.get_xslt_transform(self.path)
+        self.assertIs(files.get_xslt_transform(self.path), transform)
+
+        other_thread = []
+        thread = threading.Thread(target=lambda: other_thread.append(files.get_xslt_transform(self.path)))
+        thread.start()
+        thread.join()
+
+        self.assertIsNot(other_thread[0], transform)
+
+    def test_changed_stylesheet_is_recompiled(self):
+        transform = files.get_xslt_transform(self.path)
+
+        self.write_stylesheet('second version')
+        transform = self.assert_recompiled(transform)
+        self.assertIn('second version', self.render(transform))
+
+        # a change that keeps the size is still picked up from the modification time
+        stat = os.stat(self.path)
+        self.write_stylesheet('edited version')
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        transform = self.assert_recompiled(transform)
+        self.assertIn('edited version', self.render(transform))
+
+        files.clear_xslt_cache()
+        self.assert_recompiled(transform)
+
+
+class CompressionTests(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'render.html')
+
+        with open(self.path, 'wb') as render_file:
+            render_file.write('<p>Galley text, repeated é</p>'.encode('utf-8') * 5000)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_spliced_page_decodes_to_the_whole_page(self):
+        compression.precompress(self.path, fragment=True)
+        prefix, suffix = b'<html><body><p>Galley text</p>', b'</body></html>'
+
+        with open(self.path, 'rb') as render_file:
+            expected = prefix + render_file.read() + suffix
+
+        self.assertEqual(gzip.decompress(compression.splice_gzip(prefix, self.path, suffix)), expected)
+
+
+class RenderCleanupTests(TestCase):
+
+    def setUp(self):
+        self.folder, self.render_folder = tempfile.mkdtemp(), renders.RENDER_FOLDER
+        renders.RENDER_FOLDER = self.folder
+
+    def tearDown(self):
+        renders.RENDER_FOLDER = self.render_folder
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_only_stale_versions_without_a_galley_are_removed(self):
+        stale_version, recent_version = 'a' * 32 + '-' + 'f' * 32, 'b' * 32 + '-' + 'f' * 32
+        stale = time.time() - renders.STALE_VERSION_SECONDS - 60
+
+        for version in (stale_version, recent_version):
+            renders.write_atomically(renders.render_path(version), '<p>Galley</p>')
+            os.makedirs(renders.table_folder(version))
+
+        for path in (renders.render_path(stale_version), renders.table_folder(stale_version)):
+            os.utime(path, (stale, stale))
+
+        renders.clean_render_folder()
+
+        self.assertFalse(os.path.exists(renders.render_path(stale_version)))
+        self.assertFalse(os.path.exists(renders.table_folder(stale_version)))
+        self.assertTrue(os.path.exists(renders.render_path(recent_version)))
+        self.assertTrue(os.path.exists(renders.table_folder(recent_version)))
+
+
+class InstrumentationTests(TestCase):
+
+    def tearDown(self):
+        instrumentation.set_sample_rate(None)
+        instrumentation.discard()
+
+    def test_leftover_measurement_restores_connections(self):
+        instrumentation.set_sample_rate(1)
+        instrumentation._state['refreshed'] = 0
+        instrumentation.start(None)
+        self.assertTrue(connection.force_debug_cursor)
+
+        # the next request on this thread is not sampled, and must not inherit the debug cursor
+        instrumentation.set_sample_rate(0)
+        instrumentation._state['refreshed'] = 0
+        instrumentation.start(None)
+        self.assertFalse(connection.force_debug_cursor)
+
+    def test_totals_merge_and_estimate_percentiles(self):
+        totals = instrumentation.new_totals()
+        other = instrumentation.new_totals()
+        other.update(requests=20, latency_ms=1000.0, max_latency_ms=400.0, queries=100, max_queries=9)
+        other['latency_buckets'][3] = 18
+        other['latency_buckets'][5] = 2
+
+        instrumentation.merge(totals, other)
+        instrumentation.merge(totals, other)
+
+        self.assertEqual((totals['requests'], totals['queries'], totals['max_queries']), (40, 200, 9))
+        self.assertEqual(instrumentation.percentile(totals, 0.5), instrumentation.LATENCY_BUCKETS[3])
+        self.assertEqual(instrumentation.percentile(totals, 0.95), instrumentation.LATENCY_BUCKETS[5])
+        self.assertIsNone(instrumentation.percentile(instrumentation.new_totals(), 0.95))
+
@@ -0,0 +1,393 @@
+__copyright__ = "Copyright 2017 Birkbeck, University of London"
+__author__ = "Martin Paul Eve & Andy Byers"
+__license__ = "AGPL v3"
+__maintainer__ = "Birkbeck Centre for Technology and Publishing"
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+from uuid import uuid4, UUID
+
+from django.conf import settings
+from django.core.files import File as DjangoFile
+from django.http import Http404
+
+from core import files
+
+UPLOAD_FOLDER = os.path.join(settings.BASE_DIR, 'files', 'temp', 'uploads')
+MAX_UPLOAD_SIZE = 20 * 1024 * 1024 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+STALE_UPLOAD_SECONDS = 7 * 24 * 60 * 60
+# uploads are preallocated on disk when they start, so each user may only hold so many at once
+MAX_OPEN_UPLOADS = 10
+MAX_OPEN_UPLOAD_BYTES = MAX_UPLOAD_SIZE
+
+
+class ChunkedUploadError(Exception):
+    pass
+
+
+class AssembledUpload(DjangoFile):
+    """ A completed chunked upload, presented with the same interface as the UploadedFile objects found in
+    request.FILES so that it can be handed to save_file_to_article and friends.
+    """
+
+    def __init__(self, upload):
+        data_file = open(upload.data_path, 'rb')
+
+        try:
+            super(AssembledUpload, self).__init__(data_file, name=upload.filename)
+            self.upload = upload
+            self.content_type = files.guess_mime(upload.filename)
+        except Exception:
+            data_file.close()
+            raise
+
+    def temporary_file_path(self):
+        return self.upload.data_path
+
+    def move_to(self, path):
+        """ Moves the assembled file into its final location rather than copying it, then removes the upload.
+
+        :param path: the path to move the file to
+        :return: None
+        """
+        try:
+            shutil.move(self.upload.data_path, path)
+        finally:
+            self.close()
+
+        self.upload.discard()
+
+
+class ChunkedUpload(object):
+    """ A resumable upload assembled from offset-addressed chunks. Each upload lives in its own folder under
+    files/temp/uploads holding the partial data file and a JSON state file recording the byte ranges received.
+    """
+
+    def __init__(self, upload_id, state):
+        self.upload_id = upload_id
+        self.state = state
+
+    @staticmethod
+    def folder_for(upload_id):
+        return os.path.join(UPLOAD_FOLDER, str(upload_id))
+
+    @property
+    def folder(self):
+        return self.folder_for(self.upload_id)
+
+    @property
+    def data_path(self):
+        return os.path.join(self.folder, 'data')
+
+    @property
+    def state_path(self):
+        return os.path.join(self.folder, 'state.json')
+
+    @property
+    def filename(self):
+        return self.state['filename']
+
+    @property
+    def size(self):
+        return self.state['size']
+
+    @property
+    def complete(self):
+        return self.state['complete']
+
+    @classmethod
+    def create(cls, owner, filename, size, checksum=None):
+        """ Starts a new chunked upload.
+
+        :param owner: the Account uploading the file
+        :param filename: the original filename of the file being uploaded
+        :param size: the total size of the file in bytes
+        :param checksum: optional md5 hex digest of the whole file, checked on completion
+        :return: a ChunkedUpload object
+        """
+        try:
+            size = int(size)
+        except (TypeError, ValueError):
+            raise ChunkedUploadError('A file size is required.')
+
+        if not filename:
+            raise ChunkedUploadError('A filename is required.')
+
+        if size < 0 or size > MAX_UPLOAD_SIZE:
+            raise ChunkedUploadError('File size must be between 0 and {0} bytes.'.format(MAX_UPLOAD_SIZE))
+
+        files.mkdirs(UPLOAD_FOLDER)
+
+        # a lock on the uploads folder stops concurrent starts by the same user from slipping past the limits
+        with open(os.path.join(UPLOAD_FOLDER, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            open_uploads = cls.open_uploads(owner)
+
+            if len(open_uploads) >= MAX_OPEN_UPLOADS:
+                raise ChunkedUploadError('You have {0} unfinished uploads, please complete or cancel one before '
+                                         'starting another.'.format(len(open_uploads)))
+
+            if sum(upload.size for upload in open_uploads) + size > MAX_OPEN_UPLOAD_BYTES:
+                raise ChunkedUploadError('Your unfinished uploads would exceed {0} bytes, please complete or cancel '
+                                         'one before starting another.'.format(MAX_OPEN_UPLOAD_BYTES))
+
+            upload = cls(uuid4(), {
+                'owner': owner.pk,
+                'filename': os.path.basename(str(filename)),
+                'size': size,
+                'checksum': checksum.lower() if checksum else None,
+                'ranges': [],
+                'complete': False,
+                'created': time.time(),
+            })
+
+            files.mkdirs(upload.folder)
+
+            # preallocate a sparse file so that chunks can be written at any offset
+            with open(upload.data_path, 'wb') as data_file:
+                data_file.truncate(size)
+
+            upload.save()
+
+        return upload
+
+    @classmethod
+    def open_uploads(cls, owner):
+        """ Returns the owner's uploads that are still on disk, including completed uploads that have not yet been
+        moved into place.
+
+        :param owner: the Account that started the uploads
+        :return: a list of ChunkedUpload objects
+        """
+        open_uploads = []
+
+        for upload_id in os.listdir(UPLOAD_FOLDER):
+            try:
+                with open(os.path.join(cls.folder_for(upload_id), 'state.json'), 'r') as state_file:
+                    state = json.load(state_file)
+            except (IOError, ValueError):
+                continue
+
+            if state['owner'] == owner.pk:
+                open_uploads.append(cls(upload_id, state))
+
+        return open_uploads
+
+    @classmethod
+    def get(cls, upload_id, owner):
+        """ Loads an existing chunked upload, only if it belongs to the given owner.
+
+        :param upload_id: the upload's UUID
+        :param owner: the Account making the request
+        :return: a ChunkedUpload object
+        """
+        try:
+            folder = cls.folder_for(UUID(str(upload_id)))
+        except ValueError:
+            raise ChunkedUploadError('Upload not found.')
+
+        try:
+            with open(os.path.join(folder, 'state.json'), 'r') as state_file:
+                state = json.load(state_file)
+        except (FileNotFoundError, ValueError):
+            raise ChunkedUploadError('Upload not found.')
+
+        if state['owner'] != owner.pk:
+            raise ChunkedUploadError('Upload not found.')
+
+        return cls(os.path.basename(folder), state)
+
+    def save(self):
+        temp_path = '{0}.tmp'.format(self.state_path)
+
+        with open(temp_path, 'w') as state_file:
+            json.dump(self.state, state_file)
+
+        os.replace(temp_path, self.state_path)
+
+    def reload(self):
+        with open(self.state_path, 'r') as state_file:
+            self.state = json.load(state_file)
+
+    def write_chunk(self, offset, stream, length, chunk_checksum=None, chunk_size=8192):
+        """ Writes a chunk into the upload at the given offset, hashing it as it is streamed to disk.
+
+        :param offset: the byte offset of the start of the chunk
+        :param stream: a file-like object to read the chunk from
+        :param length: the length of the chunk in bytes
+        :param chunk_checksum: optional md5 hex digest of the chunk
+        :param chunk_size: the size of reads made against the stream
+        :return: None
+        """
+        if self.complete:
+            raise ChunkedUploadError('This upload has already been completed.')
+
+        offset, length = int(offset), int(length)
+
+        if offset < 0 or length <= 0 or length > MAX_CHUNK_SIZE or offset + length > self.size:
+            raise ChunkedUploadError('Chunk does not fit inside the file.')
+
+        hash_md5 = hashlib.md5()
+
+        # chunks cover disjoint byte ranges so they can be written concurrently
+        with open(self.data_path, 'r+b') as data_file:
+            data_file.seek(offset)
+            remaining = length
+
+            while remaining:
+                data = stream.read(min(chunk_size, remaining))
+                if not data:
+                    break
+                hash_md5.update(data)
+                data_file.write(data)
+                remaining -= len(data)
+
+        if remaining:
+            raise ChunkedUploadError('Chunk was shorter than its declared length.')
+
+        if chunk_checksum and hash_md5.hexdigest() != chunk_checksum.lower():
+            raise ChunkedUploadError('Chunk checksum does not match, please resend it.')
+
+        # a lock on the data file serialises updates to the state from concurrent chunks and completion
+        with open(self.data_path, 'rb') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.reload()
+
+            if self.complete:
+                raise ChunkedUploadError('This upload has already been completed.')
+
+            self.state['ranges'] = merge_ranges(self.state['ranges'] + [[offset, offset + length]])
+            self.save()
+
+    def received(self):
+        """ Returns the number of contiguous bytes received from the start of the file, which is the offset a
+        client should resume from.
+        """
+        ranges = self.state['ranges']
+
+        if ranges and ranges[0][0] == 0:
+            return ranges[0][1]
+
+        return 0
+
+    def assemble(self):
+        """ Checks that every byte has arrived and that the whole file matches its checksum, then marks the upload
+        as complete.
+
+        :return: the md5 hex digest of the assembled file
+        """
+        # held for the whole check so that concurrent completions and late chunks cannot interleave with it
+        with open(self.data_path, 'rb') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.reload()
+
+            if self.complete:
+                return self.state['checksum']
+
+            if self.received() != self.size:
+                raise ChunkedUploadError('Upload is incomplete, {0} of {1} bytes received.'.format(
+                    self.received(), self.size))
+
+            digest = files.checksum(self.data_path)
+
+            if self.state['checksum'] and digest != self.state['checksum']:
+                raise ChunkedUploadError('File checksum does not match.')
+
+            self.state['checksum'] = digest
+            self.state['complete'] = True
+            self.save()
+
+        return digest
+
+    def as_uploaded_file(self):
+        if not self.complete:
+            raise ChunkedUploadError('This upload has not been completed.')
+
+        return AssembledUpload(self)
+
+    def status(self):
+        return {
+            'upload_id': str(self.upload_id),
+            'filename': self.filename,
+            'size': self.size,
+            'offset': self.received(),
+            'ranges': self.state['ranges'],
+            'checksum': self.state['checksum'],
+            'complete': self.complete,
+        }
+
+    def discard(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def merge_ranges(ranges):
+    """ Merges a list of [start, end) byte ranges into the smallest sorted list of non-overlapping ranges.
+
+    :param ranges: a list of two item lists
+    :return: a list of two item lists
+    """
+    merged = []
+
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+
+    return merged
+
+
+def get_uploaded_files(request, field_name):
+    """ Returns the files uploaded under a field name, both those posted directly and completed chunked uploads
+    referenced by a '<field_name>-upload-id' POST value.
+
+    :param request: HttpRequest object
+    :param field_name: the name of the file field
+    :return: a list of UploadedFile and AssembledUpload objects
+    """
+    uploaded_files = request.FILES.getlist(field_name)
+    assembled_uploads = []
+
+    try:
+        for upload_id in request.POST.getlist('{0}-upload-id'.format(field_name)):
+            try:
+                assembled_uploads.append(ChunkedUpload.get(upload_id, request.user).as_uploaded_file())
+            except ChunkedUploadError:
+                raise Http404
+    finally:
+        # Django closes everything in request.FILES once the response has been sent, so assembled uploads that a
+        # view never saves, say because its form was invalid, are closed along with the posted files
+        for assembled_upload in assembled_uploads:
+            request.FILES.appendlist('{0}-assembled'.format(field_name), assembled_upload)
+
+    uploaded_files.extend(assembled_uploads)
+
+    return uploaded_files
+
+
+def get_uploaded_file(request, field_name):
+    uploaded_files = get_uploaded_files(request, field_name)
+    return uploaded_files[0] if uploaded_files else None
+
+
+def clean_stale_uploads(max_age=STALE_UPLOAD_SECONDS):
+    """ Removes chunked uploads that were abandoned before being used.
+
+    :param max_age: the age in seconds after which an upload is considered stale
+    :return: None
+    """
+    if not os.path.isdir(UPLOAD_FOLDER):
+        return
+
+    cutoff = time.time() - max_age
+
+    for upload_id in os.listdir(UPLOAD_FOLDER):
+        folder = os.path.join(UPLOAD_FOLDER, upload_id)
+
+        if os.path.isdir(folder) and os.path.getmtime(folder) < cutoff:
+            shutil.rmtree(folder, ignore_errors=True)
@@ -6,6 +6,7 @@ __maintainer__ = "Birkbeck Centre for Technology and Publishing"
 
 from importlib import import_module
 import json
+from urllib.parse import urlencode
 
 from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
@@ -22,8 +23,10 @@ from django.contrib.sessions.models import Session
 from django.core.validators import validate_email
 from django.core.exceptions import ValidationError
 from django.conf import settings as django_settings
+from django.views.decorators.http import require_POST
 
-from core import models, forms, logic, workflow
+from core import models, forms, logic, workflow, uploads, instrumentation
+from search import suggest as search_suggest
 from security.decorators import editor_user_required, article_author_required
 from submission import models as submission_models
 from review import models as review_models
@@ -32,7 +35,7 @@ from production import models as production_models
 from journal import models as journal_models
 from proofing import logic as proofing_logic
 from proofing import models as proofing_models
-from utils import models as util_models, setting_handler, orcid
+from utils import function_cache, models as util_models, setting_handler, orcid
 
 from django.db.models import Q
 
@@ -572,16 +575,50 @@ def manager_index(request):
 @staff_member_required
 def flush_cache(request):
     """
-    Flushes Django's cache
+    Invalidates the current journal's cached entries, or flushes Django's whole cache from the press
     :param request: HttpRequest object
     :return: HttpRedirect
     """
-    cache.clear()
-    messages.add_message(request, messages.SUCCESS, 'Memcached has been flushed.')
+    if request.journal:
+        function_cache.invalidate_tags(function_cache.tag('journal', request.journal),
+                                       function_cache.tag('settings', request.journal))
+        messages.add_message(request, messages.SUCCESS, 'The journal\'s cache has been flushed.')
+    else:
+        cache.clear()
+        messages.add_message(request, messages.SUCCESS, 'Memcached has been flushed.')
 
     return redirect(reverse('core_manager_index'))
 
 
+@staff_member_required
+def instrumentation_report(request):
+    """
+    Returns the sampled per view timings, query counts and cache lookups of every process as JSON, worst first.
+    ?sort= orders views by another summary value, eg. queries or template_ms.
+    :param request: HttpRequest object
+    :return: HttpResponse object
+    """
+    sort = request.GET.get('sort', 'latency_ms')
+
+    if sort not in instrumentation.SORT_KEYS:
+        sort = 'latency_ms'
+
+    try:
+        limit = min(max(int(request.GET.get('limit', 50)), 1), 500)
+        hours = min(max(int(request.GET.get('hours', 24)), 1), 24 * 7)
+    except ValueError:
+        limit, hours = 50, 24
+
+    instrumentation.flush()
+    data = {
+        'sample_rate': instrumentation.sample_rate(),
+        'sort': sort,
+        'views': instrumentation.summarise(hours=hours, sort=sort)[:limit],
+    }
+
+    return HttpResponse(json.dumps(data), content_type="application/json")
+
+
 @editor_user_required
 def settings_index(request):
     """
@@ -628,8 +665,6 @@ def edit_setting(request, setting_group, setting_name):
         setting_value.value = value
         setting_value.save()
 
-        cache.clear()
-
         return redirect(reverse('core_settings_index'))
 
     template = 'core/manager/settings/edit_setting.html'
@@ -683,7 +718,7 @@ def edit_settings_group(request, group):
                 path = django_settings.BASE_DIR + journal.default_large_image.url
                 logic.resize_and_crop(path, [750, 324], 'middle')
 
-            cache.clear()
+            function_cache.invalidate_tags(function_cache.tag('journal', journal))
 
             # Unset request.journal
             if journal_id:
@@ -740,7 +775,12 @@ def edit_plugin_settings_groups(request, plugin, setting_group_name, journal=Non
 
         if edit_form.is_valid():
             edit_form.save(plugin=plugin, journal=journal)
-            cache.clear()
+
+            # press wide plugin settings apply to every journal
+            if journal:
+                function_cache.invalidate_tags(function_cache.tag('settings', journal))
+            else:
+                cache.clear()
 
             return redirect(reverse(request.GET['return']))
 
@@ -1105,7 +1145,7 @@ def article_image_edit(request, article_pk):
             article_meta_image_form.save()
 
     if request.POST:
-        flush_cache(request)
+        function_cache.invalidate_tags(*function_cache.article_tags(article))
         return redirect(reverse('core_article_image_edit', kwargs={'article_pk': article.pk}))
 
     template = 'core/manager/images/article_image.html'
@@ -1533,8 +1573,6 @@ def edit_email_template(request, template_code, subject=False):
         template_value.value = value
         template_value.save()
 
-        cache.clear()
-
         return redirect(reverse('core_email_templates'))
 
     template = 'core/manager/email/edit_email_template.html'
@@ -1692,3 +1730,129 @@ def order_workflow_elements(request):
             element.save()
 
     return HttpResponse('Thanks')
+
+
+def chunked_upload_response(data, status=200):
+    return HttpResponse(json.dumps(data), content_type="application/json", status=status)
+
+
+@login_required
+@require_POST
+def chunked_upload_start(request):
+    """
+    Starts a resumable chunked upload, the returned upload_id is used to send chunks and, once complete, is posted
+    to an upload form as <field name>-upload-id in place of the file itself.
+    :param request: HttpRequest object
+    :return: HttpResponse object containing JSON
+    """
+    try:
+        upload = uploads.ChunkedUpload.create(request.user,
+                                              request.POST.get('filename'),
+                                              request.POST.get('size'),
+                                              checksum=request.POST.get('checksum'))
+    except uploads.ChunkedUploadError as e:
+        return chunked_upload_response({'error': str(e)}, status=400)
+
+    return chunked_upload_response(upload.status(), status=201)
+
+
+@login_required
+def chunked_upload(request, upload_id):
+    """
+    GET returns the status of an upload, including the offset to resume from. PUT or POST writes the request body
+    as a chunk at the offset given in the query string, with an optional md5 in the X-Chunk-Checksum header. DELETE
+    abandons the upload.
+    :param request: HttpRequest object
+    :param upload_id: the UUID of a chunked upload
+    :return: HttpResponse object containing JSON
+    """
+    try:
+        upload = uploads.ChunkedUpload.get(upload_id, request.user)
+    except uploads.ChunkedUploadError:
+        raise Http404
+
+    if request.method in ('PUT', 'POST'):
+        try:
+            upload.write_chunk(request.GET.get('offset', 0),
+                               request,
+                               request.META.get('CONTENT_LENGTH') or 0,
+                               chunk_checksum=request.META.get('HTTP_X_CHUNK_CHECKSUM'))
+        except (uploads.ChunkedUploadError, ValueError) as e:
+            return chunked_upload_response({'error': str(e), 'offset': upload.received()}, status=400)
+
+    elif request.method == 'DELETE':
+        upload.discard()
+        return chunked_upload_response({'upload_id': upload_id, 'deleted': True})
+
+    return chunked_upload_response(upload.status())
+
+
+@login_required
+@require_POST
+def chunked_upload_complete(request, upload_id):
+    """
+    Checks that all chunks of an upload have arrived and that the assembled file matches its checksum.
+    :param request: HttpRequest object
+    :param upload_id: the UUID of a chunked upload
+    :return: HttpResponse object containing JSON
+    """
+    try:
+        upload = uploads.ChunkedUpload.get(upload_id, request.user)
+    except uploads.ChunkedUploadError:
+        raise Http404
+
+    try:
+        upload.assemble()
+    except uploads.ChunkedUploadError as e:
+        return chunked_upload_response({'error': str(e), 'offset': upload.received()}, status=400)
+
+    return chunked_upload_response(upload.status())
+
+
+def suggest(request):
+    """
+    Returns typeahead suggestions for a search box as JSON. Article titles, keywords and author names come from the
+    current journal. Staff and editors can ask for account names and emails with ?kind=accounts, on a journal these
+    are limited to accounts with a role on it.
+    :param request: HttpRequest object
+    :return: HttpResponse object
+    """
+    prefix = request.GET.get('q', '')
+
+    try:
+        limit = min(max(int(request.GET.get('limit', 10)), 1), 50)
+    except ValueError:
+        limit = 10
+
+    if request.GET.get('kind') == 'accounts':
+        if not request.user.is_authenticated or not (
+                request.user.is_staff or (request.journal and request.user.has_an_editor_role(request))):
+            return HttpResponse(json.dumps({'error': 'Not allowed'}), content_type="application/json", status=403)
+
+        suggestions = search_suggest.suggest(search_suggest.ACCOUNTS, prefix, limit=limit,
+                                             journal_id=request.journal.pk if request.journal else None)
+    elif request.journal:
+        suggestions = search_suggest.suggest(request.journal.pk, prefix, limit=limit)
+    else:
+        suggestions = []
+
+    data = []
+    for suggestion in suggestions:
+        if suggestion.kind == 'article':
+            url = reverse('article_view', kwargs={'identifier_type': 'id', 'identifier': suggestion.object_id})
+        elif suggestion.kind == 'keyword':
+            url = '{0}?{1}'.format(reverse('search'), urlencode({'q': 'keyword:"{0}"'.format(suggestion.label)}))
+        elif suggestion.kind == 'author':
+            url = '{0}?{1}'.format(reverse('search'), urlencode({'q': 'author:"{0}"'.format(suggestion.label)}))
+        else:
+            url = None
+
+        data.append({
+            'kind': suggestion.kind,
+            'id': suggestion.object_id,
+            'label': suggestion.label,
+            'detail': suggestion.detail,
+            'url': url,
+        })
+
+    return HttpResponse(json.dumps(data), content_type="application/json")
@@ -8,7 +8,7 @@ from django.urls.resolvers import NoReverseMatch
 
 from core import models
 from submission import models as submission_models
-from utils.shared import clear_cache
+from utils import function_cache
 
 
 def workflow_element_complete(**kwargs):
@@ -43,7 +43,7 @@ def workflow_next(handshake_url, request, article, switch_stage=False):
 
     if handshake_url == 'submit_review':
         set_stage(article)
-        clear_cache()
+        function_cache.invalidate_tags(*function_cache.article_tags(article))
         return redirect(reverse('core_dashboard'))
 
     current_element = workflow.elements.get(handshake_url=handshake_url)
@@ -58,7 +58,7 @@ def workflow_next(handshake_url, request, article, switch_stage=False):
 
         if switch_stage:
             log_stage_change(article, next_element)
-            clear_cache()
+            function_cache.invalidate_tags(*function_cache.article_tags(article))
             article.stage = next_element.stage
             article.save()
 
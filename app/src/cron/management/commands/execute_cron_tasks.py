@@ -2,6 +2,9 @@ from django.core.management.base import BaseCommand
 from django.core.management import call_command
 
 from cron import models
+from core import renders, uploads
+from transform import logic as transform_logic
+from utils import background
 
 
 class Command(BaseCommand):
@@ -22,3 +25,7 @@ class Command(BaseCommand):
         call_command('send_digest_emails')
         call_command('send_reminders')
         models.CronTask.run_tasks()
+        uploads.clean_stale_uploads()
+        renders.clean_render_folder()
+        transform_logic.clean_typesetting_folder()
+        background.run_jobs()
@@ -16,7 +16,7 @@ from django.utils import timezone
 
 import sys
 from utils import models as util_models
-from utils.function_cache import cache
+from utils.function_cache import cache, tag
 
 CROSSREF_TEST_URL = 'https://api.crossref.org/deposits?test=true'
 CROSSREF_LIVE_URL = 'https://api.crossref.org/deposits'
@@ -221,7 +221,8 @@ def generate_crossref_doi_with_pattern(article):
     return identifier_models.Identifier.objects.create(**doi_options)
 
 
-@cache(600)
+@cache(600, tags=lambda article: [tag('journal', article.journal_id), tag('article', article),
+                                  tag('settings', article.journal_id)])
 def render_doi_from_pattern(article):
     from utils import setting_handler, render_template
 
@@ -12,7 +12,7 @@ from django.db.models.signals import post_save
 
 from submission import models as submission_models
 from identifiers import logic
-from utils import shared
+from utils import function_cache
 
 
 identifier_choices = (
@@ -62,4 +62,4 @@ class BrokenDOI(models.Model):
 # Signals
 @receiver(post_save, sender=Identifier)
 def reset_article_url_cache(sender, instance, created, **kwargs):
-    shared.clear_cache()
+    function_cache.invalidate_tags(*function_cache.article_tags(instance.article))
@@ -7,17 +7,16 @@ from os import listdir, makedirs
 from os.path import isfile, join
 import requests
 from dateutil import parser as dateparser
-from bs4 import BeautifulSoup
-import csv
 
 from django.contrib import messages
 from django.conf import settings
+from django.core.cache import cache
 from django.shortcuts import redirect, get_object_or_404
 from django.urls import reverse
 from django.template.loader import get_template
 from django.core.validators import validate_email, ValidationError
 
-from core import models as core_models, files
+from core import models as core_models, files, images
 from journal import models as journal_models, issue_forms
 from identifiers import models as identifier_models
 from utils import render_template, notify_helpers
@@ -93,6 +92,27 @@ def list_galleys(article, galleys):
     return ''
 
 
+def render_galley_id_key(article):
+    return 'article_render_galley_id_{0}'.format(article.pk)
+
+
+def get_render_galley_id(article):
+    """ Returns the PK of the galley used to render an article, cached so that figure requests don't have to look it
+    up for every image on the page.
+
+    :param article: an Article object
+    :return: a Galley PK or 0 if the article has no render galley
+    """
+    galley_id = cache.get(render_galley_id_key(article))
+
+    if galley_id is None:
+        galley = article.get_render_galley
+        galley_id = galley.pk if galley else 0
+        cache.set(render_galley_id_key(article), galley_id, 300)
+
+    return galley_id
+
+
 def get_doi_data(article):
     try:
         doi = identifier_models.Identifier.objects.get(id_type='doi', article=article)
@@ -200,6 +220,7 @@ def set_render_galley(request, article):
         article.fixedpubcheckitems.select_render_galley = True
         article.fixedpubcheckitems.save()
         article.save()
+        cache.delete(render_galley_id_key(article))
 
         messages.add_message(request, messages.SUCCESS, 'Render galley has been set.')
     else:
@@ -242,6 +263,7 @@ def set_article_image(request, article):
             article.fixedpubcheckitems.save()
 
         core_logic.resize_and_crop(new_file.self_article_path(), [750, 324], 'middle')
+        images.queue_file_derivatives(new_file)
 
 
 def send_contact_message(new_contact, request):
@@ -370,29 +392,3 @@ def resend_email(article, log_entry, request, form):
                 'target': article}
 
     notify_helpers.send_email_with_body_from_user(request, subject, valid_email_addresses, message, log_dict=log_dict)
-
-
-def get_table_from_html(table_name, content):
-    """
-    Uses BS4 to fetch an HTML table.
-    :param table_name: ID of the tabe eg T1
-    :param content: HTML Content that contains the table
-    :return: A table object
-    """
-
-    soup = BeautifulSoup(str(content), 'lxml')
-    table_div = soup.find("div", {'id': table_name})
-    table = table_div.find("table")
-    return table
-
-
-def parse_html_table_to_csv(table, table_name):
-    filepath = files.get_temp_file_path_from_name('{0}.csv'.format(table_name))
-    headers = [th.text for th in table.select("tr th")]
-
-    with open(filepath, "w") as f:
-        wr = csv.writer(f)
-        wr.writerow(headers)
-        wr.writerows([[td.text for td in row.find_all("td")] for row in table.select("tr + tr")])
-
-    return filepath
@@ -17,7 +17,7 @@ from django.urls import reverse
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
-from utils.function_cache import cache
+from utils.function_cache import cache, tag
 from utils import setting_handler
 from submission import models as submission_models
 from core import models as core_models, workflow
@@ -118,7 +118,7 @@ class Journal(models.Model):
         return setting_handler.get_setting(group_name, setting_name, self, create=False).processed_value
 
     @property
-    @cache(300)
+    @cache(300, tags=lambda self: [tag('journal', self), tag('settings', self)], local=True)
     def name(self):
         try:
             return setting_handler.get_setting('general', 'journal_name', self, create=False, fallback='en').value
@@ -139,12 +139,12 @@ class Journal(models.Model):
         setting_handler.save_setting('general', 'publisher_name', self, value)
 
     @property
-    @cache(120)
+    @cache(120, tags=lambda self: [tag('journal', self), tag('settings', self)])
     def issn(self):
         return setting_handler.get_setting('general', 'journal_issn', self, create=False, fallback='en').value
 
     @property
-    @cache(120)
+    @cache(120, tags=lambda self: [tag('journal', self), tag('settings', self)])
     def use_crossref(self):
         try:
             return setting_handler.get_setting('Identifiers',
@@ -227,7 +227,7 @@ class Journal(models.Model):
 
         return set(users)
 
-    @cache(300)
+    @cache(300, tags=lambda self: [tag('journal', self)])
     def editorial_groups(self):
         return core_models.EditorialGroup.objects.filter(journal=self)
 
@@ -12,6 +12,10 @@ urlpatterns = [
     url(r'^article/(?P<article_id>\d+)/galley/(?P<galley_id>\d+)/figure/(?P<file_name>.*)/$',
         views.article_figure,
         name='article_figure'),
+    url(r'^article/(?P<identifier_type>.+?)/(?P<identifier>.+)/file/(?P<file_id>\d+)/'
+        r'(?P<width>\d+)w\.(?P<image_format>webp|jpeg|png)$',
+        views.serve_article_file_derivative,
+        name='article_file_derivative'),
     url(r'^article/(?P<identifier_type>.+?)/(?P<identifier>.+)/file/(?P<file_id>\d+)/replace$',
         views.replace_article_file,
         name='article_file_replace'),
@@ -21,9 +25,18 @@ urlpatterns = [
     url(r'^article/(?P<article_id>\d+)/galley/(?P<galley_id>\d+)/download/',
         views.download_galley,
         name='article_download_galley'),
-    url(r'^article/(?P<identifier_type>.+?)/(?P<identifier>.+?/.+?)/table/(?P<table_name>.+)$',
+    url(r'^article/(?P<article_id>\d+)/galley/(?P<galley_id>\d+)/rendered/$',
+        views.rendered_galley,
+        name='article_rendered_galley'),
+    url(r'^article/(?P<identifier_type>.+?)/(?P<identifier>.+)/structure/$',
+        views.article_structure,
+        name='article_structure'),
+    url(r'^article/(?P<identifier_type>.+?)/(?P<identifier>.+)/figures-and-tables/$',
+        views.figures_and_tables,
+        name='article_figures_and_tables'),
+    url(r'^article/(?P<identifier_type>.+?)/(?P<identifier>.+)/table/(?P<table_name>[^/]+)$',
         views.download_table,
-        name='article_figure'),
+        name='article_table_csv'),
     url(r'^article/(?P<identifier_type>.+?)/(?P<identifier>.+?/.+?)/(?P<file_name>.+)$',
         views.identifier_figure,
         name='article_figure'),
@@ -33,9 +46,12 @@ urlpatterns = [
     url(r'^issues/$', views.issues, name='journal_issues'),
     url(r'^issue/current/$', views.current_issue, name='current_issue'),
     url(r'^issue/(?P<issue_id>\d+)/info/$', views.issue, name='journal_issue'),
+    url(r'^issue/(?P<issue_id>\d+)/epub/$', views.issue_epub, name='journal_issue_epub'),
     url(r'^collections/$', views.collections, name='journal_collections'),
     url(r'^collections/(?P<collection_id>\d+)/$', views.collection, name='journal_collection'),
     url(r'^cover/$', views.serve_journal_cover, name='journal_cover_download'),
+    url(r'^cover/(?P<width>\d+)w\.(?P<image_format>webp|jpeg|png)$', views.serve_journal_cover_derivative,
+        name='journal_cover_derivative'),
 
     url(r'^article/(?P<identifier_type>.+?)/(?P<identifier>.+)/edit/$', views.edit_article, name='article_edit'),
     url(r'^article/(?P<identifier_type>.+?)/(?P<identifier>.+)/print/$', views.print_article,
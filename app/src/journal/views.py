@@ -14,6 +14,7 @@ from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.staticfiles.templatetags.staticfiles import static
+from django.core.exceptions import ImproperlyConfigured
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.urls import reverse
 from django.db.models import Q
@@ -26,17 +27,19 @@ from django.views.decorators.http import require_POST
 from django.core.management import call_command
 
 from cms import models as cms_models
-from core import files, models as core_models, plugin_loader
+from core import files, images, models as core_models, plugin_loader, renders
 from journal import logic, models, issue_forms, forms
 from journal.logic import list_galleys
 from metrics.logic import store_article_access
 from review import forms as review_forms
+from search import documents as search_documents, related as search_related
 from security.decorators import article_stage_accepted_or_later_required, \
     article_stage_accepted_or_later_or_staff_required, article_exists, file_user_required, has_request, has_journal, \
     file_history_user_required, file_edit_user_required, production_user_or_editor_required, \
     editor_user_required
 from submission import models as submission_models
-from utils import models as utils_models, shared
+from transform import epub
+from utils import function_cache, models as utils_models, shared
 from events import logic as event_logic
 
 
@@ -94,6 +97,27 @@ def serve_journal_cover(request):
     return response
 
 
+@has_journal
+def serve_journal_cover_derivative(request, width, image_format):
+    """ Serves a resized copy of the journal's cover image, falling back to the original while it is generated.
+
+    :param request: the request associated with this call
+    :param width: the width of the derivative requested
+    :param image_format: the format of the derivative requested eg. webp
+    :return: a response containing the image
+    """
+    thumbnail = request.journal.thumbnail_image if request.journal else None
+
+    if thumbnail:
+        derivative = images.find_derivative(thumbnail.journal_path(request.journal), width, image_format,
+                                            source_mime=thumbnail.mime_type)
+
+        if derivative:
+            return images.serve_derivative(derivative, image_format)
+
+    return serve_journal_cover(request)
+
+
 @has_journal
 def articles(request):
     """ Renders the list of articles in the journal.
@@ -191,6 +215,23 @@ def issue(request, issue_id, show_sidebar=True):
     return render(request, template, context)
 
 
+@has_journal
+def issue_epub(request, issue_id):
+    """ Serves an EPUB bundling the published articles of an issue.
+
+    :param request: the request associated with this call
+    :param issue_id: the ID of the issue
+    :return: a StreamingHttpResponse of the EPUB
+    """
+    issue_object = get_object_or_404(models.Issue, pk=issue_id, journal=request.journal)
+    path = epub.get_issue_epub(issue_object)
+
+    if not path:
+        raise Http404
+
+    return files.serve_temp_file(path, '{0}.epub'.format(issue_object.display_title), unlink=False)
+
+
 @has_journal
 def collections(request):
     """
@@ -269,16 +310,26 @@ def article(request, identifier_type, identifier):
     if article_object.is_published:
         store_article_access(request, article_object, 'view')
 
+    # large XML renders are sent from their stored gzip encoding rather than compressed again for every view
+    stored_render = renders.stored_render_path(request, article_object.render_galley) if content else None
+
     template = 'journal/article.html'
     context = {
         'article': article_object,
         'galleys': galleys,
         'identifier_type': identifier_type,
         'identifier': identifier,
-        'article_content': content,
+        'article_content': renders.CONTENT_MARKER if stored_render else content,
+        'article_structure': renders.get_article_structure(article_object) if content else None,
+        'related_articles': search_related.get_related_articles(article_object),
     }
 
-    return render(request, template, context)
+    response = render(request, template, context)
+
+    if stored_render:
+        renders.splice_rendered_galley(response, stored_render)
+
+    return response
 
 
 @article_exists
@@ -359,6 +410,24 @@ def download_galley(request, article_id, galley_id):
     return files.serve_file(request, galley.file, article, public=True)
 
 
+def rendered_galley(request, article_id, galley_id):
+    """ Serves the rendered HTML of an XML galley on its own, for embedding.
+
+    :param request: an HttpRequest object
+    :param article_id: an Article object PK
+    :param galley_id: an Galley object PK
+    :return: a streaming response of the rendered galley or a 404.
+    """
+    article = get_object_or_404(submission_models.Article.allarticles, pk=article_id,
+                                stage=submission_models.STAGE_PUBLISHED)
+    galley = get_object_or_404(core_models.Galley, pk=galley_id, article=article)
+
+    if not renders.is_xml_galley(galley):
+        raise Http404
+
+    return renders.serve_rendered_galley(request, galley)
+
+
 @has_request
 @article_stage_accepted_or_later_or_staff_required
 @article_exists
@@ -391,6 +460,33 @@ def serve_article_file(request, identifier_type, identifier, file_id):
         return redirect(static('common/img/default_carousel/carousel1.png'))
 
 
+@has_request
+@article_stage_accepted_or_later_or_staff_required
+@article_exists
+@file_user_required
+def serve_article_file_derivative(request, identifier_type, identifier, file_id, width, image_format):
+    """ Serves a resized copy of an article image, falling back to the original while it is generated.
+
+    :param request: the request associated with this call
+    :param identifier_type: the identifier type for the article
+    :param identifier: the identifier for the article
+    :param file_id: the file ID to serve
+    :param width: the width of the derivative requested
+    :param image_format: the format of the derivative requested eg. webp
+    :return: a response containing the image or 404
+    """
+    article_object = submission_models.Article.get_article(request.journal, identifier_type, identifier)
+    file_object = get_object_or_404(core_models.File, pk=file_id, article_id=article_object.pk)
+
+    derivative = images.find_derivative(file_object.self_article_path(), width, image_format,
+                                        source_mime=file_object.mime_type)
+
+    if derivative:
+        return images.serve_derivative(derivative, image_format)
+
+    return files.serve_file(request, file_object, article_object)
+
+
 @login_required
 @article_exists
 @file_edit_user_required
@@ -582,14 +678,22 @@ def identifier_figure(request, identifier_type, identifier, file_name):
     """
     figure_article = submission_models.Article.get_article(request.journal, identifier_type, identifier)
 
-    if figure_article:
-        galley = figure_article.get_render_galley
-        figure = get_object_or_404(galley.images, original_filename=file_name)
+    if not figure_article:
+        raise Http404
 
-        return files.serve_file(request, figure, figure_article)
-    else:
+    galley_id = logic.get_render_galley_id(figure_article)
+
+    if not galley_id:
         raise Http404
 
+    manifest = core_models.Galley.get_figure_manifest(galley_id)
+    figure = core_models.Galley.figure_from_manifest(manifest, file_name)
+
+    if not figure:
+        raise Http404
+
+    return images.serve_file_or_derivative(request, figure, manifest['figures'][file_name]['path'])
+
 
 def article_figure(request, article_id, galley_id, file_name):
     """ Returns a galley article figure
@@ -600,11 +704,20 @@ def article_figure(request, article_id, galley_id, file_name):
     :param file_name: an File object name
     :return: a streaming file response or a 404 if not found
     """
-    figure_article = get_object_or_404(submission_models.Article, pk=article_id)
-    galley = get_object_or_404(core_models.Galley, pk=galley_id, article=figure_article)
-    figure = get_object_or_404(galley.images, original_filename=file_name)
+    try:
+        manifest = core_models.Galley.get_figure_manifest(galley_id)
+    except core_models.Galley.DoesNotExist:
+        raise Http404
+
+    if manifest['article_id'] != int(article_id) or manifest['is_preprint']:
+        raise Http404
+
+    figure = core_models.Galley.figure_from_manifest(manifest, file_name)
 
-    return files.serve_file(request, figure, figure_article)
+    if not figure:
+        raise Http404
+
+    return images.serve_file_or_derivative(request, figure, manifest['figures'][file_name]['path'])
 
 
 @production_user_or_editor_required
@@ -677,7 +790,7 @@ def publish_article(request, article_id):
 
         if 'image' in request.POST or 'delete_image' in request.POST:
             logic.set_article_image(request, article)
-            shared.clear_cache()
+            function_cache.invalidate_tags(*function_cache.article_tags(article))
             return redirect("{0}{1}".format(reverse('publish_article', kwargs={'article_id': article.pk}),
                                             "?m=article_image"))
 
@@ -690,6 +803,10 @@ def publish_article(request, article_id):
                 article.date_published = timezone.now()
 
             article.save()
+            function_cache.invalidate_tags(*function_cache.article_tags(article))
+            renders.queue_article_renders(article)
+            epub.queue_article_epubs(article)
+            search_related.queue_related_update(article)
 
             # Attempt to register xref DOI
             for identifier in article.identifier_set.all():
@@ -1240,37 +1357,43 @@ def sitemap(request):
 
 def search(request):
     """
-    Allows a user to search for articles by name or author name.
+    Allows a user to search for articles by title, abstract, keywords, author name or full text. Results are ranked
+    by the search index, phrases can be quoted and fields searched with eg. author:smith.
     :param request: HttpRequest object
     :return: HttpResponse object
     """
     articles = []
-    search_term = None
 
     if request.POST:
         search_term = request.POST.get('search')
         request.session['article_search'] = search_term
         return redirect(reverse('search'))
 
-    if request.session.get('article_search'):
-        search_term = request.session.get('article_search')
+    if request.GET.get('q'):
+        # links to a search, eg. from typeahead suggestions, page through their results like a submitted search
+        request.session['article_search'] = request.GET.get('q')
 
-        article_search = submission_models.Article.objects.filter(
-            (Q(title__icontains=search_term) |
-             Q(subtitle__icontains=search_term)) &
-            Q(journal=request.journal)
-        )
-        article_search = [article for article in article_search]
+    search_term = request.session.get('article_search')
 
-        author_search = search_term.split(' ')
-        from_author = submission_models.FrozenAuthor.objects.filter(
-            (Q(first_name__in=author_search) |
-             Q(last_name__in=author_search)) &
-            Q(article__journal=request.journal)
-        )
+    if search_term:
+        results = search_documents.search_articles(request.journal, search_term)
 
-        articles_from_author = [author.article for author in from_author]
-        articles = set(article_search + articles_from_author)
+        try:
+            results.count()
+        except ImproperlyConfigured as e:
+            # the search backend cannot run here, eg. SQLite built without FTS5, so fall back to a database search
+            print('Search backend unavailable, using a database search: {0}'.format(e))
+            results = search_documents.match_articles(request.journal, search_term)
+
+        paginator = Paginator(results, 10)
+        page = request.GET.get('page', 1)
+
+        try:
+            articles = paginator.page(page)
+        except PageNotAnInteger:
+            articles = paginator.page(1)
+        except EmptyPage:
+            articles = paginator.page(paginator.num_pages)
 
     template = 'journal/search.html'
     context = {
@@ -1406,7 +1529,7 @@ def download_journal_file(request, file_id):
 
 def download_table(request, identifier_type, identifier, table_name):
     """
-    For an JATS xml document, renders it into HTML and pulls a CSV from there.
+    For an JATS xml document, serves the CSV of a table precomputed when the galley was rendered.
     :param request: HttpRequest
     :param identifier_type: Article Identifier type eg. id or doi
     :param identifier: Article Identifier eg. 123 or 10.1167/1234
@@ -1414,13 +1537,70 @@ def download_table(request, identifier_type, identifier, table_name):
     :return: StreamingHTTPResponse with CSV attached
     """
     article = submission_models.Article.get_article(request.journal, identifier_type, identifier)
+    galley = article.get_render_galley if article else None
+
+    if galley and renders.is_xml_galley(galley):
+        csv_path = renders.get_table_csv_path(galley, table_name)
+
+        if csv_path:
+            return files.serve_temp_file(csv_path, '{0}.csv'.format(table_name), unlink=False, request=request)
+
+    raise Http404
+
+
+def article_structure(request, identifier_type, identifier):
+    """
+    Returns the sections, reference count, word count and reading time of an article as JSON.
+    :param request: HttpRequest
+    :param identifier_type: Article Identifier type eg. id or doi
+    :param identifier: Article Identifier eg. 123 or 10.1167/1234
+    :return: HttpResponse with JSON content
+    """
+    article = submission_models.Article.get_article(request.journal, identifier_type, identifier)
+
+    if not article or article.stage != submission_models.STAGE_PUBLISHED:
+        raise Http404
+
+    structure = renders.get_article_structure(article)
+
+    if structure is None:
+        raise Http404
+
+    return HttpResponse(json.dumps(dict(structure, article=article.pk)), content_type="application/json")
+
+
+def figures_and_tables(request, identifier_type, identifier):
+    """
+    Returns the figures and tables of an article's render galley as JSON.
+    :param request: HttpRequest
+    :param identifier_type: Article Identifier type eg. id or doi
+    :param identifier: Article Identifier eg. 123 or 10.1167/1234
+    :return: HttpResponse with JSON content
+    """
+    article = submission_models.Article.get_article(request.journal, identifier_type, identifier)
+
+    if not article or article.stage != submission_models.STAGE_PUBLISHED:
+        raise Http404
+
     galley = article.get_render_galley
+    index = {'tables': [], 'figures': []}
+
+    if galley and renders.is_xml_galley(galley):
+        index = renders.get_galley_index(galley)
+
+    for table in index['tables']:
+        table['csv'] = reverse('article_table_csv', kwargs={'identifier_type': identifier_type,
+                                                            'identifier': identifier,
+                                                            'table_name': table['id']})
+
+    data = {
+        'article': article.pk,
+        'galley': galley.pk if galley else None,
+        'tables': index['tables'],
+        'figures': index['figures'],
+    }
 
-    if galley.file.mime_type.endswith('/xml'):
-        content = galley.file_content()
-        table = logic.get_table_from_html(table_name, content)
-        csv = logic.parse_html_table_to_csv(table, table_name)
-        return files.serve_temp_file(csv, '{0}.csv'.format(table_name))
+    return HttpResponse(json.dumps(data), content_type="application/json")
 
 
 def download_supp_file(request, article_id, supp_file_id):
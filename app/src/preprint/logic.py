@@ -7,9 +7,9 @@ from django.contrib import messages
 
 from metrics import models as metrics_models
 from production.logic import save_galley
-from core import models as core_models, files
+from core import models as core_models, files, uploads
 from utils import render_template
-from utils.function_cache import cache
+from utils.function_cache import cache, tag
 from events import logic as event_logic
 from preprint import models
 from submission import models as submission_models
@@ -75,15 +75,15 @@ def metrics_summary(published_preprints):
 
 def handle_file_upload(request, preprint):
     if 'xml' in request.POST:
-        for uploaded_file in request.FILES.getlist('xml-file'):
+        for uploaded_file in uploads.get_uploaded_files(request, 'xml-file'):
             new_galley = save_galley(preprint, request, uploaded_file, True, "XML", False)
 
     if 'pdf' in request.POST:
-        for uploaded_file in request.FILES.getlist('pdf-file'):
+        for uploaded_file in uploads.get_uploaded_files(request, 'pdf-file'):
             new_galley = save_galley(preprint, request, uploaded_file, True, "PDF", False)
 
     if 'other' in request.POST:
-        for uploaded_file in request.FILES.getlist('other-file'):
+        for uploaded_file in uploads.get_uploaded_files(request, 'other-file'):
             new_galley = save_galley(preprint, request, uploaded_file, True, "Other", True)
 
 
@@ -164,7 +164,7 @@ def comment_manager_post(request, preprint):
 
 
 def handle_author_post(request, preprint):
-    file = request.FILES.get('file')
+    file = uploads.get_uploaded_file(request, 'file')
     update_type = request.POST.get('upload_type')
     galley_id = request.POST.get('galley_id')
     galley = get_object_or_404(core_models.Galley, article=preprint, pk=galley_id)
@@ -371,7 +371,7 @@ def save_preprint_submit_form(request, form, article, additional_fields):
     return article
 
 
-@cache(300)
+@cache(300, tags=[tag('preprint_subjects')])
 def list_articles_without_subjects():
     articles = submission_models.Article.preprints.filter(date_submitted__isnull=False)
 
@@ -5,8 +5,12 @@ __maintainer__ = "Birkbeck Centre for Technology and Publishing"
 
 
 from django.db import models
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
 from django.utils import timezone
 
+from search import documents as search_documents
+
 
 class Preprint(models.Model):
     article = models.ForeignKey('submission.Article')
@@ -82,3 +86,16 @@ class VersionQueue(models.Model):
             return True
         elif self.date_decision:
             return False
+
+
+@receiver(m2m_changed, sender=Subject.preprints.through)
+def index_subject_preprints(sender, instance, action, reverse, pk_set, **kwargs):
+    # clears are handled before they happen, while we can still see which preprints are affected
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    if reverse:
+        search_documents.queue_article_index(instance.pk)
+    else:
+        for article_id in pk_set or instance.preprints.values_list('pk', flat=True):
+            search_documents.queue_article_index(article_id)
@@ -3,9 +3,6 @@ __author__ = "Martin Paul Eve & Andy Byers"
 __license__ = "AGPL v3"
 __maintainer__ = "Birkbeck Centre for Technology and Publishing"
 
-import operator
-from functools import reduce
-
 from django.shortcuts import render, redirect, get_object_or_404, HttpResponse
 from django.utils import timezone
 from django.db.models import Q
@@ -14,13 +11,13 @@ from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.contrib.auth.decorators import login_required
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import messages
-from django.core.cache import cache
 
 from preprint import forms, logic as preprint_logic, models
+from search import documents as search_documents
 from submission import models as submission_models, forms as submission_forms, logic
-from core import models as core_models, files
+from core import models as core_models, files, uploads
 from metrics.logic import store_article_access
-from utils import shared as utils_shared
+from utils import function_cache, shared as utils_shared
 from events import logic as event_logic
 from identifiers import logic as ident_logic
 from security.decorators import preprint_editor_or_author_required, is_article_preprint_editor, is_preprint_editor
@@ -146,48 +143,50 @@ def preprints_list(request, subject_slug=None):
 
 def preprints_search(request, search_term=None):
     """
-    Searches through preprints based on their titles and authors
+    Searches through published preprints by title, abstract, keywords, subject, author name, affiliation and full
+    text. Results can be filtered by subject with ?subject=<pk>.
     :param request: HttpRequest
     :param search_term: Optional string
     :return: HttpResponse
     """
-    if search_term:
-        split_search_term = search_term.split(' ')
-
-        article_search = submission_models.Article.preprints.filter(
-            (Q(title__icontains=search_term) |
-             Q(subtitle__icontains=search_term) |
-             Q(keywords__word__in=split_search_term)),
-            stage=submission_models.STAGE_PREPRINT_PUBLISHED, date_published__lte=timezone.now()
-        )
-        article_search = [article for article in article_search]
-
-        institution_query = reduce(operator.and_, (Q(institution__icontains=x) for x in split_search_term))
-
-        from_author = core_models.Account.objects.filter(
-            (Q(first_name__in=split_search_term) |
-             Q(last_name__in=split_search_term) |
-             institution_query)
-        )
-
-        articles_from_author = [article for article in submission_models.Article.preprints.filter(
-            authors__in=from_author,
-            stage=submission_models.STAGE_PREPRINT_PUBLISHED,
-            date_published__lte=timezone.now())]
+    if request.POST:
+        search_term = request.POST.get('search_term')
+        return redirect(reverse('preprints_search_with_term', kwargs={'search_term': search_term}))
 
-        articles = set(article_search + articles_from_author)
+    subject, subject_facets = None, []
 
+    if search_term:
+        subject_id = request.GET.get('subject', '')
+        if subject_id.isdigit():
+            subject = get_object_or_404(models.Subject, pk=subject_id, enabled=True)
+
+        articles = search_documents.search_preprints(search_term, subject=subject)
+        counts = dict(articles.facet_counts('subject'))
+        subject_facets = [(facet_subject, counts[str(facet_subject.pk)])
+                          for facet_subject in models.Subject.objects.filter(pk__in=counts.keys(), enabled=True)]
+        subject_facets.sort(key=lambda facet: facet[1], reverse=True)
     else:
-        articles = submission_models.Article.preprints.all()
+        articles = submission_models.Article.preprints.filter(
+            stage=submission_models.STAGE_PREPRINT_PUBLISHED,
+            date_published__lte=timezone.now(),
+        ).order_by('-date_published', 'pk')
 
-    if request.POST:
-        search_term = request.POST.get('search_term')
-        return redirect(reverse('preprints_search_with_term', kwargs={'search_term': search_term}))
+    paginator = Paginator(articles, 15)
+    page = request.GET.get('page', 1)
+
+    try:
+        articles = paginator.page(page)
+    except PageNotAnInteger:
+        articles = paginator.page(1)
+    except EmptyPage:
+        articles = paginator.page(paginator.num_pages)
 
     template = 'preprints/list.html'
     context = {
         'search_term': search_term,
         'articles': articles,
+        'subject': subject,
+        'subject_facets': subject_facets,
     }
 
     return render(request, template, context)
@@ -417,10 +416,11 @@ def preprints_files(request, article_id):
         messages.add_message(request, messages.WARNING, 'File deleted')
         return redirect(reverse('preprints_files', kwargs={'article_id': article_id}))
 
-    if request.POST and request.FILES:
+    uploaded_file = uploads.get_uploaded_file(request, 'file') if request.POST else None
+
+    if request.POST and uploaded_file:
 
         form = submission_forms.FileDetails(request.POST)
-        uploaded_file = request.FILES.get('file')
 
         # If required, check if the file is a PDF:
         if request.press.preprint_pdf_only and 'manuscript' in request.POST:
@@ -560,7 +560,7 @@ def preprints_manager_article(request, article_id):
                                                                          doi_suffix=doi,
                                                                          suffix_is_whole_doi=True)
                     ident_logic.register_preprint_doi(request, crossref_enabled, doi_obj)
-                    cache.clear()
+                    function_cache.invalidate_tags(*function_cache.article_tags(preprint))
 
                 return redirect(reverse('preprints_notification', kwargs={'article_id': preprint.pk}))
 
@@ -686,14 +686,14 @@ def preprints_subjects(request, subject_id=None):
     if request.POST:
 
         if 'delete' in request.POST:
-            utils_shared.clear_cache()
+            function_cache.invalidate_tags(function_cache.tag('preprint_subjects'))
             return preprint_logic.handle_delete_subject(request)
 
         form = forms.SubjectForm(request.POST, instance=subject)
 
         if form.is_valid():
             form.save()
-            utils_shared.clear_cache()
+            function_cache.invalidate_tags(function_cache.tag('preprint_subjects'))
             return redirect(reverse('preprints_subjects'))
 
     template = 'admin/preprints/subjects.html'
@@ -14,7 +14,7 @@ from django.core.files.storage import FileSystemStorage
 from django.core.validators import MinValueValidator
 
 from core import models as core_models
-from utils.function_cache import cache
+from utils.function_cache import cache, tag
 
 
 fs = FileSystemStorage(location=settings.MEDIA_ROOT)
@@ -246,7 +246,7 @@ class Press(models.Model):
         except PressSetting.DoesNotExist:
             return ''
 
-    @cache(600)
+    @cache(600, tags=[tag('preprint_subjects')])
     def preprint_editors(self):
         from preprint import models as pp_models
         editors = list()
@@ -8,7 +8,7 @@ from django.contrib import messages
 from django.urls import reverse
 
 from production import models
-from core import files, models as core_models
+from core import files, images, models as core_models
 from copyediting import models as copyediting_models
 from utils import render_template
 
@@ -116,6 +116,7 @@ def save_galley_image(galley, request, uploaded_file, label="Galley Image", fixe
     new_file.save()
 
     galley.images.add(new_file)
+    images.queue_file_derivatives(new_file)
 
     return new_file
 
@@ -14,7 +14,7 @@ from django.views.decorators.http import require_POST
 from django.template.loader import render_to_string
 
 from events import logic as event_logic
-from core import models as core_models
+from core import models as core_models, uploads
 from cron import models as cron_task
 from production import logic, models, forms
 from security.decorators import editor_user_required, production_user_or_editor_required, \
@@ -156,24 +156,24 @@ def production_article(request, article_id):
     if request.POST:
 
         if 'xml' in request.POST:
-            for uploaded_file in request.FILES.getlist('xml-file'):
+            for uploaded_file in uploads.get_uploaded_files(request, 'xml-file'):
                 logic.save_galley(article, request, uploaded_file, True, "XML", False)
 
         if 'pdf' in request.POST:
-            for uploaded_file in request.FILES.getlist('pdf-file'):
+            for uploaded_file in uploads.get_uploaded_files(request, 'pdf-file'):
                 logic.save_galley(article, request, uploaded_file, True, "PDF", False)
 
         if 'other' in request.POST:
-            for uploaded_file in request.FILES.getlist('other-file'):
+            for uploaded_file in uploads.get_uploaded_files(request, 'other-file'):
                 logic.save_galley(article, request, uploaded_file, True, "Other", True)
 
         if 'prod' in request.POST:
-            for uploaded_file in request.FILES.getlist('prod-file'):
+            for uploaded_file in uploads.get_uploaded_files(request, 'prod-file'):
                 logic.save_prod_file(article, request, uploaded_file, 'Production Ready File')
 
         if 'supp' in request.POST:
             label = request.POST.get('label', 'Supplementary File')
-            for uploaded_file in request.FILES.getlist('supp-file'):
+            for uploaded_file in uploads.get_uploaded_files(request, 'supp-file'):
                 logic.save_supp_file(article, request, uploaded_file, label)
 
         return redirect(reverse('production_article', kwargs={'article_id': article.pk}))
@@ -387,15 +387,15 @@ def do_typeset_task(request, typeset_id):
 
         new_galley = None
         if 'xml' in request.POST:
-            for uploaded_file in request.FILES.getlist('xml-file'):
+            for uploaded_file in uploads.get_uploaded_files(request, 'xml-file'):
                 new_galley = logic.save_galley(article, request, uploaded_file, True, "XML", False)
 
         if 'pdf' in request.POST:
-            for uploaded_file in request.FILES.getlist('pdf-file'):
+            for uploaded_file in uploads.get_uploaded_files(request, 'pdf-file'):
                 new_galley = logic.save_galley(article, request, uploaded_file, True, "PDF", False)
 
         if 'other' in request.POST:
-            for uploaded_file in request.FILES.getlist('other-file'):
+            for uploaded_file in uploads.get_uploaded_files(request, 'other-file'):
                 new_galley = logic.save_galley(article, request, uploaded_file, True, "Other", True)
 
         if new_galley:
@@ -466,15 +466,15 @@ def edit_galley(request, galley_id, typeset_id=None, article_id=None):
         if 'fixed-image-upload' in request.POST:
             if request.POST.get('datafile') is not None:
                 logic.use_data_file_as_galley_image(galley, request, label)
-            for uploaded_file in request.FILES.getlist('image'):
+            for uploaded_file in uploads.get_uploaded_files(request, 'image'):
                 logic.save_galley_image(galley, request, uploaded_file, label, fixed=True)
 
         if 'image-upload' in request.POST:
-            for uploaded_file in request.FILES.getlist('image'):
+            for uploaded_file in uploads.get_uploaded_files(request, 'image'):
                 logic.save_galley_image(galley, request, uploaded_file, label, fixed=False)
 
         elif 'css-upload' in request.POST:
-            for uploaded_file in request.FILES.getlist('css'):
+            for uploaded_file in uploads.get_uploaded_files(request, 'css'):
                 logic.save_galley_css(galley, request, uploaded_file, 'galley-{0}.css'.format(galley.id), label)
 
         if 'galley-label' in request.POST:
@@ -482,7 +482,7 @@ def edit_galley(request, galley_id, typeset_id=None, article_id=None):
             galley.save()
 
         if 'replace-galley' in request.POST:
-            logic.replace_galley_file(article, request, galley, request.FILES.get('galley'))
+            logic.replace_galley_file(article, request, galley, uploads.get_uploaded_file(request, 'galley'))
 
         if typeset_task:
             return redirect(reverse('edit_galley', kwargs={'typeset_id': typeset_id, 'galley_id': galley_id}))
@@ -0,0 +1,338 @@
+__copyright__ = "Copyright 2017 Birkbeck, University of London"
+__author__ = "Martin Paul Eve & Andy Byers"
+__license__ = "AGPL v3"
+__maintainer__ = "Birkbeck Centre for Technology and Publishing"
+
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from core import files
+from search import query as search_query
+
+# the backend used by get_backend(), settings.SEARCH_BACKEND can name any subclass of SearchBackend instead
+SEARCH_BACKEND = getattr(settings, 'SEARCH_BACKEND', 'search.backends.SQLiteFTSBackend')
+
+# the fields of an indexed document, and how much a match in each counts towards a document's rank
+FIELD_WEIGHTS = (
+    ('title', 10.0),
+    ('subtitle', 5.0),
+    ('abstract', 3.0),
+    ('keywords', 6.0),
+    ('subjects', 4.0),
+    ('authors', 6.0),
+    ('affiliations', 2.0),
+    ('body', 1.0),
+)
+FIELDS = tuple(field for field, weight in FIELD_WEIGHTS)
+
+Hit = namedtuple('Hit', ['object_id', 'score'])
+
+
+class SearchBackend(object):
+    """ Stores documents and ranks them against queries. A document is a dictionary of:
+
+        doc_type: the kind of object, eg. 'article'
+        object_id: the pk of the object
+        scope: the pk of the journal the object belongs to, or None for the preprint repository. Results are always
+            limited to one scope
+        published: a timestamp, the document is left out of results until then, or None
+        fields: a dictionary of text for some or all of FIELDS
+        facets: optional, a dictionary of facet names to lists of values that results can be filtered and counted by
+    """
+
+    def index(self, documents):
+        raise NotImplementedError
+
+    def remove(self, doc_type, object_ids):
+        raise NotImplementedError
+
+    def clear(self, doc_type=None, scope=None):
+        raise NotImplementedError
+
+    def search(self, doc_type, scope, query, offset=0, limit=10, facets=None):
+        """ Ranks the documents of a scope against a query.
+
+        :param doc_type: the kind of document to search
+        :param scope: the scope to search in
+        :param query: the query string typed by the user
+        :param offset: the number of results to skip
+        :param limit: the number of results to return
+        :param facets: optional, a dictionary of facet names to the value results must have
+        :return: a list of Hit tuples, best first
+        """
+        raise NotImplementedError
+
+    def count(self, doc_type, scope, query, facets=None):
+        raise NotImplementedError
+
+    def facet_counts(self, doc_type, scope, query, name, facets=None):
+        """ Counts the documents matching a query for each value of a facet.
+
+        :param doc_type: the kind of document to search
+        :param scope: the scope to search in
+        :param query: the query string typed by the user
+        :param name: the facet to count
+        :param facets: optional, facet values the documents counted must have
+        :return: a list of (value, count) tuples, largest count first
+        """
+        raise NotImplementedError
+
+
+class SQLiteFTSBackend(SearchBackend):
+    """ Keeps the index in an SQLite database using its FTS5 extension and ranks results by BM25, so that search needs
+    no external service. Each process and thread uses its own connection, SQLite handles the locking between them.
+    """
+
+    path = os.path.join(settings.BASE_DIR, 'files', 'search', 'index.sqlite3')
+
+    # bump this when the tables change, the index is then recreated empty and must be rebuilt
+    schema_version = 2
+
+    def __init__(self, path=None):
+        self.path = path or self.path
+        self._local = threading.local()
+
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+
+        if connection is None or self._local.pid != os.getpid():
+            files.mkdirs(os.path.dirname(self.path))
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self.create_tables(connection)
+            self._local.connection, self._local.pid = connection, os.getpid()
+
+        return connection
+
+    def create_tables(self, connection):
+        version = connection.execute('PRAGMA user_version').fetchone()[0]
+
+        if version == self.schema_version:
+            return
+
+        with connection:
+            connection.execute('DROP TABLE IF EXISTS document_text')
+            connection.execute('DROP TABLE IF EXISTS document_facets')
+            connection.execute('DROP TABLE IF EXISTS documents')
+            connection.execute(
+                'CREATE TABLE documents (id INTEGER PRIMARY KEY, doc_type TEXT NOT NULL, object_id INTEGER NOT NULL, '
+                'scope INTEGER, published REAL, UNIQUE (doc_type, object_id))'
+            )
+            connection.execute('CREATE INDEX documents_scope ON documents (doc_type, scope, published)')
+            connection.execute('CREATE TABLE document_facets (document_id INTEGER NOT NULL, name TEXT NOT NULL, '
+                               'value TEXT NOT NULL, PRIMARY KEY (name, value, document_id)) WITHOUT ROWID')
+            connection.execute('CREATE INDEX document_facets_document ON document_facets (document_id)')
+
+            try:
+                connection.execute(
+                    'CREATE VIRTUAL TABLE document_text USING fts5({0}, '
+                    'tokenize="unicode61 remove_diacritics 2")'.format(', '.join(FIELDS))
+                )
+            except sqlite3.OperationalError:
+                raise ImproperlyConfigured('The SQLite library used by Python was built without FTS5, choose '
+                                           'another search backend.')
+
+            connection.execute('PRAGMA user_version = {0}'.format(int(self.schema_version)))
+
+    def index(self, documents):
+        connection = self.connection()
+
+        with connection:
+            for document in documents:
+                self._delete(connection, document['doc_type'], document['object_id'])
+                cursor = connection.execute(
+                    'INSERT INTO documents (doc_type, object_id, scope, published) VALUES (?, ?, ?, ?)',
+                    (document['doc_type'], document['object_id'], document.get('scope'), document.get('published'))
+                )
+                connection.execute(
+                    'INSERT INTO document_text (rowid, {0}) VALUES (?, {1})'.format(
+                        ', '.join(FIELDS), ', '.join('?' for field in FIELDS)),
+                    [cursor.lastrowid] + [document['fields'].get(field) or '' for field in FIELDS]
+                )
+                connection.executemany(
+                    'INSERT OR IGNORE INTO document_facets (document_id, name, value) VALUES (?, ?, ?)',
+                    [(cursor.lastrowid, name, str(value))
+                     for name, values in document.get('facets', {}).items() for value in values]
+                )
+
+    @staticmethod
+    def _delete(connection, doc_type, object_id):
+        row = connection.execute('SELECT id FROM documents WHERE doc_type = ? AND object_id = ?',
+                                 (doc_type, object_id)).fetchone()
+
+        if row:
+            connection.execute('DELETE FROM document_text WHERE rowid = ?', row)
+            connection.execute('DELETE FROM document_facets WHERE document_id = ?', row)
+            connection.execute('DELETE FROM documents WHERE id = ?', row)
+
+    def remove(self, doc_type, object_ids):
+        connection = self.connection()
+
+        with connection:
+            for object_id in object_ids:
+                self._delete(connection, doc_type, object_id)
+
+    def clear(self, doc_type=None, scope=None):
+        connection = self.connection()
+        conditions, parameters = ['1'], []
+
+        if doc_type:
+            conditions.append('doc_type = ?')
+            parameters.append(doc_type)
+
+        if scope is not None:
+            conditions.append('scope IS ?')
+            parameters.append(scope)
+
+        where = ' AND '.join(conditions)
+
+        with connection:
+            connection.execute('DELETE FROM document_text WHERE rowid IN (SELECT id FROM documents WHERE {0})'.format(
+                where), parameters)
+            connection.execute('DELETE FROM document_facets WHERE document_id IN '
+                               '(SELECT id FROM documents WHERE {0})'.format(where), parameters)
+            connection.execute('DELETE FROM documents WHERE {0}'.format(where), parameters)
+
+    @staticmethod
+    def _where(doc_type, scope, query, facets):
+        """ Builds the conditions shared by searches, counts and facet counts.
+
+        :return: a tuple of the WHERE clause and its parameters, or None if the query can match nothing
+        """
+        match = search_query.to_fts(search_query.parse(query), FIELDS)
+
+        if match is None:
+            return None
+
+        conditions = [
+            'document_text MATCH ?',
+            'documents.doc_type = ?',
+            'documents.scope IS ?',
+            '(documents.published IS NULL OR documents.published <= ?)',
+        ]
+        parameters = [match, doc_type, scope, time.time()]
+
+        for name, value in sorted((facets or {}).items()):
+            conditions.append('documents.id IN (SELECT document_id FROM document_facets WHERE name = ? AND value = ?)')
+            parameters += [name, str(value)]
+
+        return ' AND '.join(conditions), parameters
+
+    def search(self, doc_type, scope, query, offset=0, limit=10, facets=None):
+        where = self._where(doc_type, scope, query, facets)
+
+        if where is None:
+            return []
+
+        # CROSS JOIN stops SQLite from scanning documents and running the full-text match once per row, and equal
+        # ranks are ordered by object so that pages neither repeat nor skip results
+        rows = self.connection().execute(
+            'SELECT documents.object_id, bm25(document_text, {0}) AS rank '
+            'FROM document_text CROSS JOIN documents ON documents.id = document_text.rowid '
+            'WHERE {1} ORDER BY rank, documents.object_id LIMIT ? OFFSET ?'.format(
+                ', '.join(str(weight) for field, weight in FIELD_WEIGHTS), where[0]),
+            where[1] + [limit, offset]
+        )
+
+        # bm25() is lower for better matches, flip it so that scores read naturally
+        return [Hit(object_id, -rank) for object_id, rank in rows]
+
+    def count(self, doc_type, scope, query, facets=None):
+        where = self._where(doc_type, scope, query, facets)
+
+        if where is None:
+            return 0
+
+        return self.connection().execute(
+            'SELECT count(*) FROM document_text CROSS JOIN documents ON documents.id = document_text.rowid '
+            'WHERE {0}'.format(where[0]),
+            where[1]
+        ).fetchone()[0]
+
+    def facet_counts(self, doc_type, scope, query, name, facets=None):
+        where = self._where(doc_type, scope, query, facets)
+
+        if where is None:
+            return []
+
+        return self.connection().execute(
+            'SELECT document_facets.value, count(*) AS total '
+            'FROM document_text CROSS JOIN documents ON documents.id = document_text.rowid '
+            'JOIN document_facets ON document_facets.document_id = documents.id AND document_facets.name = ? '
+            'WHERE {0} GROUP BY document_facets.value ORDER BY total DESC, document_facets.value'.format(where[0]),
+            [name] + where[1]
+        ).fetchall()
+
+
+_backend = []
+
+
+def get_backend():
+    """ Returns the configured search backend, one instance is shared by the process.
+
+    :return: a SearchBackend
+    """
+    if not _backend:
+        _backend.append(import_string(SEARCH_BACKEND)())
+
+    return _backend[0]
+
+
+class SearchResults(object):
+    """ A lazy, sliceable sequence of search results that can be handed to a Paginator, only the page being shown is
+    fetched from the backend.
+    """
+
+    def __init__(self, doc_type, scope, query, facets=None, backend=None):
+        self.doc_type = doc_type
+        self.scope = scope
+        self.query = query
+        self.facets = facets
+        self.backend = backend or get_backend()
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = self.backend.count(self.doc_type, self.scope, self.query, facets=self.facets)
+
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def fetch(self, hits):
+        """ Turns a page of hits into the objects to display, subclasses return model instances.
+
+        :param hits: a list of Hit tuples
+        :return: a list
+        """
+        return hits
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop = item.start or 0, item.stop if item.stop is not None else self.count()
+            return self.fetch(self.backend.search(self.doc_type, self.scope, self.query, offset=start,
+                                                  limit=max(stop - start, 0), facets=self.facets))
+
+        results = self[item:item + 1]
+
+        if not results:
+            raise IndexError(item)
+
+        return results[0]
+
+    def facet_counts(self, name):
+        """ Counts these results by each value of a facet, ignoring any filter already applied on that facet.
+
+        :param name: the facet to count
+        :return: a list of (value, count) tuples
+        """
+        facets = {key: value for key, value in (self.facets or {}).items() if key != name}
+        return self.backend.facet_counts(self.doc_type, self.scope, self.query, name, facets=facets)
@@ -0,0 +1,183 @@
+__copyright__ = "Copyright 2017 Birkbeck, University of London"
+__author__ = "Martin Paul Eve & Andy Byers"
+__license__ = "AGPL v3"
+__maintainer__ = "Birkbeck Centre for Technology and Publishing"
+
+import threading
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils.html import strip_tags
+
+from search import backends, extraction
+from utils import background
+
+ARTICLE = 'article'
+PREPRINT = 'preprint'
+
+# articles waiting to be indexed, drained by a single background job
+_pending = set()
+_pending_lock = threading.Lock()
+_draining = [False]
+
+
+def article_document(article):
+    """ Builds the search document for a published journal article or preprint. Preprints are searched across the
+    whole repository and can be filtered by subject.
+
+    :param article: an Article object
+    :return: a document dictionary, see backends.SearchBackend
+    """
+    authors = list(article.frozen_authors()) or list(article.authors.all())
+    subjects = list(article.subject_set.all()) if article.is_preprint else []
+
+    return {
+        'doc_type': PREPRINT if article.is_preprint else ARTICLE,
+        'object_id': article.pk,
+        'scope': None if article.is_preprint else article.journal_id,
+        'published': article.date_published.timestamp() if article.date_published else None,
+        'fields': {
+            'title': article.title,
+            'subtitle': article.subtitle,
+            'abstract': strip_tags(article.abstract or ''),
+            'keywords': ' '.join(keyword.word for keyword in article.keywords.all()),
+            'subjects': ' '.join(subject.name for subject in subjects),
+            'authors': ' '.join(author.full_name() for author in authors),
+            'affiliations': ' '.join(author.affiliation() or '' for author in authors),
+            'body': extraction.get_article_text(article),
+        },
+        'facets': {
+            'subject': [subject.pk for subject in subjects if subject.enabled],
+        },
+    }
+
+
+def is_indexable(article):
+    from submission import models
+
+    if article.is_preprint:
+        return article.stage == models.STAGE_PREPRINT_PUBLISHED and article.date_published
+
+    return article.stage == models.STAGE_PUBLISHED and article.date_published
+
+
+def index_articles(article_ids):
+    """ Indexes published articles and preprints and removes any others from the index.
+
+    :param article_ids: a list of Article pks
+    :return: None
+    """
+    from submission import models
+
+    articles = models.Article.allarticles.filter(pk__in=article_ids).select_related(
+        'journal', 'render_galley__file').prefetch_related('subject_set', 'keywords', 'galley_set__file')
+    documents = [article_document(article) for article in articles if is_indexable(article)]
+    indexed = {(document['doc_type'], document['object_id']) for document in documents}
+
+    backend = backends.get_backend()
+    backend.index(documents)
+
+    for doc_type in (ARTICLE, PREPRINT):
+        backend.remove(doc_type, [article_id for article_id in article_ids if (doc_type, article_id) not in indexed])
+
+
+def drain_index_queue():
+    try:
+        while True:
+            with _pending_lock:
+                if not _pending:
+                    return
+
+                article_ids = list(_pending)
+                _pending.clear()
+
+            try:
+                index_articles(article_ids)
+            except Exception as e:
+                print('Unable to index articles {0}: {1}'.format(article_ids, e))
+            else:
+                for article_id in article_ids:
+                    background.forget_job('search', ('article', article_id))
+    finally:
+        with _pending_lock:
+            _draining[0] = False
+            restart = bool(_pending)
+
+        if restart:
+            start_draining()
+
+
+def start_draining():
+    with _pending_lock:
+        if _draining[0] or not _pending:
+            return
+
+        _draining[0] = True
+
+    background.submit('search', drain_index_queue)
+
+
+def queue_article_index(article_id):
+    """ Queues an article to be indexed, or removed from the index, once the current transaction has committed.
+    Changes made while the article is being indexed queue it again rather than being lost, and each queued article
+    is recorded until it has been indexed so that background.run_jobs() can index it if this process goes away.
+
+    :param article_id: the pk of an Article
+    :return: None
+    """
+    def queue():
+        background.record_job('search', ('article', article_id), index_articles, [article_id])
+
+        with _pending_lock:
+            _pending.add(article_id)
+
+        start_draining()
+
+    transaction.on_commit(queue)
+
+
+class ArticleResults(backends.SearchResults):
+
+    def fetch(self, hits):
+        from submission import models
+
+        articles = models.Article.allarticles.in_bulk([hit.object_id for hit in hits])
+        return [articles[hit.object_id] for hit in hits if hit.object_id in articles]
+
+
+def search_articles(journal, query):
+    """ Searches a journal's published articles, best matches first.
+
+    :param journal: a Journal object
+    :param query: the query string typed by the user
+    :return: an ArticleResults sequence, suitable for a Paginator
+    """
+    return ArticleResults(ARTICLE, journal.pk, query)
+
+
+def match_articles(journal, query):
+    """ Finds a journal's published articles by title, subtitle or author name with the database alone, for when the
+    search backend is unavailable. Results are not ranked.
+
+    :param journal: a Journal object
+    :param query: the query string typed by the user
+    :return: a QuerySet of Articles, newest first
+    """
+    from submission import models
+
+    words = query.split()
+    matches = Q(title__icontains=query) | Q(subtitle__icontains=query)
+    matches |= Q(frozenauthor__first_name__in=words) | Q(frozenauthor__last_name__in=words)
+
+    return models.Article.objects.filter(matches, journal=journal, stage=models.STAGE_PUBLISHED).distinct().order_by(
+        '-date_published', 'pk')
+
+
+def search_preprints(query, subject=None):
+    """ Searches the repository's published preprints, best matches first.
+
+    :param query: the query string typed by the user
+    :param subject: optional, a Subject object to limit results to
+    :return: an ArticleResults sequence, suitable for a Paginator
+    """
+    return ArticleResults(PREPRINT, None, query, facets={'subject': subject.pk} if subject else None)
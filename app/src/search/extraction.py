@@ -0,0 +1,311 @@
+__copyright__ = "Copyright 2017 Birkbeck, University of London"
+__author__ = "Martin Paul Eve & Andy Byers"
+__license__ = "AGPL v3"
+__maintainer__ = "Birkbeck Centre for Technology and Publishing"
+
+import gzip
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+import unicodedata
+import zlib
+
+from lxml import html as lxml_html
+
+from django.conf import settings
+from django.db import transaction
+
+from core import files, renders
+from utils import background
+
+TEXT_FOLDER = os.path.join(settings.BASE_DIR, 'files', 'text')
+HTML_MIMETYPES = ('text/html',)
+PDF_MIMETYPES = ('application/pdf',)
+# poppler's pdftotext, if it isn't installed PDF galleys are skipped
+PDF_EXTRACTOR = 'pdftotext'
+PDF_TIMEOUT = 120
+# bump this when normalisation changes so that stored text is extracted again
+TEXT_FORMAT = 1
+
+WHITESPACE = re.compile(r'\s+')
+TOKEN = re.compile(r'\w+')
+
+
+def is_extractable(galley):
+    mime_type = galley.file.mime_type
+    return mime_type in renders.XML_MIMETYPES or mime_type in HTML_MIMETYPES or mime_type in PDF_MIMETYPES
+
+
+def text_version(galley):
+    """ Identifies the version of a galley's text, XML galleys change when either their XML or XSLT changes and other
+    galleys when their file does.
+
+    :param galley: a Galley object
+    :return: a string, or None if the galley's file is missing or can't be extracted
+    """
+    if not is_extractable(galley):
+        return None
+
+    if renders.is_xml_galley(galley):
+        version = renders.render_version(galley)
+    else:
+        try:
+            version = files.cached_checksum(galley.file.get_file_path(galley.article))
+        except FileNotFoundError:
+            version = None
+
+    return '{0}-{1}'.format(TEXT_FORMAT, version) if version else None
+
+
+def text_path(galley, version):
+    return os.path.join(TEXT_FOLDER, str(galley.pk), '{0}.txt.gz'.format(version))
+
+
+def normalise(text):
+    """ Folds compatibility characters, eg. ligatures from PDFs, and collapses whitespace.
+
+    :param text: a string
+    :return: a string
+    """
+    return WHITESPACE.sub(' ', unicodedata.normalize('NFKC', text or '')).strip()
+
+
+def tokenize(text):
+    """ Splits normalised text into lower case word tokens, dropping single characters.
+
+    :param text: a string
+    :return: a list of strings
+    """
+    return [token for token in TOKEN.findall(text.lower()) if len(token) > 1]
+
+
+def shingles(tokens, size=5):
+    """ Fingerprints text as the set of hashes of each run of consecutive tokens, for spotting near duplicates.
+
+    :param tokens: a list of tokens from tokenize()
+    :param size: the number of tokens in each run
+    :return: a set of integers
+    """
+    return {zlib.crc32(' '.join(tokens[index:index + size]).encode('utf-8'))
+            for index in range(max(len(tokens) - size + 1, 1))} if tokens else set()
+
+
+def resemblance(first, second):
+    """ The proportion of shingles two texts share, 1.0 for identical texts.
+
+    :param first: a set from shingles()
+    :param second: a set from shingles()
+    :return: a float between 0 and 1
+    """
+    if not first or not second:
+        return 0.0
+
+    return len(first & second) / len(first | second)
+
+
+def html_text(html):
+    if not html:
+        return ''
+
+    document = lxml_html.document_fromstring(html)
+
+    for element in document.xpath('//script|//style'):
+        element.drop_tree()
+
+    return document.text_content()
+
+
+def pdf_text(path):
+    """ Extracts the text of a PDF with a local extractor.
+
+    :param path: the path to the PDF
+    :return: a string, or None if the extractor isn't installed or fails
+    """
+    try:
+        result = subprocess.run([PDF_EXTRACTOR, '-q', '-enc', 'UTF-8', path, '-'], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, timeout=PDF_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+
+    if result.returncode != 0:
+        return None
+
+    return result.stdout.decode('utf-8', errors='replace')
+
+
+def extract_text(galley):
+    """ Pulls the plain text out of a galley, XML galleys through the render pipeline.
+
+    :param galley: a Galley object
+    :return: a string, or None if no text could be extracted
+    """
+    mime_type = galley.file.mime_type
+
+    if mime_type in renders.XML_MIMETYPES:
+        return html_text(renders.get_rendered_galley(galley))
+
+    path = galley.file.get_file_path(galley.article)
+
+    if mime_type in HTML_MIMETYPES:
+        with open(path, 'r', encoding='utf-8', errors='replace') as html_file:
+            return html_text(html_file.read())
+
+    if mime_type in PDF_MIMETYPES:
+        return pdf_text(path)
+
+
+def store_galley_text(galley, version=None):
+    """ Extracts, normalises and stores a compressed copy of a galley's text, removing any earlier version.
+
+    :param galley: a Galley object
+    :param version: the galley's text version, if already known
+    :return: the normalised text, or None if there was none
+    """
+    version = version or text_version(galley)
+
+    if version is None:
+        return None
+
+    text = extract_text(galley)
+
+    if text is None:
+        return None
+
+    text = normalise(text)
+    path = text_path(galley, version)
+    folder = os.path.dirname(path)
+    files.mkdirs(folder)
+
+    handle, temp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    with os.fdopen(handle, 'wb') as raw_file, gzip.open(raw_file, 'wt', encoding='utf-8') as text_file:
+        text_file.write(text)
+    os.replace(temp_path, path)
+
+    for name in os.listdir(folder):
+        if name != os.path.basename(path) and not name.endswith('.tmp'):
+            files.unlink_temp_file(os.path.join(folder, name))
+
+    return text
+
+
+def get_galley_text(galley, extract=True):
+    """ Returns the stored text of a galley's current version.
+
+    :param galley: a Galley object
+    :param extract: extract the text now if it hasn't been stored yet
+    :return: a string, or None if the galley has no text
+    """
+    version = text_version(galley)
+
+    if version is None:
+        return None
+
+    try:
+        with gzip.open(text_path(galley, version), 'rt', encoding='utf-8') as text_file:
+            return text_file.read()
+    except FileNotFoundError:
+        return store_galley_text(galley, version) if extract else None
+
+
+def get_galley_tokens(galley, extract=True):
+    text = get_galley_text(galley, extract=extract)
+    return tokenize(text) if text else []
+
+
+def text_galleys(article):
+    """ Lists the galleys an article's text can be taken from, best first: its render galley, then XML, HTML and
+    finally PDF galleys.
+
+    :param article: an Article object
+    :return: a list of Galley objects
+    """
+    # sorted here rather than with order_by so that galleys prefetched with their files are used
+    preference = {mime_type: rank for rank, mime_types in enumerate(
+        (renders.XML_MIMETYPES, HTML_MIMETYPES, PDF_MIMETYPES)) for mime_type in mime_types}
+
+    galleys = sorted((galley for galley in article.galley_set.all() if galley.file.mime_type in preference),
+                     key=lambda galley: (preference[galley.file.mime_type], galley.sequence))
+
+    if article.render_galley and is_extractable(article.render_galley):
+        galleys.insert(0, article.render_galley)
+
+    return galleys
+
+
+def get_article_text(article, extract=True):
+    """ Returns the text of an article's body from the best galley that has any.
+
+    :param article: an Article object
+    :param extract: extract text that hasn't been stored yet
+    :return: a string, empty if none of the article's galleys has text
+    """
+    for galley in text_galleys(article):
+        try:
+            text = get_galley_text(galley, extract=extract)
+        except (IOError, ValueError):
+            continue
+
+        if text:
+            return text
+
+    return ''
+
+
+def extract_galley(galley_id, force=False):
+    """ Extracts and stores a galley's text unless this version is already stored. Used by the background queue and
+    by bulk extraction, where each call may run in a worker process.
+
+    :param galley_id: the pk of a Galley
+    :param force: extract even if the current version is already stored
+    :return: a tuple of galley pk, seconds taken, whether text was extracted and an error message or None
+    """
+    from core import models
+
+    start = time.time()
+
+    try:
+        galley = models.Galley.objects.select_related('file', 'article').get(pk=galley_id)
+        version = text_version(galley)
+
+        if version is None:
+            return galley_id, time.time() - start, False, 'The galley file is missing or is not XML, HTML or PDF.'
+
+        if not force and os.path.isfile(text_path(galley, version)):
+            return galley_id, time.time() - start, False, None
+
+        if store_galley_text(galley, version) is None:
+            return galley_id, time.time() - start, False, 'No text could be extracted.'
+    except Exception as e:
+        return galley_id, time.time() - start, False, '{0}: {1}'.format(type(e).__name__, e)
+
+    return galley_id, time.time() - start, True, None
+
+
+def queue_galley_extraction(galley):
+    """ Queues background extraction of a galley's text once the current transaction has committed, the article is
+    then re-indexed with it.
+
+    :param galley: a Galley object
+    :return: None
+    """
+    if not galley.file_id or not is_extractable(galley):
+        return
+
+    transaction.on_commit(
+        lambda: background.submit_once('text', ('galley', galley.pk), extract_and_index, galley.pk,
+                                       galley.article_id, durable=True)
+    )
+
+
+def extract_and_index(galley_id, article_id):
+    from search import documents
+
+    extract_galley(galley_id)
+    documents.queue_article_index(article_id)
+
+
+def remove_galley_text(galley_id):
+    shutil.rmtree(os.path.join(TEXT_FOLDER, str(galley_id)), ignore_errors=True)
@@ -0,0 +1,94 @@
+__copyright__ = "Copyright 2017 Birkbeck, University of London"
+__author__ = "Martin Paul Eve & Andy Byers"
+__license__ = "AGPL v3"
+__maintainer__ = "Birkbeck Centre for Technology and Publishing"
+
+import re
+from collections import namedtuple
+
+# the names users may put before a colon, eg. author:eve or title:"open access", and the field each searches
+FIELD_ALIASES = {
+    'title': 'title',
+    'subtitle': 'subtitle',
+    'abstract': 'abstract',
+    'keyword': 'keywords',
+    'keywords': 'keywords',
+    'subject': 'subjects',
+    'subjects': 'subjects',
+    'author': 'authors',
+    'authors': 'authors',
+    'affiliation': 'affiliations',
+    'institution': 'affiliations',
+    'text': 'body',
+    'body': 'body',
+}
+
+TOKEN = re.compile(r'(?P<negate>-)?(?:(?P<field>[A-Za-z]+):)?(?:"(?P<phrase>[^"]*)"?|(?P<word>[^\s"]+))')
+WORD_CHARACTER = re.compile(r'\w')
+
+Term = namedtuple('Term', ['text', 'field', 'phrase', 'negate'])
+
+
+def parse(query):
+    """ Splits a search box query into terms. Quoted text is a phrase, a known field name and a colon restrict a term
+    to that field and a leading minus excludes documents matching the term. Terms without any letters or digits are
+    dropped.
+
+    :param query: the string typed by the user
+    :return: a list of Term tuples
+    """
+    terms = []
+
+    for match in TOKEN.finditer(query or ''):
+        field = match.group('field')
+        text = match.group('phrase') if match.group('phrase') is not None else match.group('word')
+
+        if field and field.lower() not in FIELD_ALIASES:
+            # not a field we know, eg. a time or a url, search for it as typed
+            text, field = '{0}:{1}'.format(field, text), None
+
+        if not text or not WORD_CHARACTER.search(text):
+            continue
+
+        terms.append(Term(
+            text=text,
+            field=FIELD_ALIASES[field.lower()] if field else None,
+            phrase=match.group('phrase') is not None,
+            negate=bool(match.group('negate')),
+        ))
+
+    return terms
+
+
+def quote(text):
+    return '"{0}"'.format(text.replace('"', ' '))
+
+
+def to_fts(terms, fields):
+    """ Builds an SQLite FTS5 match expression requiring every term. All text is quoted so that nothing the user
+    types is read as FTS syntax.
+
+    :param terms: a list of Term tuples
+    :param fields: the fields the index has, terms for any other field search every field
+    :return: a string, or None if there is nothing positive to search for
+    """
+    required, excluded = [], []
+
+    for term in terms:
+        expression = quote(term.text)
+
+        if term.field in fields:
+            expression = '{0} : {1}'.format(term.field, expression)
+
+        (excluded if term.negate else required).append(expression)
+
+    if not required:
+        # FTS5 cannot match on exclusions alone
+        return None
+
+    expression = '({0})'.format(' AND '.join(required))
+
+    for exclusion in excluded:
+        expression = '{0} NOT {1}'.format(expression, exclusion)
+
+    return expression
@@ -0,0 +1,316 @@
+__copyright__ = "Copyright 2017 Birkbeck, University of London"
+__author__ = "Martin Paul Eve & Andy Byers"
+__license__ = "AGPL v3"
+__maintainer__ = "Birkbeck Centre for Technology and Publishing"
+
+import heapq
+import json
+import math
+import os
+import tempfile
+import threading
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.html import strip_tags
+
+from core import files
+from search import extraction
+from utils import background
+
+RELATED_FOLDER = os.path.join(settings.BASE_DIR, 'files', 'related')
+RELATED_COUNT = 10
+# how much a token counts towards an article's vector depending on where it appears
+FIELD_WEIGHTS = (
+    ('keywords', 3.0),
+    ('title', 2.0),
+    ('abstract', 1.0),
+    ('text', 1.0),
+)
+# the number of tokens of body text used, long texts add little beyond this
+TEXT_TOKENS = 5000
+# each vector keeps only its heaviest terms, which bounds the cost of comparing articles
+VECTOR_TERMS = 100
+# terms in more than this proportion of a journal's articles say nothing about how articles differ
+MAX_DOCUMENT_FREQUENCY = 0.5
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def related_path(journal_id):
+    return os.path.join(RELATED_FOLDER, '{0}.json'.format(journal_id))
+
+
+def vectors_path(journal_id):
+    return os.path.join(RELATED_FOLDER, '{0}-vectors.json'.format(journal_id))
+
+
+def article_terms(article):
+    """ Counts the weighted terms of an article's keywords, title, abstract and extracted text.
+
+    :param article: an Article object
+    :return: a Counter of term to weighted count
+    """
+    texts = {
+        'keywords': ' '.join(keyword.word for keyword in article.keywords.all()),
+        'title': article.title,
+        'abstract': strip_tags(article.abstract or ''),
+        'text': extraction.get_article_text(article, extract=False),
+    }
+    terms = Counter()
+
+    for field, weight in FIELD_WEIGHTS:
+        tokens = extraction.tokenize(texts[field] or '')
+
+        if field == 'text':
+            tokens = tokens[:TEXT_TOKENS]
+
+        for token in tokens:
+            if not token.isdigit():
+                terms[token] += weight
+
+    return terms
+
+
+def tfidf_vector(terms, document_frequency, total):
+    """ Turns an article's term counts into a sparse, unit length TF-IDF vector.
+
+    :param terms: a Counter of term to weighted count, from article_terms()
+    :param document_frequency: a dictionary of term to the number of articles it appears in
+    :param total: the number of articles
+    :return: a dictionary of term to weight, empty if no term distinguishes the article
+    """
+    weights = []
+
+    for term, count in terms.items():
+        frequency = document_frequency.get(term, 0)
+
+        if 1 < frequency <= MAX_DOCUMENT_FREQUENCY * total:
+            weights.append((term, (1 + math.log(count)) * (math.log((1 + total) / (1 + frequency)) + 1)))
+
+    weights = heapq.nlargest(VECTOR_TERMS, weights, key=lambda weight: weight[1])
+    norm = math.sqrt(sum(weight * weight for term, weight in weights))
+
+    return {term: round(weight / norm, 4) for term, weight in weights} if norm else {}
+
+
+def tfidf_vectors(term_counts):
+    """ Turns term counts into sparse, unit length TF-IDF vectors.
+
+    :param term_counts: a dictionary of article pk to Counter of terms
+    :return: a tuple of a dictionary of article pk to a dictionary of term to weight, and the document frequencies
+    """
+    total = len(term_counts)
+    document_frequency = Counter()
+
+    for terms in term_counts.values():
+        document_frequency.update(terms.keys())
+
+    vectors = {}
+    for article_id, terms in term_counts.items():
+        vector = tfidf_vector(terms, document_frequency, total)
+
+        if vector:
+            vectors[article_id] = vector
+
+    return vectors, document_frequency
+
+
+def nearest_neighbours(vectors, article_ids, count=RELATED_COUNT):
+    """ Finds the articles with the most similar vectors to each of the given articles. Each article is scored against
+    an inverted index of every vector, the sparse equivalent of multiplying its row by the whole matrix, so only
+    articles sharing a term with it are ever looked at.
+
+    :param vectors: a dictionary of article pk to vector, from tfidf_vectors()
+    :param article_ids: the articles to find neighbours for
+    :param count: the number of neighbours to keep
+    :return: a dictionary of article pk to a list of (neighbour pk, cosine similarity), most similar first
+    """
+    postings = defaultdict(list)
+    for article_id, vector in vectors.items():
+        for term, weight in vector.items():
+            postings[term].append((article_id, weight))
+
+    article_ids = [article_id for article_id in article_ids if article_id in vectors]
+    neighbours = {}
+
+    for article_id in article_ids:
+        scores = defaultdict(float)
+
+        for term, weight in vectors[article_id].items():
+            for other_id, other_weight in postings[term]:
+                scores[other_id] += weight * other_weight
+
+        scores.pop(article_id, None)
+        neighbours[article_id] = [(other_id, round(score, 4)) for other_id, score in
+                                  heapq.nlargest(count, scores.items(), key=lambda score: score[1])]
+
+    return neighbours
+
+
+def published_articles(journal_id):
+    from submission import models
+
+    return models.Article.objects.filter(journal_id=journal_id, stage=models.STAGE_PUBLISHED,
+                                         date_published__lte=timezone.now())
+
+
+def read_related(journal_id):
+    """ Loads a journal's stored related articles, kept in memory until the file changes.
+
+    :param journal_id: the pk of a Journal
+    :return: a dictionary of article pk to a list of (neighbour pk, score)
+    """
+    path = related_path(journal_id)
+
+    try:
+        modified = os.path.getmtime(path)
+    except OSError:
+        return {}
+
+    cached = _cache.get(journal_id)
+    if cached and cached[0] == modified:
+        return cached[1]
+
+    with open(path, 'r') as related_file:
+        related = {int(article_id): [tuple(neighbour) for neighbour in neighbours]
+                   for article_id, neighbours in json.load(related_file).items()}
+
+    _cache[journal_id] = (modified, related)
+    return related
+
+
+def write_json(path, content):
+    files.mkdirs(RELATED_FOLDER)
+    handle, temp_path = tempfile.mkstemp(dir=RELATED_FOLDER, suffix='.tmp')
+
+    with os.fdopen(handle, 'w') as json_file:
+        json.dump(content, json_file)
+    os.replace(temp_path, path)
+
+
+def write_related(journal_id, related):
+    write_json(related_path(journal_id), {str(article_id): neighbours for article_id, neighbours in related.items()})
+
+
+def read_vectors(journal_id):
+    """ Loads the vectors and document frequencies stored by the last build of a journal's related articles.
+
+    :param journal_id: the pk of a Journal
+    :return: a tuple of a dictionary of article pk to vector, the document frequencies and the number of articles
+    they were counted from, or None if nothing is stored
+    """
+    try:
+        with open(vectors_path(journal_id), 'r') as vectors_file:
+            stored = json.load(vectors_file)
+    except (IOError, ValueError):
+        return None
+
+    vectors = {int(article_id): vector for article_id, vector in stored['vectors'].items()}
+    return vectors, Counter(stored['document_frequency']), stored['total']
+
+
+def write_vectors(journal_id, vectors, document_frequency, total):
+    write_json(vectors_path(journal_id), {
+        'vectors': {str(article_id): vector for article_id, vector in vectors.items()},
+        'document_frequency': document_frequency,
+        'total': total,
+    })
+
+
+def build_related(journal_id, article_ids=None):
+    """ Computes related articles for a journal and stores them along with the vectors they were computed from.
+    When only some articles are given, for example ones that have just been published, only their terms are counted.
+    They are scored against the stored vectors and offered to the articles already stored where they score higher
+    than those articles' current neighbours. The stored vectors keep the weights they were given when they were
+    built, a full build refreshes them.
+
+    :param journal_id: the pk of a Journal
+    :param article_ids: optional, a list of Article pks to update
+    :return: the number of articles whose related articles were computed
+    """
+    articles = published_articles(journal_id).prefetch_related('keywords', 'galley_set__file').select_related(
+        'render_galley__file')
+
+    with _lock:
+        stored = read_vectors(journal_id) if article_ids is not None else None
+
+        if stored is None:
+            vectors, document_frequency = tfidf_vectors({article.pk: article_terms(article) for article in articles})
+            total = len(articles)
+            related = nearest_neighbours(vectors, list(vectors.keys()))
+            write_vectors(journal_id, vectors, document_frequency, total)
+            write_related(journal_id, related)
+
+            return len(vectors)
+
+        vectors, document_frequency, total = stored
+        published = set(published_articles(journal_id).values_list('pk', flat=True))
+        vectors = {article_id: vector for article_id, vector in vectors.items() if article_id in published}
+        term_counts = {article.pk: article_terms(article) for article in articles.filter(pk__in=article_ids)}
+
+        for article_id, terms in term_counts.items():
+            # articles already counted, eg. when republished, would otherwise count twice
+            if article_id not in vectors:
+                document_frequency.update(terms.keys())
+                total += 1
+
+        for article_id, terms in term_counts.items():
+            vectors[article_id] = tfidf_vector(terms, document_frequency, total)
+
+        vectors = {article_id: vector for article_id, vector in vectors.items() if vector}
+        related = {article_id: neighbours for article_id, neighbours in read_related(journal_id).items()
+                   if article_id in published}
+        new = nearest_neighbours(vectors, list(term_counts.keys()))
+        related.update(new)
+
+        for article_id, neighbours in new.items():
+            for other_id, score in neighbours:
+                current = [neighbour for neighbour in related.get(other_id, []) if neighbour[0] != article_id]
+                current.append((article_id, score))
+                related[other_id] = heapq.nlargest(RELATED_COUNT, current, key=lambda neighbour: neighbour[1])
+
+        write_vectors(journal_id, vectors, document_frequency, total)
+        write_related(journal_id, related)
+
+    return len(new)
+
+
+def get_related_ids(article, limit=5):
+    if not article.journal_id:
+        return []
+
+    return [article_id for article_id, score in read_related(article.journal_id).get(article.pk, [])][:limit]
+
+
+def get_related_articles(article, limit=5):
+    """ Returns the stored related articles of an article that are still published.
+
+    :param article: an Article object
+    :param limit: the number of articles to return
+    :return: a list of Article objects, most related first
+    """
+    if not article.journal_id:
+        return []
+
+    related_ids = [article_id for article_id, score in read_related(article.journal_id).get(article.pk, [])]
+    articles = published_articles(article.journal_id).in_bulk(related_ids)
+
+    return [articles[article_id] for article_id in related_ids if article_id in articles][:limit]
+
+
+def queue_related_update(article):
+    """ Queues an incremental update of related articles for a newly published article once the current transaction
+    has committed.
+
+    :param article: an Article object
+    :return: None
+    """
+    if article.journal_id:
+        transaction.on_commit(
+            lambda: background.submit('related', build_related, article.journal_id, [article.pk], max_workers=1,
+                                      durable=True)
+        )
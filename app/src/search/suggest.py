@@ -0,0 +1,232 @@
+__copyright__ = "Copyright 2017 Birkbeck, University of London"
+__author__ = "Martin Paul Eve & Andy Byers"
+__license__ = "AGPL v3"
+__maintainer__ = "Birkbeck Centre for Technology and Publishing"
+
+import bisect
+import re
+import threading
+import time
+import unicodedata
+from collections import namedtuple
+
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from utils import background
+
+# indexes are also rebuilt this often so that articles published on a future date appear once that date passes
+INDEX_LIFETIME = 60 * 60
+# the most index entries looked at for one prefix, bounds the time taken by very short prefixes
+SCAN_LIMIT = 500
+ACCOUNTS = 'accounts'
+
+WORD = re.compile(r'[\w@.+-]+')
+
+Suggestion = namedtuple('Suggestion', ['kind', 'object_id', 'label', 'detail', 'weight'])
+
+
+def normalise(text):
+    # drops accents so that "eve" finds "Ève"
+    return ''.join(character for character in unicodedata.normalize('NFKD', text or '')
+                   if not unicodedata.combining(character)).lower()
+
+
+class PrefixIndex(object):
+    """ Sorted arrays of keys for prefix lookups with bisect. Every word of a suggestion's text starts a key, so that
+    "open" finds both "Open Access" and "The Case for Open Data". Keys starting at the first word are kept apart so
+    that they can be offered first.
+    """
+
+    def __init__(self, generation=None):
+        self.generation = generation
+        self.built = time.time()
+        self.suggestions = []
+        # first words, then later words
+        self.tiers = ([], [])
+        # the journals each suggestion belongs to, for indexes shared between journals
+        self.journals = {}
+
+    def add(self, suggestion, *texts):
+        position = len(self.suggestions)
+        self.suggestions.append(suggestion)
+
+        for text in texts:
+            words = WORD.findall(normalise(text))
+
+            for index in range(len(words)):
+                self.tiers[index > 0].append((' '.join(words[index:]), position))
+
+    def freeze(self):
+        self.tiers = tuple(([key for key, position in entries], [position for key, position in entries])
+                           for entries in (sorted(tier) for tier in self.tiers))
+        return self
+
+    def lookup(self, prefix, limit=10, journal_id=None):
+        """ Finds the suggestions with a word starting with the prefix.
+
+        :param prefix: the text typed so far
+        :param limit: the number of suggestions to return
+        :param journal_id: optional, only return suggestions that belong to this journal, see self.journals
+        :return: a list of Suggestion tuples, those matching from their first word and the most used first
+        """
+        prefix = ' '.join(WORD.findall(normalise(prefix)))
+
+        if not prefix:
+            return []
+
+        found, results = set(), []
+
+        for keys, positions in self.tiers:
+            start = bisect.bisect_left(keys, prefix)
+            matches = []
+
+            for index in range(start, min(start + SCAN_LIMIT, len(keys))):
+                if not keys[index].startswith(prefix):
+                    break
+
+                if positions[index] in found:
+                    continue
+
+                if journal_id is not None and journal_id not in self.journals.get(positions[index], ()):
+                    continue
+
+                found.add(positions[index])
+                matches.append(self.suggestions[positions[index]])
+
+            results += sorted(matches, key=lambda suggestion: (-suggestion.weight, suggestion.label))
+
+            if len(results) >= limit:
+                break
+
+        return results[:limit]
+
+
+def generation_key(scope):
+    return 'suggest_generation_{0}'.format(scope)
+
+
+def invalidate(scope):
+    """ Marks a scope's index as out of date in every process, each rebuilds it on its next lookup.
+
+    :param scope: a Journal pk or ACCOUNTS
+    :return: None
+    """
+    key = generation_key(scope)
+
+    if not cache.add(key, 1, None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, None)
+
+
+def queue_invalidate(scope):
+    transaction.on_commit(lambda: invalidate(scope))
+
+
+def build_article_index(journal_id, generation=None):
+    """ Indexes the titles, keywords and author names of a journal's published articles.
+
+    :param journal_id: the pk of a Journal
+    :param generation: the scope's generation when the build started
+    :return: a PrefixIndex
+    """
+    from submission import models
+
+    index = PrefixIndex(generation)
+    articles = models.Article.objects.filter(journal_id=journal_id, stage=models.STAGE_PUBLISHED,
+                                             date_published__lte=timezone.now())
+    article_ids = set()
+
+    for article_id, title in articles.values_list('pk', 'title'):
+        article_ids.add(article_id)
+        index.add(Suggestion('article', article_id, title, None, 1), title)
+
+    keywords, authors = {}, {}
+
+    for article_id, word in models.Article.keywords.through.objects.filter(
+            article__journal_id=journal_id).values_list('article_id', 'keyword__word'):
+        if article_id in article_ids and word:
+            keywords[word] = keywords.get(word, 0) + 1
+
+    for article_id, first_name, last_name in models.FrozenAuthor.objects.filter(
+            article__journal_id=journal_id).values_list('article_id', 'first_name', 'last_name'):
+        name = ' '.join(part for part in (first_name, last_name) if part)
+        if article_id in article_ids and name:
+            authors[name] = authors.get(name, 0) + 1
+
+    for word, count in keywords.items():
+        index.add(Suggestion('keyword', None, word, None, count), word)
+
+    for name, count in authors.items():
+        index.add(Suggestion('author', None, name, None, count), name)
+
+    return index.freeze()
+
+
+def build_account_index(generation=None):
+    """ Indexes the names and email addresses of active accounts, recording the journals each has a role on.
+
+    :param generation: the scope's generation when the build started
+    :return: a PrefixIndex
+    """
+    from core import models
+
+    index = PrefixIndex(generation)
+    journals = {}
+
+    for account_id, journal_id in models.AccountRole.objects.values_list('user_id', 'journal_id'):
+        journals.setdefault(account_id, set()).add(journal_id)
+
+    for account_id, first_name, last_name, email in models.Account.objects.filter(is_active=True).values_list(
+            'pk', 'first_name', 'last_name', 'email'):
+        name = ' '.join(part for part in (first_name, last_name) if part)
+        index.journals[len(index.suggestions)] = journals.get(account_id, set())
+        index.add(Suggestion('account', account_id, name or email, email, 1), name, email)
+
+    return index.freeze()
+
+
+_indexes = {}
+_lock = threading.Lock()
+# answers lookups while the first build of a scope built in the background is running
+_empty = PrefixIndex().freeze()
+
+
+def build_index(scope, generation):
+    index = build_account_index(generation) if scope == ACCOUNTS else build_article_index(scope, generation)
+
+    with _lock:
+        _indexes[scope] = index
+
+    return index
+
+
+def get_index(scope):
+    """ Returns this process's index for a scope. The first lookup of a journal builds it, after that an out of date
+    index keeps answering while a fresh one is built in the background. Every active account is too many to index
+    inside a request, so the account index is always built in the background and lookups find nothing until then.
+
+    :param scope: a Journal pk or ACCOUNTS
+    :return: a PrefixIndex
+    """
+    generation = cache.get(generation_key(scope))
+    index = _indexes.get(scope)
+
+    if index is None and scope == ACCOUNTS:
+        background.submit_once('suggest', scope, build_index, scope, generation)
+        return _empty
+
+    if index is None:
+        return build_index(scope, generation)
+
+    if index.generation != generation or time.time() - index.built > INDEX_LIFETIME:
+        background.submit_once('suggest', scope, build_index, scope, generation)
+
+    return index
+
+
+def suggest(scope, prefix, limit=10, journal_id=None):
+    return get_index(scope).lookup(prefix, limit=limit, journal_id=journal_id)
@@ -0,0 +1,227 @@
+__copyright__ = "Copyright 2017 Birkbeck, University of London"
+__author__ = "Martin Paul Eve & Andy Byers"
+__license__ = "AGPL v3"
+__maintainer__ = "Birkbeck Centre for Technology and Publishing"
+
+import os
+import shutil
+import tempfile
+import time
+from collections import Counter
+
+from django.core.paginator import Paginator
+from django.test import TestCase
+from django.utils import timezone
+
+from search import backends, extraction, query, related, suggest
+from submission import models as submission_models
+from utils.testing import setup
+
+
+class QueryParserTests(TestCase):
+
+    def test_fields_phrases_and_exclusions(self):
+        terms = query.parse('author:eve "open access" -preprint')
+
+        self.assertEqual(terms, [
+            query.Term(text='eve', field='authors', phrase=False, negate=False),
+            query.Term(text='open access', field=None, phrase=True, negate=False),
+            query.Term(text='preprint', field=None, phrase=False, negate=True),
+        ])
+
+    def test_unknown_fields_are_searched_as_typed(self):
+        self.assertEqual(query.parse('10:30'), [query.Term(text='10:30', field=None, phrase=False, negate=False)])
+
+    def test_punctuation_only_terms_are_dropped(self):
+        self.assertEqual(query.parse('- "" ...'), [])
+
+    def test_fts_expression_quotes_user_input(self):
+        expression = query.to_fts(query.parse('title:"a OR b" -c NEAR'), backends.FIELDS)
+
+        self.assertEqual(expression, '(title : "a OR b" AND "NEAR") NOT "c"')
+
+    def test_exclusions_alone_match_nothing(self):
+        self.assertIsNone(query.to_fts(query.parse('-draft'), backends.FIELDS))
+
+
+class SearchBackendTests(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.backend = backends.SQLiteFTSBackend(os.path.join(self.folder, 'index.sqlite3'))
+        self.backend.index([
+            self.document(1, title='Open access publishing'),
+            self.document(2, body='A long text that mentions open access once among other publishing concerns.'),
+            self.document(3, title='Peer review', abstract='Open peer review in practice'),
+            self.document(4, title='Open access elsewhere', scope=2),
+            self.document(5, title='Open access in the future', published=time.time() + 60 * 60),
+        ])
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    @staticmethod
+    def document(object_id, scope=1, published=None, **fields):
+        return {'doc_type': 'article', 'object_id': object_id, 'scope': scope, 'published': published,
+                'fields': fields}
+
+    def test_title_matches_rank_above_body_matches(self):
+        hits = self.backend.search('article', 1, 'open access')
+
+        self.assertEqual([hit.object_id for hit in hits], [1, 2])
+        self.assertGreater(hits[0].score, hits[1].score)
+
+    def test_results_are_limited_to_scope_and_published_documents(self):
+        self.assertEqual(self.backend.count('article', 2, 'open access'), 1)
+        self.assertNotIn(5, [hit.object_id for hit in self.backend.search('article', 1, 'future')])
+
+    def test_field_and_excluded_terms(self):
+        self.assertEqual([hit.object_id for hit in self.backend.search('article', 1, 'title:review')], [3])
+        self.assertEqual([hit.object_id for hit in self.backend.search('article', 1, 'open -review')], [1, 2])
+
+    def test_removed_documents_are_not_found(self):
+        self.backend.remove('article', [1])
+
+        self.assertEqual([hit.object_id for hit in self.backend.search('article', 1, 'open access')], [2])
+
+
+class PreprintSearchTests(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.backend = backends.SQLiteFTSBackend(os.path.join(self.folder, 'index.sqlite3'))
+        self.backend.index([{'doc_type': 'preprint', 'object_id': object_id, 'scope': None, 'published': None,
+                             'fields': {'title': 'Open data preprint'}, 'facets': {'subject': subjects}}
+                            for object_id, subjects in ((1, [1]), (2, [1, 2]), (3, [2]), (4, [1]), (5, []))])
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def results(self, subject=None):
+        return backends.SearchResults('preprint', None, 'open data', facets={'subject': subject} if subject else None,
+                                      backend=self.backend)
+
+    def test_facet_counts_ignore_the_subject_being_filtered(self):
+        results = self.results(subject=2)
+
+        self.assertEqual(results.count(), 2)
+        self.assertEqual(results.facet_counts('subject'), [('1', 3), ('2', 2)])
+
+    def test_pages_of_equally_ranked_results_neither_repeat_nor_skip(self):
+        paginator = Paginator(self.results(), 2)
+        pages = [[hit.object_id for hit in paginator.page(number).object_list] for number in paginator.page_range]
+
+        self.assertEqual(pages, [[1, 2], [3, 4], [5]])
+
+
+class PrefixIndexTests(TestCase):
+
+    def setUp(self):
+        self.index = suggest.PrefixIndex()
+
+        for object_id, label, weight in ((1, 'The Case for Open Data', 5), (2, 'Open Access', 1),
+                                         (3, 'Ève Martin', 2), (4, 'Opening Remarks', 3)):
+            self.index.add(suggest.Suggestion('article', object_id, label, None, weight), label)
+
+        self.index.freeze()
+
+    def test_first_word_matches_come_first_then_by_weight(self):
+        self.assertEqual([suggestion.object_id for suggestion in self.index.lookup('open')], [4, 2, 1])
+
+    def test_accents_and_case_are_ignored(self):
+        self.assertEqual([suggestion.object_id for suggestion in self.index.lookup('EVE')], [3])
+
+    def test_limit_and_empty_prefix(self):
+        self.assertEqual(len(self.index.lookup('open', limit=1)), 1)
+        self.assertEqual(self.index.lookup('  '), [])
+
+    def test_lookups_can_be_limited_to_a_journal(self):
+        self.index.journals = {0: {1}, 1: {1, 2}, 3: {2}}
+
+        self.assertEqual([suggestion.object_id for suggestion in self.index.lookup('open', journal_id=2)], [4, 2])
+        self.assertEqual([suggestion.object_id for suggestion in self.index.lookup('open', journal_id=3)], [])
+
+
+class ExtractionTests(TestCase):
+
+    def test_tokenize_lowercases_and_drops_single_characters(self):
+        self.assertEqual(extraction.tokenize('A Study of X-Ray data, 2017'), ['study', 'of', 'ray', 'data', '2017'])
+
+    def test_shingles_of_short_and_empty_texts(self):
+        self.assertEqual(len(extraction.shingles(['one', 'two'])), 1)
+        self.assertEqual(extraction.shingles([]), set())
+
+    def test_resemblance(self):
+        text = extraction.tokenize('the quick brown fox jumps over the lazy dog near the river bank')
+        changed = extraction.tokenize('the quick brown fox jumps over the lazy cat near the river bank')
+
+        self.assertEqual(extraction.resemblance(extraction.shingles(text), extraction.shingles(text)), 1.0)
+        self.assertLess(extraction.resemblance(extraction.shingles(text), extraction.shingles(changed)), 1.0)
+        self.assertGreater(extraction.resemblance(extraction.shingles(text), extraction.shingles(changed)), 0.0)
+        self.assertEqual(extraction.resemblance(set(), extraction.shingles(text)), 0.0)
+
+
+class RelatedArticleTests(TestCase):
+
+    TITLES = ('Open access publishing models', 'Open access publishing costs', 'Peer review practices',
+              'Peer review bias', 'Research data sharing', 'Research data repositories')
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.related_folder = related.RELATED_FOLDER
+        related.RELATED_FOLDER = self.folder
+        related._cache.clear()
+
+    def tearDown(self):
+        related.RELATED_FOLDER = self.related_folder
+        related._cache.clear()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_neighbours_are_ordered_by_shared_distinctive_terms(self):
+        vectors, document_frequency = related.tfidf_vectors({
+            1: Counter({'open': 2, 'access': 2, 'review': 1, 'the': 1}),
+            2: Counter({'open': 1, 'access': 1, 'the': 1}),
+            3: Counter({'open': 1, 'review': 2, 'the': 1}),
+            4: Counter({'data': 1, 'unique': 3, 'the': 1}),
+            5: Counter({'data': 2, 'the': 1}),
+            6: Counter({'sharing': 1, 'the': 1}),
+        })
+
+        # terms in every article or in only one say nothing about how articles are related
+        self.assertEqual(sorted(vectors), [1, 2, 3, 4, 5])
+        self.assertEqual(vectors[4], {'data': 1.0})
+
+        neighbours = related.nearest_neighbours(vectors, [1, 2, 6])
+
+        self.assertEqual([article_id for article_id, score in neighbours[1]], [2, 3])
+        self.assertEqual([article_id for article_id, score in neighbours[2]], [1, 3])
+        self.assertNotIn(6, neighbours)
+
+    def test_new_articles_are_scored_against_the_stored_vectors(self):
+        setup.create_press()
+        journal, _ = setup.create_journals()
+        setup.create_roles(['author'])
+        author = setup.create_author(journal)
+
+        articles = [self.publish(journal, author, title) for title in self.TITLES]
+        self.assertEqual(related.build_related(journal.pk), 6)
+
+        new_article = self.publish(journal, author, 'Open access publishing of research data')
+        self.assertEqual(related.build_related(journal.pk, [new_article.pk]), 1)
+
+        related_ids = related.get_related_ids(new_article, limit=10)
+        self.assertEqual(set(related_ids[:2]), {articles[0].pk, articles[1].pk})
+        self.assertEqual(set(related_ids[2:]), {articles[4].pk, articles[5].pk})
+
+        # the new article is offered to the articles it is related to
+        self.assertEqual(related.get_related_ids(articles[0]), [articles[1].pk, new_article.pk])
+
+        vectors, document_frequency, total = related.read_vectors(journal.pk)
+        self.assertEqual(total, 7)
+        self.assertIn(new_article.pk, vectors)
+
+    @staticmethod
+    def publish(journal, author, title):
+        return submission_models.Article.objects.create(owner=author, title=title, journal=journal,
+                                                        stage=submission_models.STAGE_PUBLISHED,
+                                                        date_published=timezone.now())
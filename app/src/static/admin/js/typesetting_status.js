@@ -0,0 +1,33 @@
+// Polls the status of queued CaSSius PDF jobs and reloads the page once a new PDF galley has been created.
+var typesettingLabels = {
+    'queued': 'PDF queued',
+    'running': 'Generating PDF',
+    'failed': 'PDF generation failed'
+};
+
+function pollTypesettingStatus(element) {
+    $.getJSON(element.data('status-url'), function (status) {
+        if (status.state === 'complete' && element.data('polling')) {
+            window.location.reload();
+            return;
+        }
+
+        var label = typesettingLabels[status.state] || '';
+        if (status.state === 'running' && status.stage) {
+            label = label + ' (' + status.stage + ')';
+        }
+        element.text(label);
+        element.attr('title', status.message || '');
+
+        if (status.state === 'queued' || status.state === 'running') {
+            element.data('polling', true);
+            setTimeout(function () {
+                pollTypesettingStatus(element);
+            }, 5000);
+        }
+    });
+}
+
+$('.typesetting-status').each(function () {
+    pollTypesettingStatus($(this));
+});
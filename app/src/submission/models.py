@@ -11,6 +11,8 @@ from dateutil import parser as dateparser
 
 from django.urls import reverse
 from django.db import models
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
 from django.utils import timezone
 from hvad.models import TranslatableModel, TranslatedFields
 from django.core.files.storage import FileSystemStorage
@@ -20,7 +22,8 @@ from django.utils.translation import ugettext_lazy as _
 from identifiers import logic as id_logic
 from metrics.logic import ArticleMetrics
 from review import models as review_models
-from utils.function_cache import cache
+from search import documents as search_documents, suggest as search_suggest
+from utils.function_cache import cache, tag
 from preprint import models as preprint_models
 
 fs = FileSystemStorage(location=settings.MEDIA_ROOT)
@@ -521,7 +524,7 @@ class Article(models.Model):
         return True
 
     @property
-    @cache(300)
+    @cache(300, tags=lambda self: [tag('journal', self.journal_id), tag('article', self)])
     def identifier(self):
         from identifiers import models as identifier_models
         try:
@@ -561,7 +564,9 @@ class Article(models.Model):
         return u'%s - %s' % (self.pk, self.title)
 
     @staticmethod
-    @cache(300)
+    @cache(300, tags=lambda journal, identifier_type, identifier: [tag('journal', journal),
+                                                                   tag('identifiers', journal)],
+           cache_none=True)
     def get_article(journal, identifier_type, identifier):
         from identifiers import models as identifier_models
         try:
@@ -586,7 +591,7 @@ class Article(models.Model):
             return None
 
     @property
-    @cache(600)
+    @cache(600, tags=lambda self: [tag('journal', self.journal_id), tag('article', self)], local=True)
     def url(self):
         if self.is_remote:
             return self.remote_url
@@ -701,7 +706,7 @@ class Article(models.Model):
         from journal import models as journal_models
         return journal_models.Issue.objects.filter(journal=self.journal, articles__in=[self])
 
-    @cache(7200)
+    @cache(7200, tags=lambda self: [tag('journal', self.journal_id), tag('article', self)])
     def altmetrics(self):
         alm = self.altmetric_set.all()
         return {
@@ -714,7 +719,7 @@ class Article(models.Model):
         }
 
     @property
-    @cache(300)
+    @cache(300, tags=lambda self: [tag('journal', self.journal_id), tag('article', self)], cache_none=True)
     def issue(self):
         """
         Yields the first issue in the current journal that contains this article.
@@ -944,12 +949,13 @@ class Article(models.Model):
         else:
             return None
 
-    @cache(600)
+    @cache(600, tags=lambda self: [tag('journal', self.journal_id), tag('article', self)])
     def workflow_stages(self):
         from core import models as core_models
         return core_models.WorkflowLog.objects.filter(article=self)
 
-    @cache(600)
+    @cache(600, tags=lambda self: [tag('journal', self.journal_id), tag('article', self),
+                                   tag('settings', self.journal_id)])
     def render_sample_doi(self):
         return id_logic.render_doi_from_pattern(self)
 
@@ -1212,3 +1218,32 @@ class SubmissionConfiguration(models.Model):
             article.license = self.default_license
 
         article.save()
+
+
+def invalidate_suggestions(article):
+    # only published articles are offered as suggestions, so workflow changes can leave the index alone
+    if article.journal_id and article.stage == STAGE_PUBLISHED:
+        search_suggest.queue_invalidate(article.journal_id)
+
+
+@receiver(post_save, sender=Article)
+@receiver(post_delete, sender=Article)
+def index_saved_article(sender, instance, **kwargs):
+    search_documents.queue_article_index(instance.pk)
+    invalidate_suggestions(instance)
+
+
+@receiver(m2m_changed, sender=Article.keywords.through)
+@receiver(m2m_changed, sender=Article.authors.through)
+def index_article_relations(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear') and not reverse:
+        search_documents.queue_article_index(instance.pk)
+        invalidate_suggestions(instance)
+
+
+@receiver(post_save, sender=FrozenAuthor)
+@receiver(post_delete, sender=FrozenAuthor)
+def index_frozen_author_article(sender, instance, **kwargs):
+    if instance.article_id:
+        search_documents.queue_article_index(instance.article_id)
+        invalidate_suggestions(instance.article)
@@ -13,7 +13,7 @@ from django.http import HttpResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.utils import timezone
 
-from core import files, models as core_models
+from core import files, models as core_models, uploads
 from preprint import models as preprint_models
 from security.decorators import article_edit_user_required, production_user_or_editor_required, editor_user_required
 from submission import forms, models, logic, decorators
@@ -275,7 +275,7 @@ def submit_files(request, article_id):
 
         if 'manuscript' in request.POST:
             form = forms.FileDetails(request.POST)
-            uploaded_file = request.FILES.get('file')
+            uploaded_file = uploads.get_uploaded_file(request, 'file')
             if logic.check_file(uploaded_file, request, form):
                 if form.is_valid():
                     new_file = files.save_file_to_article(uploaded_file, article, request.user)
@@ -290,7 +290,7 @@ def submit_files(request, article_id):
                 modal = 'manuscript'
 
         if 'data' in request.POST:
-            for uploaded_file in request.FILES.getlist('file'):
+            for uploaded_file in uploads.get_uploaded_files(request, 'file'):
                 form = forms.FileDetails(request.POST)
                 if form.is_valid():
                     new_file = files.save_file_to_article(uploaded_file, article, request.user)
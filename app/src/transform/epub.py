@@ -3,65 +3,246 @@ __author__ = "Martin Paul Eve & Andy Byers"
 __license__ = "AGPL v3"
 __maintainer__ = "Birkbeck Centre for Technology and Publishing"
 
+import hashlib
+import json
 import os
-import codecs
-import uuid
+import tempfile
 
-from bs4 import BeautifulSoup
 from ebooklib import epub
+from lxml import html as lxml_html
 
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
 
-from core import files
+from core import files, renders
 from core import models
+from utils import background
 
+EPUB_FOLDER = os.path.join(settings.BASE_DIR, 'files', 'epub')
+# bump this when the layout of generated books changes so that existing books are rebuilt
+EPUB_FORMAT = 1
+EPUB_STYLE = '''img {max-width: 100%;}'''
 
-def temp_directory():
-    _dir = os.path.join(settings.BASE_DIR, 'files/temp', str(uuid.uuid4()))
-    os.makedirs(_dir, 0o775)
-    return _dir
 
+class FileItem(epub.EpubItem):
+    """ An EPUB item whose content is read from disk as the book is written, rather than held in memory. """
 
-def manipulate_images(html):
-    souped_html = BeautifulSoup(str(html), 'html')
+    def __init__(self, path, **kwargs):
+        super(FileItem, self).__init__(**kwargs)
+        self.path = path
 
-    elements = {
-        'img': 'src',
-    }
+    def get_content(self, default=None):
+        with open(self.path, 'rb') as content_file:
+            return content_file.read()
 
+
+def manipulate_images(html, prefix=''):
+    """ Points the images of a galley at their copies alongside it in the book and links the book's stylesheet.
+
+    :param html: a string of galley HTML
+    :param prefix: the folder inside the book that this galley and its images are stored in
+    :return: a tuple of the new HTML and the original filenames of the images referenced
+    """
+    document = lxml_html.document_fromstring(html or '<p></p>')
     found_elements = []
 
-    # iterate over all found elements
-    for element, attribute in elements.items():
-        images = souped_html.findAll(element)
+    for image in document.iter('img'):
+        if not image.get('src'):
+            continue
+
+        name = os.path.basename(image.get('src'))
+        image.set('src', name)
 
-        # iterate over all found elements of each type in the elements dictionary
-        for image in images:
-            # attempt to pull a URL from the specified attribute
-            found_elements.append(os.path.basename(image['src']))
-            image['src'] = os.path.basename(image['src'])
+        if name not in found_elements:
+            found_elements.append(name)
 
-    css_tag = souped_html.new_tag("link", rel="stylesheet", type="text/css", href="style/default.css")
-    souped_html.body.append(css_tag)
+    css_depth = '../' * prefix.count('/')
+    document.body.append(lxml_html.Element('link', rel='stylesheet', type='text/css',
+                                           href='{0}style/default.css'.format(css_depth)))
 
-    return souped_html, found_elements
+    return lxml_html.tostring(document, encoding='unicode'), found_elements
 
 
 def get_html_content(galley):
-    if galley.file.mime_type == 'application/xml':
-        return galley.file.render_xml(galley.article)
+    if renders.is_xml_galley(galley):
+        return renders.get_rendered_galley(galley)
     elif galley.file.mime_type == 'text/html':
         return galley.file.get_file(galley.article)
 
 
-def write_html_to_temp(html, temp):
-    file = codecs.open(os.path.join(temp, 'temp.html'), "w", "utf-8")
-    file.write(str(html))
-    file.close()
+def source_version(galley):
+    if renders.is_xml_galley(galley):
+        return renders.render_version(galley)
+    elif galley.file.mime_type == 'text/html':
+        try:
+            return files.cached_checksum(galley.file.get_file_path(galley.article))
+        except FileNotFoundError:
+            return None
+
+
+def chapter_key(galley):
+    """ Identifies the content of an article's chapter by its galley, figures and metadata.
+
+    :param galley: an XML or HTML Galley
+    :return: a hex digest, or None if the galley's file is missing
+    """
+    version = source_version(galley)
+
+    if version is None:
+        return None
+
+    manifest = galley.figure_manifest()
+    figures = sorted((name, figure['checksum']) for name, figure in manifest['figures'].items())
+    authors = [author.full_name() for author in galley.article.authors.all()]
+
+    return hashlib.md5(json.dumps([EPUB_FORMAT, version, galley.article.title, authors, figures]).encode()).hexdigest()
+
+
+def epub_path(key):
+    return os.path.join(EPUB_FOLDER, key[:2], '{0}.epub'.format(key))
+
+
+def add_chapter(book, galley, file_name, prefix=''):
+    """ Adds a galley and its figures to a book, the figures are read from disk as the book is written.
+
+    :param book: an EpubBook
+    :param galley: an XML or HTML Galley
+    :param file_name: the file name of the chapter inside the book
+    :param prefix: a folder inside the book for this galley's images
+    :return: the EpubHtml chapter
+    """
+    article = galley.article
+    html, elements = manipulate_images(get_html_content(galley), prefix=prefix)
+    figures = galley.figure_manifest()['figures']
+
+    chapter = epub.EpubHtml(title=article.title, file_name=file_name, lang='en')
+    chapter.content = html
+    book.add_item(chapter)
+
+    for element in elements:
+        figure = figures.get(element)
+
+        if figure and figure['size'] is not None:
+            book.add_item(FileItem(figure['path'], uid='image_{0}'.format(figure['pk']), file_name=prefix + element,
+                                   media_type=figure['mime_type']))
+
+    return chapter
+
+
+def write_book(book, chapters, path):
+    book.add_item(epub.EpubItem(uid="style_default", file_name="style/default.css", media_type="text/css",
+                                content=EPUB_STYLE))
+    book.spine = chapters
+
+    files.mkdirs(os.path.dirname(path))
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    os.close(handle)
+
+    try:
+        epub.write_epub(temp_path, book, {})
+        os.replace(temp_path, path)
+    finally:
+        files.unlink_temp_file(temp_path)
+
+    return path
+
+
+def replace_previous(cache_key, key):
+    previous_key = cache.get(cache_key)
+    if previous_key and previous_key != key:
+        files.unlink_temp_file(epub_path(previous_key))
+    cache.set(cache_key, key, None)
+
+
+def get_galley_epub(galley):
+    """ Returns the path to an EPUB of a galley, building it only if this version hasn't been built before.
+
+    :param galley: an XML or HTML Galley
+    :return: a path, or None if the galley's file is missing
+    """
+    key = chapter_key(galley)
+
+    if key is None:
+        return None
+
+    path = epub_path(key)
+
+    if os.path.isfile(path):
+        return path
+
+    article = galley.article
+    book = epub.EpubBook()
+
+    book.set_identifier('janeway-article-{0}'.format(article.pk))
+    book.set_title(article.title)
+    book.set_language('en')
+
+    for author in article.authors.all():
+        book.add_author(author.full_name())
+
+    write_book(book, [add_chapter(book, galley, 'article.xhtml')], path)
+    replace_previous('galley_epub_{0}'.format(galley.pk), key)
+
+    return path
+
+
+def epub_galley(article):
+    """ Returns the galley an article's chapter should be built from, its render galley or else an XML or HTML one. """
+    galleys = [article.render_galley] if article.render_galley else []
+    galleys += list(article.galley_set.select_related('file').order_by('sequence'))
+
+    for galley in galleys:
+        if renders.is_xml_galley(galley) or galley.file.mime_type == 'text/html':
+            return galley
+
+    return None
+
+
+def get_issue_epub(issue):
+    """ Returns the path to an EPUB bundling the published articles of an issue, one chapter per article. The bundle
+    is rebuilt when any of its articles change.
+
+    :param issue: an Issue object
+    :return: a path, or None if no article in the issue has an XML or HTML galley
+    """
+    galleys = [galley for galley in (epub_galley(item['article']) for item in issue.issue_articles) if galley]
+    keys = [chapter_key(galley) for galley in galleys]
+    galleys = [galley for galley, key in zip(galleys, keys) if key]
+    keys = [key for key in keys if key]
+
+    if not galleys:
+        return None
+
+    key = hashlib.md5(json.dumps([EPUB_FORMAT, issue.pk, issue.display_title, keys]).encode()).hexdigest()
+    path = epub_path(key)
 
+    if os.path.isfile(path):
+        return path
 
-def store_file(request, temp, file, galley):
-    new_file = files.copy_local_file_to_article(os.path.join(temp, file), 'article.epub', galley.article,
+    book = epub.EpubBook()
+
+    book.set_identifier('janeway-issue-{0}'.format(issue.pk))
+    book.set_title(issue.display_title)
+    book.set_language('en')
+
+    chapters = []
+    for galley in galleys:
+        prefix = 'article-{0}/'.format(galley.article.pk)
+        chapters.append(add_chapter(book, galley, '{0}article.xhtml'.format(prefix), prefix=prefix))
+
+    book.toc = chapters
+    book.add_item(epub.EpubNcx())
+    book.add_item(epub.EpubNav())
+
+    write_book(book, ['nav'] + chapters, path)
+    replace_previous('issue_epub_{0}'.format(issue.pk), key)
+
+    return path
+
+
+def store_file(request, path, galley):
+    new_file = files.copy_local_file_to_article(path, 'article.epub', galley.article,
                                                 request.user, label="EPUB", galley=True)
     galley.article.manuscript_files.add(new_file)
 
@@ -75,40 +256,31 @@ def store_file(request, temp, file, galley):
 
 
 def generate_ebook_lib_epub(request, galley):
-    base_html = get_html_content(galley)
-    temp = temp_directory()
-    file = "temp.epub"
-    article = galley.article
-    html, elements = manipulate_images(base_html)
-
-    book = epub.EpubBook()
-
-    # add metadata
-    book.set_identifier('sample123456')
-    book.set_title(article.title)
-    book.set_language('en')
+    path = get_galley_epub(galley)
 
-    for author in article.authors.all():
-        book.add_author(author.full_name())
+    if path:
+        store_file(request, path, galley)
 
-    c1 = epub.EpubHtml(title=article.title, file_name='article.xhtml', lang='en')
-    c1.content = str(html)
-    book.add_item(c1)
 
-    for i, element in enumerate(elements):
-        img = galley.images.get(original_filename=element)
-        item = epub.EpubItem(uid="image_{0}".format(i),
-                             file_name=element,
-                             content=open(img.self_article_path(), 'rb').read())
+def prebuild_galley_epub(galley_id):
+    try:
+        galley = models.Galley.objects.select_related('file', 'article__journal').get(pk=galley_id)
+    except models.Galley.DoesNotExist:
+        return
 
-        book.add_item(item)
+    get_galley_epub(galley)
 
-    style = '''img {max-width: 100%;}'''
-    default_css = epub.EpubItem(uid="style_default", file_name="style/default.css", media_type="text/css",
-                                content=style)
-    book.add_item(default_css)
 
-    book.spine = [c1]
-    epub.write_epub(os.path.join(temp, file), book, {})
+def queue_article_epubs(article):
+    """ Queues background builds of EPUBs for an article's XML and HTML galleys once the current transaction has
+    committed.
 
-    store_file(request, temp, file, galley)
+    :param article: an Article object
+    :return: None
+    """
+    for galley in article.galley_set.select_related('file'):
+        if renders.is_xml_galley(galley) or galley.file.mime_type == 'text/html':
+            transaction.on_commit(
+                lambda galley_id=galley.pk: background.submit_once('epub', ('galley', galley_id),
+                                                                   prebuild_galley_epub, galley_id, durable=True)
+            )
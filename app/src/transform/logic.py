@@ -4,24 +4,39 @@ __license__ = "AGPL v3"
 __maintainer__ = "Birkbeck Centre for Technology and Publishing"
 import os
 import shutil
+import socket
 import subprocess
+import time
 import uuid
 
 import pdfkit
 
+from django.conf import settings
+from django.core.cache import cache
+
 from core import files
+from utils import background, models as util_models
+
+TYPESETTING_FOLDER = os.path.join(settings.BASE_DIR, 'files', 'temp', 'typesetting')
+# each job runs a JVM and a wkhtmltopdf process so only a couple are run at once
+TYPESETTING_WORKERS = 2
+# jobs still queued or running after this long are assumed to have died with their process, jobs whose process has
+# exited on this host are known to have died straight away
+TYPESETTING_TIMEOUT = 60 * 60
 
 
 class CassiusDriver:
     """ A class to control the typesetting tool CaSSius and its JATS importer for automated XML typesetting
     """
 
-    def __init__(self, accessible_temporary_directory, galley, request):
+    def __init__(self, accessible_temporary_directory, galley, request=None, owner=None, logo=None):
         """ Creates a new CassiusDriver
 
         :param accessible_temporary_directory: a temporary directory to which the application has write permissions
         :param galley: a galley associated with an article and file
-        :param request: the current request object
+        :param request: optional, the current request object, from which the owner and logo are taken
+        :param owner: the Account that owns the new PDF, when there is no request
+        :param logo: the path to the press logo or None, when there is no request
         """
         from transform import urls
         self.galley = galley
@@ -29,32 +44,48 @@ class CassiusDriver:
         self.article_object = galley.article
         self.file_object = galley.file
         self.current_path = os.path.dirname(urls.__file__)
-        self.request = request
+        # the driver may outlive the request when run in the background, so take what we need from it now
+        self.logo = request.press.press_cover(request) if request else logo
+        self.owner = request.user if request else owner
         self.rewritten_figures = {}
 
-    def transform(self):
+    def transform(self, progress=None):
         """ Transforms a JATS XML document into a PDF and affiliate it with the current article as a galley
 
-        :return: None
+        :param progress: optional function called with the name of each stage as it starts
+        :return: the new PDF Galley, or None if the galley is not XML
         """
-        html, uuid_directory_name, uuid_file_name = self.import_from_jats()
-        if html:
-            self.replace_logo(uuid_directory_name)
-            self.replace_figures(uuid_directory_name, html)
-            pdf = self.print_to_pdf(html, uuid_directory_name, uuid_file_name)
-            self._store_file(pdf)
+        progress = progress or (lambda stage: None)
+        # the working directory is named up front so that it is removed however the import fails
+        uuid_directory_name = os.path.join(self.accessible_temporary_directory, str(uuid.uuid4()))
+
+        try:
+            progress('importing')
+            html, uuid_directory_name, uuid_file_name = self.import_from_jats(uuid_directory_name)
+
+            if html:
+                progress('replacing figures')
+                self.replace_logo(uuid_directory_name)
+                self.replace_figures(uuid_directory_name, html)
 
-        self._cleanup(uuid_directory_name)
+                progress('printing')
+                pdf = self.print_to_pdf(html, uuid_directory_name, uuid_file_name)
 
-    def import_from_jats(self):
+                progress('storing')
+                return self._store_file(pdf)
+        finally:
+            self._cleanup(uuid_directory_name)
+
+    def import_from_jats(self, uuid_directory_name):
         """ Import a JATS file into CaSSius HTML
 
+        :param uuid_directory_name: the temporary directory to work in, created if necessary
         :return: a 3-tuple of output_file_path, uuid_directory_name, uuid_file_name
         """
         if not self._check_file_is_xml():
-            return None, None, None
+            return None, uuid_directory_name, None
 
-        uuid_directory_name, uuid_file_name = self._copy_files_to_accessible_temporary_directory()
+        uuid_file_name = self._copy_files_to_accessible_temporary_directory(uuid_directory_name)
         return self._transform_using_xsl(uuid_directory_name, uuid_file_name)
 
     def replace_logo(self, uuid_directory_name):
@@ -69,7 +100,7 @@ class CassiusDriver:
         with open(javascript_path, 'r') as javascript:
             in_data = javascript.read()
 
-        out_data = in_data.replace(old_logo_text, self.request.press.press_cover(self.request))
+        out_data = in_data.replace(old_logo_text, self.logo)
 
         with open(javascript_path, 'w') as new_javascript:
             new_javascript.write(out_data)
@@ -110,12 +141,12 @@ class CassiusDriver:
         """
         return self.file_object.mime_type == 'application/xml'
 
-    def _copy_files_to_accessible_temporary_directory(self):
+    def _copy_files_to_accessible_temporary_directory(self, uuid_directory_name):
         """ Copies the XML, all images, and CaSSius templates to a temporary UUID directory
 
-        :return: a 2-tuple of uuid_directory_name, uuid_file_name
+        :param uuid_directory_name: the temporary directory to copy into
+        :return: the uuid_file_name of the copied XML
         """
-        uuid_directory_name = os.path.join(self.accessible_temporary_directory, str(uuid.uuid4()))
         uuid_file_name = str(uuid.uuid4())
 
         # create the sub-folders as necessary
@@ -149,7 +180,7 @@ class CassiusDriver:
             # store the old file name as a key and the new file name as a value in this dictionary
             self.rewritten_figures[image.original_filename] = new_image_file_name
 
-        return uuid_directory_name, uuid_file_name
+        return uuid_file_name
 
     def _transform_using_xsl(self, uuid_directory_name, uuid_file_name):
         """ Transforms a document from XML to HTML
@@ -167,6 +198,9 @@ class CassiusDriver:
 
         subprocess.call(command, stdin=None, shell=True)
 
+        if not os.path.isfile(output_file_path):
+            raise IOError('The CaSSius import produced no HTML.')
+
         return output_file_path, uuid_directory_name, uuid_file_name
 
     def _call_pdfkit(self, html_file, uuid_directory_name, uuid_file_name):
@@ -201,14 +235,14 @@ class CassiusDriver:
         """ Affiliates a file with an article
 
         :param file_path: the file path
-        :return: None
+        :return: the new Galley
         """
         from core import models as core_models
         new_file = files.copy_local_file_to_article(file_path, 'article.pdf', self.article_object,
-                                                    self.request.user, label="PDF", galley=True)
+                                                    self.owner, label="PDF", galley=True)
         self.article_object.manuscript_files.add(new_file)
 
-        core_models.Galley.objects.create(
+        return core_models.Galley.objects.create(
             article=self.article_object,
             file=new_file,
             label='PDF',
@@ -223,4 +257,109 @@ class CassiusDriver:
         :param uuid_directory_name: the temporary directory to delete
         :return: None
         """
-        shutil.rmtree(uuid_directory_name)
+        shutil.rmtree(uuid_directory_name, ignore_errors=True)
+
+
+def typesetting_status_key(article_id):
+    return 'typesetting_status_{0}'.format(article_id)
+
+
+def get_typesetting_status(article_id):
+    """ Returns the status of an article's PDF typesetting job. A job left queued or running by a process that has
+    exited is reported as failed, background.run_jobs() retries it and it can be queued again.
+
+    :param article_id: the pk of an Article
+    :return: a dictionary with a 'state' of queued, running, complete or failed, or None if there is no job
+    """
+    status = cache.get(typesetting_status_key(article_id))
+    in_progress = status and status['state'] in ('queued', 'running')
+
+    if in_progress and not background.process_alive(status.get('host'), status.get('pid')):
+        status = set_typesetting_status(article_id, 'failed', galley=status.get('galley'), stage=None,
+                                        message='Typesetting stopped when its process exited.')
+
+    return status
+
+
+def set_typesetting_status(article_id, state, **kwargs):
+    # the process running the job is recorded so that a job that died with it is noticed straight away
+    status = dict(kwargs, state=state, updated=time.time(), host=socket.gethostname(), pid=os.getpid())
+    cache.set(typesetting_status_key(article_id), status, TYPESETTING_TIMEOUT)
+    return status
+
+
+def typesetting_in_progress(article_id):
+    status = get_typesetting_status(article_id)
+    return bool(status) and status['state'] in ('queued', 'running')
+
+
+def queue_typesetting(galley, request):
+    """ Queues a CaSSius PDF typesetting job for a galley. Only one job runs per article at a time, asking again
+    while one is queued or running returns its status rather than starting another.
+
+    :param galley: an XML Galley
+    :param request: the current request object
+    :return: the job's status dictionary
+    """
+    article_id = galley.article_id
+
+    if typesetting_in_progress(article_id):
+        return get_typesetting_status(article_id)
+
+    status = set_typesetting_status(article_id, 'queued', galley=galley.pk, stage=None)
+
+    background.submit_once('typesetting', ('article', article_id), run_typesetting, galley.pk, request.user.pk,
+                           request.press.press_cover(request), max_workers=TYPESETTING_WORKERS, durable=True)
+
+    return status
+
+
+def run_typesetting(galley_id, owner_id, logo):
+    """ Runs a queued typesetting job, recording its progress as it goes.
+
+    :param galley_id: the pk of an XML Galley
+    :param owner_id: the pk of the Account that queued the job
+    :param logo: the path to the press logo or None
+    :return: None
+    """
+    from core import models as core_models
+
+    galley = core_models.Galley.objects.select_related('article', 'file').get(pk=galley_id)
+    driver = CassiusDriver(TYPESETTING_FOLDER, galley, owner=core_models.Account.objects.get(pk=owner_id), logo=logo)
+    article_id = galley.article_id
+
+    def progress(stage):
+        set_typesetting_status(article_id, 'running', galley=galley_id, stage=stage)
+
+    try:
+        pdf_galley = driver.transform(progress=progress)
+    except Exception as e:
+        message = '{0}: {1}'.format(type(e).__name__, e)
+        set_typesetting_status(article_id, 'failed', galley=galley_id, stage=None, message=message)
+        util_models.LogEntry.add_entry(types='Error', description='PDF typesetting failed. {0}'.format(message),
+                                       level='Error', actor=None, target=driver.article_object)
+        return
+
+    if pdf_galley:
+        set_typesetting_status(article_id, 'complete', galley=galley_id, stage=None, pdf_galley=pdf_galley.pk)
+    else:
+        set_typesetting_status(article_id, 'failed', galley=galley_id, stage=None,
+                               message='Only XML galleys can be typeset.')
+
+
+def clean_typesetting_folder(max_age=TYPESETTING_TIMEOUT):
+    """ Removes working directories left behind by typesetting jobs that died with their process.
+
+    :param max_age: the age in seconds after which a working directory is considered abandoned
+    :return: None
+    """
+    if not os.path.isdir(TYPESETTING_FOLDER):
+        return
+
+    cutoff = time.time() - max_age
+
+    for directory in os.listdir(TYPESETTING_FOLDER):
+        path = os.path.join(TYPESETTING_FOLDER, directory)
+
+        if os.path.getmtime(path) < cutoff:
+            shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,107 @@
+__copyright__ = "Copyright 2017 Birkbeck, University of London"
+__author__ = "Martin Paul Eve & Andy Byers"
+__license__ = "AGPL v3"
+__maintainer__ = "Birkbeck Centre for Technology and Publishing"
+
+import os
+import shutil
+import tempfile
+import zipfile
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+
+from core import files, models as core_models
+from journal import models as journal_models
+from submission import models as submission_models
+from transform import epub
+from utils.testing import setup
+
+
+class EpubTests(TestCase):
+
+    def setUp(self):
+        setup.create_press()
+        self.journal, _ = setup.create_journals()
+        setup.create_roles(['author'])
+        self.author = setup.create_author(self.journal)
+
+        self.issue = journal_models.Issue.objects.create(journal=self.journal, issue_title='An Issue',
+                                                         issue_description='An issue')
+        self.paths = []
+        self.galleys = [self.create_galley('Article {0}'.format(index)) for index in range(2)]
+
+        # books are written to a throwaway folder rather than files/epub
+        self.epub_folder = epub.EPUB_FOLDER
+        epub.EPUB_FOLDER = tempfile.mkdtemp()
+        cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(epub.EPUB_FOLDER, ignore_errors=True)
+        epub.EPUB_FOLDER = self.epub_folder
+
+        for path in self.paths:
+            os.remove(path)
+
+    def create_galley(self, title):
+        article = submission_models.Article.objects.create(owner=self.author, title=title, journal=self.journal,
+                                                           stage=submission_models.STAGE_PUBLISHED,
+                                                           date_published=timezone.now())
+        self.issue.articles.add(article)
+
+        html_file = core_models.File.objects.create(article_id=article.pk, mime_type='text/html',
+                                                    original_filename='article.html',
+                                                    uuid_filename='epub-test-{0}.html'.format(article.pk),
+                                                    owner=self.author, is_galley=True)
+        galley = core_models.Galley.objects.create(article=article, file=html_file, label='HTML', type='html')
+
+        path = html_file.get_file_path(article)
+        files.mkdirs(os.path.dirname(path))
+        self.paths.append(path)
+        self.write_html(galley, '<p>The first version.</p>')
+
+        return galley
+
+    @staticmethod
+    def write_html(galley, html):
+        with open(galley.file.get_file_path(galley.article), 'w') as html_file:
+            html_file.write(html)
+
+    @staticmethod
+    def book_text(path):
+        with zipfile.ZipFile(path) as book:
+            return ''.join(book.read(name).decode() for name in book.namelist() if name.endswith('article.xhtml'))
+
+    def assert_reused(self, build, path):
+        modified = os.stat(path).st_mtime_ns
+
+        self.assertEqual(build(), path)
+        self.assertEqual(os.stat(path).st_mtime_ns, modified)
+
+    def test_galley_epub_is_reused_until_its_render_changes(self):
+        galley = self.galleys[0]
+        path = epub.get_galley_epub(galley)
+
+        self.assertIn('The first version.', self.book_text(path))
+        self.assert_reused(lambda: epub.get_galley_epub(galley), path)
+
+        self.write_html(galley, '<p>A revised version of the article.</p>')
+        new_path = epub.get_galley_epub(galley)
+
+        self.assertNotEqual(new_path, path)
+        self.assertIn('A revised version of the article.', self.book_text(new_path))
+        self.assertFalse(os.path.isfile(path), 'The previous version of the book should have been removed.')
+
+    def test_issue_epub_is_rebuilt_when_one_of_its_articles_changes(self):
+        path = epub.get_issue_epub(self.issue)
+
+        self.assertEqual(self.book_text(path).count('The first version.'), 2)
+        self.assert_reused(lambda: epub.get_issue_epub(self.issue), path)
+
+        self.write_html(self.galleys[1], '<p>A revised version of the article.</p>')
+        new_path = epub.get_issue_epub(self.issue)
+
+        self.assertNotEqual(new_path, path)
+        self.assertIn('A revised version of the article.', self.book_text(new_path))
+        self.assertIn('The first version.', self.book_text(new_path))
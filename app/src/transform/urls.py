@@ -9,6 +9,8 @@ from transform import views
 urlpatterns = [
     url(r'^galley/(?P<galley_id>.+?)/generate-pdf/$', views.cassius_generate,
         name='cassius_generate'),
+    url(r'^galley/(?P<galley_id>.+?)/generate-pdf/status/$', views.cassius_status,
+        name='cassius_status'),
 
     url(r'^galley/(?P<galley_id>.+?)/generate-epub/$', views.epub_generate,
         name='epub_generate'),
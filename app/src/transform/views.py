@@ -4,17 +4,16 @@ __license__ = "AGPL v3"
 __maintainer__ = "Birkbeck Centre for Technology and Publishing"
 
 
-import os
+import json
 
-from django.conf import settings
+from django.contrib import messages
 from django.contrib.auth.decorators import login_required
+from django.http import HttpResponse
 from django.shortcuts import get_object_or_404, redirect
 
 from core import models as core_models
 from security.decorators import typesetting_user_or_production_user_or_editor_required, has_request
-from transform.logic import CassiusDriver
-
-from transform import epub
+from transform import epub, logic
 
 
 @login_required
@@ -24,14 +23,27 @@ def cassius_generate(request, galley_id):
 
     galley = get_object_or_404(core_models.Galley, pk=galley_id)
 
-    temporary_directory = os.path.join(settings.BASE_DIR, 'files', 'temp')
-
-    driver = CassiusDriver(temporary_directory, galley, request)
-    driver.transform()
+    if logic.typesetting_in_progress(galley.article_id):
+        messages.add_message(request, messages.INFO, 'A PDF is already being generated for this article.')
+    else:
+        logic.queue_typesetting(galley, request)
+        messages.add_message(request, messages.SUCCESS, 'PDF generation has been queued, the new galley will appear '
+                                                        'here when it is ready.')
 
     return redirect(request.GET['return'])
 
 
+@login_required
+@has_request
+@typesetting_user_or_production_user_or_editor_required
+def cassius_status(request, galley_id):
+
+    galley = get_object_or_404(core_models.Galley, pk=galley_id)
+    status = logic.get_typesetting_status(galley.article_id) or {'state': None}
+
+    return HttpResponse(json.dumps(status), content_type="application/json")
+
+
 @login_required
 @has_request
 @typesetting_user_or_production_user_or_editor_required
@@ -0,0 +1,279 @@
+__copyright__ = "Copyright 2017 Birkbeck, University of London"
+__author__ = "Martin Paul Eve & Andy Byers"
+__license__ = "AGPL v3"
+__maintainer__ = "Birkbeck Centre for Technology and Publishing"
+
+import fcntl
+import hashlib
+import importlib
+import json
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+from django.conf import settings
+from django.db import close_old_connections
+
+# durable jobs are recorded here until they finish so that work lost with its process can be run by run_jobs()
+JOB_FOLDER = os.path.join(settings.BASE_DIR, 'files', 'temp', 'jobs')
+# how long a recorded job may wait in its pool before run_jobs() assumes its process has gone, jobs recorded by a
+# process on this host that has exited are run straight away
+JOB_GRACE_SECONDS = 15 * 60
+MAX_JOB_ATTEMPTS = 3
+
+# Named, bounded worker pools for work that should happen outside of the request/response cycle.
+_pools = {}
+_in_flight = {}
+_lock = threading.RLock()
+
+
+def get_pool(name, max_workers=2):
+    """ Returns the named worker pool, creating it on first use.
+
+    :param name: the name of the pool, eg. 'images' or 'render'
+    :param max_workers: the number of worker threads the pool may use, only applied when the pool is created
+    :return: a ThreadPoolExecutor
+    """
+    with _lock:
+        pool = _pools.get(name)
+
+        if pool is None:
+            pool = ThreadPoolExecutor(max_workers=max_workers)
+            _pools[name] = pool
+
+        return pool
+
+
+def _run(func, args, kwargs, job_path=None):
+    # worker threads open their own database connections, make sure they are not left dangling
+    close_old_connections()
+    try:
+        if job_path is None:
+            return func(*args, **kwargs)
+
+        return _run_recorded(job_path, lambda job: func(*args, **kwargs))
+    finally:
+        close_old_connections()
+
+
+def process_alive(host, pid):
+    """ Tells whether the process that recorded a job or status is still running. Processes on other hosts cannot
+    be checked and are assumed to be running.
+
+    :param host: the hostname recorded along with the pid
+    :param pid: the process id, or None if none was recorded
+    :return: a boolean
+    """
+    if pid is None or host != socket.gethostname():
+        return True
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def job_path(name, key):
+    digest = hashlib.sha1(json.dumps([name, key]).encode('utf-8')).hexdigest()
+    return os.path.join(JOB_FOLDER, '{0}-{1}.json'.format(name, digest))
+
+
+def record_job(name, key, func, *args, **kwargs):
+    """ Records a job on disk so that it can be run by run_jobs() if the process that queued it goes away before it
+    has finished. Recording the same name and key again replaces the earlier record.
+
+    :param name: the name of the pool
+    :param key: a JSON serialisable key identifying the job
+    :param func: a module level function
+    :param args: JSON serialisable positional arguments
+    :param kwargs: JSON serialisable keyword arguments
+    :return: the path of the record
+    """
+    function_path = '{0}.{1}'.format(func.__module__, func.__qualname__)
+
+    if '<locals>' in function_path:
+        raise ValueError('Only module level functions can be recorded, not {0}.'.format(function_path))
+
+    record = json.dumps({'name': name, 'key': key, 'function': function_path, 'args': args, 'kwargs': kwargs,
+                         'attempts': 0, 'queued': time.time(), 'host': socket.gethostname(), 'pid': os.getpid()})
+
+    os.makedirs(JOB_FOLDER, exist_ok=True)
+    path = job_path(name, key)
+    temp_path = '{0}.{1}.tmp'.format(path, uuid4())
+
+    with open(temp_path, 'w') as record_file:
+        record_file.write(record)
+    os.replace(temp_path, path)
+
+    return path
+
+
+def forget_job(name, key):
+    """ Removes the record of a job that has finished outside of the worker pools.
+
+    :param name: the name of the pool
+    :param key: the key the job was recorded with
+    :return: None
+    """
+    try:
+        os.unlink(job_path(name, key))
+    except FileNotFoundError:
+        pass
+
+
+def _run_recorded(path, run):
+    """ Runs a recorded job while holding a lock on its record, then removes the record. A record that has gone or
+    is locked has already been run, or is being run, elsewhere. A job that fails keeps its record to be retried.
+
+    :param path: the path of the job's record
+    :param run: a function called with the job's record
+    :return: the job's return value, or None if it was not run
+    """
+    try:
+        record_file = open(path, 'r+')
+    except FileNotFoundError:
+        return None
+
+    with record_file:
+        try:
+            fcntl.flock(record_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+
+        # the record may have been run and removed, or replaced by a new one, before the lock was taken
+        try:
+            if os.stat(path).st_ino != os.fstat(record_file.fileno()).st_ino:
+                return None
+        except FileNotFoundError:
+            return None
+
+        job = json.load(record_file)
+        result = run(job)
+        os.unlink(path)
+
+        return result
+
+
+def submit(name, func, *args, max_workers=2, durable=False, **kwargs):
+    """ Runs a function in the named worker pool.
+
+    :param name: the name of the pool
+    :param func: the function to run
+    :param max_workers: the size of the pool if it has not yet been created
+    :param durable: record the job so that it is run by run_jobs() if this process goes away before it has finished,
+    func must then be a module level function and its arguments JSON serialisable
+    :return: a Future
+    """
+    path = record_job(name, str(uuid4()), func, *args, **kwargs) if durable else None
+    return get_pool(name, max_workers=max_workers).submit(_run, func, args, kwargs, path)
+
+
+def submit_once(name, key, func, *args, max_workers=2, durable=False, **kwargs):
+    """ Runs a function in the named worker pool unless a job with the same key is already queued or running, in
+    which case the existing job's Future is returned.
+
+    :param name: the name of the pool
+    :param key: a hashable identifying the job, eg. ('galley', 12)
+    :param func: the function to run
+    :param max_workers: the size of the pool if it has not yet been created
+    :param durable: record the job, see submit()
+    :return: a Future
+    """
+    with _lock:
+        future = _in_flight.get((name, key))
+
+        if future is None:
+            path = record_job(name, key, func, *args, **kwargs) if durable else None
+            future = get_pool(name, max_workers=max_workers).submit(_run, func, args, kwargs, path)
+            _in_flight[(name, key)] = future
+            future.add_done_callback(lambda done: _forget(name, key, done))
+
+        return future
+
+
+def in_flight(name, key):
+    """ Returns the Future for a queued or running job, or None.
+
+    :param name: the name of the pool
+    :param key: the key the job was submitted with
+    :return: a Future or None
+    """
+    with _lock:
+        return _in_flight.get((name, key))
+
+
+def _forget(name, key, future):
+    with _lock:
+        if _in_flight.get((name, key)) is future:
+            del _in_flight[(name, key)]
+
+
+def run_job(job):
+    module_name, _, function_name = job['function'].rpartition('.')
+    func = getattr(importlib.import_module(module_name), function_name)
+    return func(*job['args'], **job['kwargs'])
+
+
+def job_lost(path):
+    """ Tells whether a recorded job was queued by a process on this host that has since exited.
+
+    :param path: the path of the job's record
+    :return: a boolean
+    """
+    try:
+        with open(path, 'r') as record_file:
+            job = json.load(record_file)
+    except (FileNotFoundError, ValueError):
+        return False
+
+    return not process_alive(job.get('host'), job.get('pid'))
+
+
+def run_jobs(grace=JOB_GRACE_SECONDS):
+    """ Runs recorded jobs that have waited longer than the grace period, or whose process has exited, which means
+    the process that queued them stopped before finishing them. Jobs still running elsewhere are skipped, jobs that
+    keep failing are dropped after MAX_JOB_ATTEMPTS.
+
+    :param grace: the age in seconds after which a recorded job is assumed to have been lost
+    :return: the number of jobs run
+    """
+    if not os.path.isdir(JOB_FOLDER):
+        return 0
+
+    cutoff = time.time() - grace
+    ran = 0
+
+    def attempt(job):
+        job['attempts'] += 1
+
+        if job['attempts'] > MAX_JOB_ATTEMPTS:
+            print('Dropping {0} job {1} after {2} attempts.'.format(job['name'], job['key'], MAX_JOB_ATTEMPTS))
+            return False
+
+        # count the attempt before running so that a job that takes its process down is not retried forever
+        with open(path, 'w') as record_file:
+            json.dump(job, record_file)
+
+        run_job(job)
+        return True
+
+    for name in sorted(os.listdir(JOB_FOLDER)):
+        path = os.path.join(JOB_FOLDER, name)
+
+        if not name.endswith('.json') or (os.path.getmtime(path) > cutoff and not job_lost(path)):
+            continue
+
+        try:
+            if _run_recorded(path, attempt):
+                ran += 1
+        except Exception as e:
+            print('Unable to run background job {0}: {1}'.format(name, e))
+
+    return ran
@@ -3,24 +3,462 @@ __author__ = "Martin Paul Eve & Andy Byers"
 __license__ = "AGPL v3"
 __maintainer__ = "Birkbeck Centre for Technology and Publishing"
 
-
+import datetime
+import functools
+import math
+import random
+import threading
+import time
+from collections import Counter, OrderedDict
 from hashlib import sha1
 
 from django.core.cache import cache as django_cache
+from django.db import transaction
+from django.db.models import Model
+from django.db.models.query import QuerySet
+
+MISSING = object()
+
+# how long one worker may hold the right to compute a missing value, and how long others wait for it before
+# computing it themselves
+LOCK_SECONDS = 30
+WAIT_SECONDS = 1
+WAIT_INTERVAL = 0.05
+
+# higher values refresh entries earlier, see should_refresh()
+EARLY_REFRESH_BETA = 1.0
+
+# how often each process adds its hit and miss counts to the shared totals
+STATS_FLUSH_SECONDS = 60
+STATS_COUNTERS = ('hits', 'misses', 'refreshes', 'waits', 'local_hits', 'local_misses', 'evictions')
+
+# the in-process cache in front of the shared one for functions decorated with local=True, see NearCache
+LOCAL_SECONDS = 5
+LOCAL_MAX_ENTRIES = 5000
+# how often each process checks whether another has invalidated anything
+LOCAL_SYNC_SECONDS = 1
+LOCAL_GENERATION_KEY = 'function_cache_local_generation'
+
+# every decorated function by namespace
+registry = {}
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+_stats_flushed = time.time()
+# counts for the current request when it is being instrumented, see collect()
+_collector = threading.local()
+
+
+class NONE(object):
+    """ Stored in place of None by functions decorated with cache_none=True, so that a None result is a hit rather
+    than a miss. The class itself is stored, and unpickles as the same object, so it is compared with is.
+    """
+
+
+class NearCache(object):
+    """ A bounded, least recently used cache of unpickled values kept in this process. Values are shared between
+    callers rather than copied, so callers must not change them. Entries only live for a few seconds, and the whole
+    cache is dropped when any process invalidates a tag, see sync_local().
+    """
+
+    def __init__(self, max_entries=LOCAL_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = None
+        self.synced = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                return MISSING
+
+            value, expires, namespace = entry
+
+            if expires < time.time():
+                del self.entries[key]
+                return MISSING
+
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, seconds, namespace):
+        evicted = []
+
+        with self.lock:
+            self.entries[key] = (value, time.time() + seconds, namespace)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                evicted.append(self.entries.popitem(last=False)[1][2])
+
+        for evicted_namespace in evicted:
+            if evicted_namespace:
+                record(evicted_namespace, 'evictions')
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+_near = NearCache()
+
+
+def sync_local():
+    """ Drops this process's near cache if another process has invalidated a tag since it was last checked. Checks
+    at most once every LOCAL_SYNC_SECONDS, which bounds how long another process's invalidation goes unseen.
+
+    :return: None
+    """
+    now = time.time()
+
+    if now - _near.synced < LOCAL_SYNC_SECONDS:
+        return
+
+    _near.synced = now
+    generation = django_cache.get(LOCAL_GENERATION_KEY)
+
+    if generation != _near.generation:
+        _near.clear()
+        _near.generation = generation
+
+
+def key_part(value):
+    """ Turns an argument into something with an unambiguous, stable repr. Model instances are identified by their
+    model and pk rather than by str(), which for many models is a name that more than one object can share.
+
+    :param value: a function argument
+    :return: a string, or a tuple of key parts
+    """
+    if value is None or isinstance(value, (bool, int, float, str, bytes)):
+        return repr(value)
+
+    if isinstance(value, Model):
+        return 'model', value._meta.label_lower, repr(value.pk)
+
+    if isinstance(value, QuerySet):
+        return 'queryset', value.model._meta.label_lower, str(value.query)
+
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__,) + tuple(key_part(item) for item in value)
+
+    if isinstance(value, (set, frozenset)):
+        return ('set',) + tuple(sorted((key_part(item) for item in value), key=repr))
+
+    if isinstance(value, dict):
+        return ('dict',) + tuple(sorted(((key_part(name), key_part(item)) for name, item in value.items()), key=repr))
+
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return type(value).__name__, value.isoformat()
+
+    if hasattr(value, 'cache_key'):
+        return 'object', value.cache_key()
+
+    return type(value).__name__, str(value)
+
+
+def make_key(namespace, parts):
+    return 'function_cache:{0}:{1}'.format(namespace, sha1(repr(key_part(parts)).encode('utf-8')).hexdigest())
+
+
+def tag(kind, obj=None):
+    """ Names a group of cache entries that are invalidated together, eg. tag('article', article) or
+    tag('settings', journal). Entries belonging to the press rather than a journal are tagged with obj None.
+
+    :param kind: a string, eg. 'journal', 'article' or 'settings'
+    :param obj: a model instance, a pk or None
+    :return: a string
+    """
+    if isinstance(obj, Model):
+        obj = obj.pk
+
+    return '{0}:{1}'.format(kind, 'press' if obj is None else obj)
+
+
+def article_tags(article):
+    """ The tags of entries that depend on an article, including identifier lookups that may resolve to it.
+
+    :param article: an Article object
+    :return: a list of tags
+    """
+    return [tag('article', article), tag('identifiers', article.journal_id)]
+
+
+def generation_key(name):
+    return 'function_cache_tag:{0}'.format(name)
+
+
+def generations(tags, local=False):
+    """ Looks up the current generation of each tag, starting any that are missing. A tag evicted from the cache
+    restarts from the current time rather than 0 so that entries from before the eviction are not used again.
+
+    :param tags: a list of tags from tag()
+    :param local: look in this process's near cache first
+    :return: a tuple of generations, in the order of the tags
+    """
+    if not tags:
+        return ()
+
+    keys = [generation_key(name) for name in tags]
+    found = {}
+
+    if local:
+        for key in keys:
+            generation = _near.get(key)
+            if generation is not MISSING:
+                found[key] = generation
+
+    missing = [key for key in keys if key not in found]
+
+    if missing:
+        found.update(django_cache.get_many(missing))
+
+        for key in missing:
+            if key not in found:
+                django_cache.add(key, int(time.time() * 1000), None)
+                found[key] = django_cache.get(key)
 
+            if local:
+                _near.set(key, found[key], LOCAL_SECONDS, None)
 
-def cache(seconds=900):
+    return tuple(found[key] for key in keys)
+
+
+def invalidate_tags(*tags):
+    """ Invalidates every cached entry with any of the tags, in every process, once the current transaction has
+    committed. Entries are not deleted, they stop being looked up and expire.
+
+    :param tags: tags from tag()
+    :return: None
+    """
+    transaction.on_commit(lambda: bump_tags(*tags))
+
+
+def bump_tags(*tags):
+    for key in [generation_key(name) for name in tags] + [LOCAL_GENERATION_KEY]:
+        try:
+            django_cache.incr(key)
+        except ValueError:
+            django_cache.set(key, int(time.time() * 1000), None)
+
+    _near.clear()
+
+
+def collect():
+    """ Starts counting this thread's cache hits and misses, eg. for the request it is handling.
+
+    :return: a Counter of (namespace, counter) to count that fills until stop_collecting() is called
+    """
+    _collector.counts = Counter()
+    return _collector.counts
+
+
+def stop_collecting():
+    _collector.counts = None
+
+
+def record(namespace, counter):
+    global _stats_flushed
+
+    counts = getattr(_collector, 'counts', None)
+    if counts is not None:
+        counts[namespace, counter] += 1
+
+    with _stats_lock:
+        _stats[namespace, counter] += 1
+
+        if time.time() - _stats_flushed < STATS_FLUSH_SECONDS:
+            return
+
+        counts = dict(_stats)
+        _stats.clear()
+        _stats_flushed = time.time()
+
+    flush_stats(counts)
+
+
+def stats_key(namespace, counter):
+    return 'function_cache_stats:{0}:{1}'.format(namespace, counter)
+
+
+def flush_stats(counts=None):
+    """ Adds this process's counts to the totals shared by every process.
+
+    :param counts: a dictionary of (namespace, counter) to count, by default everything counted since the last flush
+    :return: None
+    """
+    global _stats_flushed
+
+    if counts is None:
+        with _stats_lock:
+            counts = dict(_stats)
+            _stats.clear()
+            _stats_flushed = time.time()
+
+    for (namespace, counter), count in counts.items():
+        key = stats_key(namespace, counter)
+
+        if not django_cache.add(key, count, None):
+            try:
+                django_cache.incr(key, count)
+            except ValueError:
+                django_cache.set(key, count, None)
+
+
+def shared_stats(namespaces=None):
+    """ Returns the hit and miss totals of every process since they were last reset.
+
+    :param namespaces: optional, the namespaces to report, by default every registered function
+    :return: a dictionary of namespace to a dictionary of counter to count
+    """
+    namespaces = sorted(namespaces or registry.keys())
+    keys = {stats_key(namespace, counter): (namespace, counter)
+            for namespace in namespaces for counter in STATS_COUNTERS}
+    found = django_cache.get_many(list(keys.keys()))
+    totals = {namespace: dict.fromkeys(STATS_COUNTERS, 0) for namespace in namespaces}
+
+    for key, count in found.items():
+        namespace, counter = keys[key]
+        totals[namespace][counter] = count
+
+    return totals
+
+
+def reset_stats(namespaces=None):
+    django_cache.delete_many([stats_key(namespace, counter)
+                              for namespace in (namespaces or registry.keys()) for counter in STATS_COUNTERS])
+
+
+def should_refresh(expires, duration):
+    """ Probabilistic early refresh: as an entry nears expiry each reader has a growing chance of recomputing it, so
+    that usually a single worker refreshes it before it expires rather than all of them at once afterwards. Entries
+    that take longer to compute are refreshed earlier.
+
+    :param expires: the timestamp the entry expires at
+    :param duration: the seconds the entry took to compute
+    :return: True if this reader should recompute the entry
+    """
+    return time.time() - duration * EARLY_REFRESH_BETA * math.log(1 - random.random()) >= expires
+
+
+def cache(seconds=900, key=None, namespace=None, cache_none=False, early_refresh=True, tags=None, local=False):
+    """ Caches the results of a function in the Django cache.
+
+    :param seconds: how long results are cached for
+    :param key: optional, a function taking the same arguments as the decorated function and returning what identifies
+    a result, eg. lambda self, journal: journal.pk. By default every argument is used, see key_part()
+    :param namespace: the prefix of the function's cache keys, by default its module and qualified name
+    :param cache_none: cache None results rather than calling the function again each time, for functions where
+    None is a common answer that is as expensive to find as any other
+    :param early_refresh: refresh entries shortly before they expire, see should_refresh()
+    :param tags: optional, a list of tags from tag() or a function taking the same arguments as the decorated function
+    and returning one. Results are invalidated when any of their tags is, see invalidate_tags()
+    :param local: also keep results in this process for LOCAL_SECONDS, for values read many times a request. The
+    results are shared between callers and must not be changed, see NearCache
+    :return: a decorator
+    """
 
     def do_cache(f):
-        def y(*args, **kwargs):
-            f_module = f.__module__.encode('utf-8')
-            f_name = f.__name__.encode('utf-8')
-            key = sha1(f_module + f_name + str(args).encode('UTF-8') + str(kwargs).encode('UTF-8')).hexdigest()
-            result = django_cache.get(key)
-            if result is None:
-                result = f(*args, **kwargs)
-                django_cache.set(key, result, seconds)
+        function_namespace = namespace or '{0}.{1}'.format(f.__module__, f.__qualname__)
+
+        def cache_key(*args, **kwargs):
+            parts = key(*args, **kwargs) if key else (args, kwargs)
+            entry_tags = tags(*args, **kwargs) if callable(tags) else tags
+            return make_key(function_namespace, (parts, generations(list(entry_tags or []), local=local)))
+
+        def compute(entry_key, args, kwargs):
+            start = time.time()
+            result = f(*args, **kwargs)
+            duration = time.time() - start
+
+            if result is not None or cache_none:
+                stored = NONE if result is None else result
+                django_cache.set(entry_key, (stored, time.time() + seconds, duration), seconds)
 
             return result
+
+        @functools.wraps(f)
+        def y(*args, **kwargs):
+            if not local:
+                return lookup(cache_key(*args, **kwargs), args, kwargs)
+
+            sync_local()
+            entry_key = cache_key(*args, **kwargs)
+            value = _near.get(entry_key)
+
+            if value is not MISSING:
+                record(function_namespace, 'local_hits')
+                return None if value is NONE else value
+
+            record(function_namespace, 'local_misses')
+            value = lookup(entry_key, args, kwargs)
+
+            if value is not None or cache_none:
+                _near.set(entry_key, NONE if value is None else value, min(LOCAL_SECONDS, seconds), function_namespace)
+
+            return value
+
+        def lookup(entry_key, args, kwargs):
+            entry = django_cache.get(entry_key, MISSING)
+
+            if entry is MISSING:
+                record(function_namespace, 'misses')
+                return fill(entry_key, args, kwargs)
+
+            record(function_namespace, 'hits')
+            stored, expires, duration = entry
+
+            # only the reader that wins the lock refreshes, the rest carry on with the current value
+            if early_refresh and should_refresh(expires, duration) and django_cache.add(
+                    entry_key + ':lock', 1, LOCK_SECONDS):
+                record(function_namespace, 'refreshes')
+                try:
+                    return compute(entry_key, args, kwargs)
+                finally:
+                    django_cache.delete(entry_key + ':lock')
+
+            return None if stored is NONE else stored
+
+        def fill(entry_key, args, kwargs):
+            # single flight: one worker computes a missing value while others wait a little for it to appear
+            if django_cache.add(entry_key + ':lock', 1, LOCK_SECONDS):
+                try:
+                    return compute(entry_key, args, kwargs)
+                finally:
+                    django_cache.delete(entry_key + ':lock')
+
+            record(function_namespace, 'waits')
+            waited = 0
+
+            while waited < WAIT_SECONDS:
+                time.sleep(WAIT_INTERVAL)
+                waited += WAIT_INTERVAL
+                entry = django_cache.get(entry_key, MISSING)
+
+                if entry is not MISSING:
+                    return None if entry[0] is NONE else entry[0]
+
+            return compute(entry_key, args, kwargs)
+
+        def invalidate(*args, **kwargs):
+            """ Removes the cached result for these arguments. """
+            entry_key = cache_key(*args, **kwargs)
+            django_cache.delete(entry_key)
+            _near.delete(entry_key)
+
+        y.namespace = function_namespace
+        y.cache_key = cache_key
+        y.invalidate = invalidate
+        registry[function_namespace] = y
         return y
+
     return do_cache
@@ -0,0 +1,78 @@
+import time
+import tracemalloc
+
+import magic
+
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.core.management.base import BaseCommand
+
+from core import files
+
+PDF_HEADER = b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n1 0 obj\n<< /Type /Catalog >>\nendobj\n'
+
+
+class Command(BaseCommand):
+    """ Benchmarks MIME detection of large uploads, reporting the peak memory used for each upload size."""
+
+    help = "Benchmarks MIME sniffing of large uploads and reports peak memory per upload size."
+
+    def add_arguments(self, parser):
+        """Adds arguments to Django's management command-line parser.
+
+        :param parser: the parser to which the required arguments will be added
+        :return: None
+        """
+        parser.add_argument('--sizes', default='1,50,500',
+                            help='Comma separated list of upload sizes in MB.')
+        parser.add_argument('--legacy', action='store_true', default=False,
+                            help='Also measure the old approach of reading the whole upload into memory.')
+
+    def handle(self, *args, **options):
+        """ Builds a sparse upload for each size and measures check_in_memory_mime against it.
+
+        :param args: None
+        :param options: Dictionary containing 'sizes' and 'legacy'
+        :return: None
+        """
+        sizes = [int(size) for size in options.get('sizes').split(',')]
+
+        print('{0:>10} {1:>20} {2:>12} {3:>14}'.format('Size (MB)', 'Method', 'Time (ms)', 'Peak (KB)'))
+
+        for size in sizes:
+            upload = self.build_upload(size)
+
+            try:
+                self.measure(size, 'header sniff', files.check_in_memory_mime, upload)
+
+                if options.get('legacy'):
+                    self.measure(size, 'full read', self.legacy_mime, upload)
+            finally:
+                upload.close()
+
+    @staticmethod
+    def build_upload(size):
+        upload = TemporaryUploadedFile('benchmark.pdf', 'application/pdf', size * 1024 * 1024, None)
+        upload.write(PDF_HEADER)
+        upload.truncate(size * 1024 * 1024)
+        upload.seek(0)
+
+        return upload
+
+    @staticmethod
+    def legacy_mime(upload):
+        upload.seek(0)
+        return magic.from_buffer(upload.read(), mime=True)
+
+    @staticmethod
+    def measure(size, method, function, upload):
+        files._mime_cache.clear()
+        tracemalloc.start()
+        start = time.time()
+
+        detected = function(upload)
+
+        elapsed = (time.time() - start) * 1000
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print('{0:>10} {1:>20} {2:>12.2f} {3:>14.1f}   {4}'.format(size, method, elapsed, peak / 1024, detected))
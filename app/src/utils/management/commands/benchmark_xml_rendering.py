@@ -0,0 +1,119 @@
+import multiprocessing
+import os
+import re
+import resource
+import time
+import tracemalloc
+
+from bs4 import BeautifulSoup
+from lxml import etree
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core import files
+
+
+class Command(BaseCommand):
+    """ Benchmarks parsing and transforming JATS files, reporting time and peak memory for each file."""
+
+    help = "Benchmarks parse and XSLT transform of a corpus of JATS files and reports time and peak memory."
+
+    def add_arguments(self, parser):
+        """Adds arguments to Django's management command-line parser.
+
+        :param parser: the parser to which the required arguments will be added
+        :return: None
+        """
+        parser.add_argument('corpus', help='A folder of JATS XML files, or a single XML file.')
+        parser.add_argument('--xsl', default=os.path.join(settings.BASE_DIR, 'transform', 'xsl', 'article.xsl'),
+                            help='The XSLT to transform with, defaults to the Janeway article.xsl.')
+        parser.add_argument('--legacy', action='store_true', default=False,
+                            help='Also measure the old BeautifulSoup round trip.')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='Number of timed runs per file, the fastest is reported.')
+
+    def handle(self, *args, **options):
+        """ Measures each file in its own process so that peak memory figures are not polluted by earlier files.
+
+        :param args: None
+        :param options: Dictionary containing 'corpus', 'xsl', 'legacy' and 'repeat'
+        :return: None
+        """
+        corpus = options.get('corpus')
+
+        if os.path.isdir(corpus):
+            paths = sorted(os.path.join(corpus, name) for name in os.listdir(corpus) if name.endswith('.xml'))
+        else:
+            paths = [corpus]
+
+        methods = [('lxml', self.direct)]
+
+        if options.get('legacy'):
+            methods.append(('bs4 round trip', self.legacy))
+
+        print('{0:<40} {1:>10} {2:>16} {3:>12} {4:>14} {5:>14}'.format('File', 'Size (KB)', 'Method', 'Time (ms)',
+                                                                       'Python (KB)', 'RSS (KB)'))
+
+        totals = {}
+
+        for path in paths:
+            for method, function in methods:
+                elapsed, python_peak, rss_peak = self.measure(function, path, options.get('xsl'),
+                                                              options.get('repeat'))
+                totals.setdefault(method, [0, 0])
+                totals[method][0] += elapsed
+                totals[method][1] = max(totals[method][1], rss_peak)
+
+                print('{0:<40} {1:>10.1f} {2:>16} {3:>12.2f} {4:>14.1f} {5:>14.1f}'.format(
+                    os.path.basename(path)[:40], os.path.getsize(path) / 1024, method, elapsed, python_peak, rss_peak))
+
+        for method, (elapsed, rss_peak) in totals.items():
+            print('{0}: {1:.2f}ms total, {2:.1f}KB largest RSS growth'.format(method, elapsed, rss_peak))
+
+    @staticmethod
+    def direct(path, xsl_path):
+        return files.get_xslt_transform(xsl_path)(files.parse_xml(path))
+
+    @staticmethod
+    def legacy(path, xsl_path):
+        with open(path, "rb") as xml_file_contents:
+            xml = BeautifulSoup(xml_file_contents, "lxml-xml")
+            transform = files.get_xslt_transform(xsl_path)
+            regex = re.compile(r'<\?xml version="1.0" encoding=".+"\?>')
+            xml_string = re.sub(regex, '', str(xml), count=1)
+
+            return transform(etree.XML(xml_string))
+
+    def measure(self, function, path, xsl_path, repeat):
+        # warm the XSLT cache so that only parsing and transforming are measured
+        files.get_xslt_transform(xsl_path)
+
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=self.run, args=(sender, function, path, xsl_path, repeat))
+        process.start()
+        result = receiver.recv()
+        process.join()
+
+        return result
+
+    @staticmethod
+    def run(sender, function, path, xsl_path, repeat):
+        # libxml2 allocates outside of the Python heap, so resident memory growth is reported alongside tracemalloc
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        tracemalloc.start()
+        function(path, xsl_path)
+        current, python_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+
+        timings = []
+        for i in range(repeat):
+            start = time.time()
+            function(path, xsl_path)
+            timings.append((time.time() - start) * 1000)
+
+        sender.send((min(timings), python_peak / 1024, rss_peak))
+        sender.close()
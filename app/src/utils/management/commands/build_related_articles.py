@@ -0,0 +1,39 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from journal import models as journal_models
+from search import related
+
+
+class Command(BaseCommand):
+    """ Computes the related articles shown on article pages."""
+
+    help = "Computes related articles for each journal from TF-IDF vectors of keywords, abstracts and extracted " \
+           "text. Newly published articles are added as they are published, run this nightly to refresh the rest."
+
+    def add_arguments(self, parser):
+        """Adds arguments to Django's management command-line parser.
+
+        :param parser: the parser to which the required arguments will be added
+        :return: None
+        """
+        parser.add_argument('--journal_code', default=None)
+
+    def handle(self, *args, **options):
+        """ Rebuilds related articles for every journal, or the one given.
+
+        :param args: None
+        :param options: Dictionary of the arguments above
+        :return: None
+        """
+        journals = journal_models.Journal.objects.all()
+
+        if options.get('journal_code'):
+            journals = journals.filter(code=options.get('journal_code'))
+
+        for journal in journals:
+            start = time.time()
+            count = related.build_related(journal.pk)
+            print('{0}: related articles computed for {1} articles in {2:.1f}s.'.format(
+                journal.code, count, time.time() - start))
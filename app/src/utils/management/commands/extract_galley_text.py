@@ -0,0 +1,84 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from core import models as core_models, renders
+from search import extraction
+
+
+class Command(BaseCommand):
+    """ Extracts and stores the plain text of XML, HTML and PDF galleys in parallel."""
+
+    help = "Extracts the text of galleys across a pool of worker processes for search and related articles. " \
+           "Galleys whose current version is already stored are skipped, so an interrupted run can simply be " \
+           "started again."
+
+    def add_arguments(self, parser):
+        """Adds arguments to Django's management command-line parser.
+
+        :param parser: the parser to which the required arguments will be added
+        :return: None
+        """
+        parser.add_argument('--journal_code', default=None)
+        parser.add_argument('--preprints', action='store_true', default=False,
+                            help='Extract the galleys of preprints instead of journal articles.')
+        parser.add_argument('--workers', default=os.cpu_count(), type=int)
+        parser.add_argument('--force', action='store_true', default=False,
+                            help='Extract galleys even if their current version is already stored.')
+
+    def handle(self, *args, **options):
+        """ Extracts each matching galley in a worker process.
+
+        :param args: None
+        :param options: Dictionary of the arguments above
+        :return: None
+        """
+        galleys = core_models.Galley.objects.filter(
+            file__mime_type__in=renders.XML_MIMETYPES + extraction.HTML_MIMETYPES + extraction.PDF_MIMETYPES,
+            article__is_preprint=options.get('preprints'),
+        )
+
+        if options.get('journal_code'):
+            galleys = galleys.filter(article__journal__code=options.get('journal_code'))
+
+        galley_ids = list(galleys.order_by('pk').values_list('pk', flat=True))
+        print('{0} galleys to check.'.format(len(galley_ids)))
+
+        if not galley_ids:
+            return
+
+        # worker processes are forked, they must open their own database connections rather than share ours
+        connections.close_all()
+
+        extracted, skipped, failures = 0, 0, []
+        start = time.time()
+
+        with ProcessPoolExecutor(max_workers=options.get('workers')) as executor:
+            futures = [executor.submit(extraction.extract_galley, galley_id, options.get('force'))
+                       for galley_id in galley_ids]
+
+            for count, future in enumerate(as_completed(futures), 1):
+                galley_id, seconds, was_extracted, error = future.result()
+
+                if error:
+                    failures.append((galley_id, error))
+                elif was_extracted:
+                    extracted += 1
+                else:
+                    skipped += 1
+
+                if count % 100 == 0:
+                    print('{0}/{1} galleys, {2:.1f} per second'.format(count, len(galley_ids),
+                                                                       count / (time.time() - start)))
+
+        print('Extracted {0}, skipped {1} already current, {2} failed in {3:.1f}s.'.format(
+            extracted, skipped, len(failures), time.time() - start))
+
+        for galley_id, error in failures:
+            print('    galley {0}: {1}'.format(galley_id, error))
+
+        if extracted:
+            print('Run rebuild_search_index to add the new text to the search index.')
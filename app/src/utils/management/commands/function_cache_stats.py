@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+
+from utils import function_cache
+
+
+class Command(BaseCommand):
+    """ Reports the hit rates of cached functions across every process."""
+
+    help = "Prints the shared and in-process hits, misses and hit rates of each cached function since the counts " \
+           "were last reset. Processes add their counts every minute, so recent activity may not show yet."
+
+    def add_arguments(self, parser):
+        """Adds arguments to Django's management command-line parser.
+
+        :param parser: the parser to which the required arguments will be added
+        :return: None
+        """
+        parser.add_argument('--reset', action='store_true', default=False,
+                            help='Reset the counts after printing them.')
+
+    def handle(self, *args, **options):
+        """ Prints a line per cached function, busiest first.
+
+        :param args: None
+        :param options: Dictionary of the arguments above
+        :return: None
+        """
+        function_cache.flush_stats()
+        totals = function_cache.shared_stats()
+        rows = sorted(totals.items(),
+                      key=lambda row: -(row[1]['hits'] + row[1]['misses'] + row[1]['local_hits']))
+
+        line = '{0:<70} {1:>10} {2:>10} {3:>8} {4:>10} {5:>8} {6:>12} {7:>12} {8:>10}'
+        print(line.format('Function', 'Hits', 'Misses', 'Rate', 'Refreshes', 'Waits', 'Local hits', 'Local rate',
+                          'Evictions'))
+
+        for namespace, counts in rows:
+            calls = counts['hits'] + counts['misses']
+            local_calls = counts['local_hits'] + counts['local_misses']
+            rate = '{0:.1%}'.format(counts['hits'] / calls) if calls else '-'
+            local_rate = '{0:.1%}'.format(counts['local_hits'] / local_calls) if local_calls else '-'
+            print(line.format(namespace, counts['hits'], counts['misses'], rate, counts['refreshes'], counts['waits'],
+                              counts['local_hits'], local_rate, counts['evictions']))
+
+        if options.get('reset'):
+            function_cache.reset_stats()
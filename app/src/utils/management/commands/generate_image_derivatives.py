@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+
+from core import files, images, models as core_models
+from journal import models as journal_models
+from submission import models as submission_models
+
+
+class Command(BaseCommand):
+    """ Generates resized copies of journal covers, article images and galley figures that do not yet have them."""
+
+    help = "Generates resized and WebP copies of journal covers, article images and galley figures."
+
+    def add_arguments(self, parser):
+        """Adds arguments to Django's management command-line parser.
+
+        :param parser: the parser to which the required arguments will be added
+        :return: None
+        """
+        parser.add_argument('--journal_code', default=None)
+
+    def handle(self, *args, **options):
+        """ Generates derivatives synchronously, existing derivatives are skipped.
+
+        :param args: None
+        :param options: Dictionary containing 'journal_code'
+        :return: None
+        """
+        journals = journal_models.Journal.objects.all()
+
+        if options.get('journal_code'):
+            journals = journals.filter(code=options.get('journal_code'))
+
+        for journal in journals:
+            if journal.thumbnail_image:
+                self.generate(journal.thumbnail_image, journal.thumbnail_image.journal_path(journal))
+
+            articles = submission_models.Article.objects.filter(journal=journal).select_related(
+                'thumbnail_image_file', 'large_image_file')
+
+            for article in articles:
+                for image_file in (article.thumbnail_image_file, article.large_image_file):
+                    if image_file:
+                        self.generate(image_file, image_file.self_article_path())
+
+            figures = core_models.File.objects.filter(images__article__journal=journal,
+                                                      mime_type__in=files.IMAGE_MIMETYPES).distinct()
+
+            for figure in figures:
+                self.generate(figure, figure.self_article_path())
+
+    @staticmethod
+    def generate(file_object, path):
+        if path and file_object.mime_type in files.IMAGE_MIMETYPES:
+            generated = images.generate_derivatives(path, file_object.mime_type)
+            print('{0}: {1} derivatives'.format(path, len(generated)))
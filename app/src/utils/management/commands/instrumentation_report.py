@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand
+
+from core import instrumentation
+
+
+class Command(BaseCommand):
+    """ Changes the instrumentation sample rate and reports the worst views it has measured."""
+
+    help = "Reports the slowest or most query heavy views from sampled requests, or changes the proportion of " \
+           "requests that are sampled."
+
+    def add_arguments(self, parser):
+        """Adds arguments to Django's management command-line parser.
+
+        :param parser: the parser to which the required arguments will be added
+        :return: None
+        """
+        parser.add_argument('--sample_rate', default=None, type=float,
+                            help='Sample this proportion of requests, between 0 and 1.')
+        parser.add_argument('--minutes', default=60, type=int,
+                            help='How long the sample rate applies for before returning to the default.')
+        parser.add_argument('--default', action='store_true', default=False,
+                            help='Return to the default sample rate.')
+        parser.add_argument('--reset', action='store_true', default=False,
+                            help='Delete the recorded totals.')
+        parser.add_argument('--sort', choices=instrumentation.SORT_KEYS, default='latency_ms')
+        parser.add_argument('--hours', default=24, type=int,
+                            help='Ignore processes that have not recorded anything for this many hours.')
+        parser.add_argument('--limit', default=20, type=int)
+
+    def handle(self, *args, **options):
+        """ Changes the sample rate or resets the totals if asked to, otherwise prints a report.
+
+        :param args: None
+        :param options: Dictionary of the arguments above
+        :return: None
+        """
+        if options.get('sample_rate') is not None:
+            rate = min(max(options.get('sample_rate'), 0), 1)
+            instrumentation.set_sample_rate(rate, minutes=options.get('minutes'))
+            print('Sampling {0:.1%} of requests for {1} minutes.'.format(rate, options.get('minutes')))
+            return
+
+        if options.get('default'):
+            instrumentation.set_sample_rate(None)
+            print('Sampling {0:.1%} of requests.'.format(instrumentation.DEFAULT_SAMPLE_RATE))
+            return
+
+        if options.get('reset'):
+            instrumentation.reset()
+            print('Instrumentation totals deleted.')
+            return
+
+        print('Currently sampling {0:.1%} of requests.\n'.format(instrumentation.sample_rate()))
+        print('{0:<50} {1:>8} {2:>10} {3:>10} {4:>10} {5:>9} {6:>9} {7:>10} {8:>13} {9:>8} {10:>8}'.format(
+            'View', 'Requests', 'Mean (ms)', 'p95 (ms)', 'Max (ms)', 'Queries', 'Max q.', 'Query (ms)',
+            'Template (ms)', 'C. hits', 'C. miss'))
+
+        for view in instrumentation.summarise(hours=options.get('hours'), sort=options.get('sort'))[
+                :options.get('limit')]:
+            print('{0:<50} {1:>8} {2:>10.1f} {3:>10.0f} {4:>10.1f} {5:>9.1f} {6:>9} {7:>10.1f} {8:>13.1f} {9:>8.1f} '
+                  '{10:>8.1f}'.format(view['view'][:50], view['requests'], view['latency_ms'], view['p95_latency_ms'],
+                                      view['max_latency_ms'], view['queries'], view['max_queries'], view['query_ms'],
+                                      view['template_ms'], view['cache_hits'], view['cache_misses']))
@@ -0,0 +1,62 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from search import backends, documents
+from submission import models as submission_models
+
+
+class Command(BaseCommand):
+    """ Rebuilds the article and preprint search index from the database."""
+
+    help = "Indexes every published article or preprint for search. Both are kept up to date as they are " \
+           "published and edited, this is only needed to build the index for the first time or after changing backend."
+
+    def add_arguments(self, parser):
+        """Adds arguments to Django's management command-line parser.
+
+        :param parser: the parser to which the required arguments will be added
+        :return: None
+        """
+        parser.add_argument('--journal_code', default=None)
+        parser.add_argument('--preprints', action='store_true', default=False,
+                            help='Index the preprint repository instead of journal articles.')
+        parser.add_argument('--clear', action='store_true', default=False,
+                            help='Empty the index before rebuilding it.')
+        parser.add_argument('--batch_size', default=100, type=int)
+
+    def handle(self, *args, **options):
+        """ Indexes published articles, or preprints, in batches.
+
+        :param args: None
+        :param options: Dictionary of the arguments above
+        :return: None
+        """
+        if options.get('preprints'):
+            articles = submission_models.Article.preprints.filter(stage=submission_models.STAGE_PREPRINT_PUBLISHED)
+        else:
+            articles = submission_models.Article.objects.filter(stage=submission_models.STAGE_PUBLISHED)
+
+        if options.get('journal_code') and not options.get('preprints'):
+            articles = articles.filter(journal__code=options.get('journal_code'))
+
+        article_ids = list(articles.order_by('pk').values_list('pk', flat=True))
+
+        if options.get('clear'):
+            if options.get('preprints'):
+                backends.get_backend().clear(documents.PREPRINT)
+            elif options.get('journal_code'):
+                journal_ids = articles.values_list('journal_id', flat=True).distinct()
+                for journal_id in journal_ids:
+                    backends.get_backend().clear(documents.ARTICLE, scope=journal_id)
+            else:
+                backends.get_backend().clear(documents.ARTICLE)
+
+        batch_size = options.get('batch_size')
+        start = time.time()
+
+        for offset in range(0, len(article_ids), batch_size):
+            documents.index_articles(article_ids[offset:offset + batch_size])
+            print('{0}/{1} articles indexed'.format(min(offset + batch_size, len(article_ids)), len(article_ids)))
+
+        print('Indexed {0} articles in {1:.1f}s.'.format(len(article_ids), time.time() - start))
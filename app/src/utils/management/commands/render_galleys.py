@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from dateutil import parser as dateparser
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from core import files, models as core_models, renders
+
+
+class Command(BaseCommand):
+    """ Re-renders XML galleys in parallel, storing the output, table index and CSVs for each."""
+
+    help = "Re-renders XML galleys across a pool of worker processes. Resumable, run again to pick up where a " \
+           "previous run stopped."
+
+    def add_arguments(self, parser):
+        """Adds arguments to Django's management command-line parser.
+
+        :param parser: the parser to which the required arguments will be added
+        :return: None
+        """
+        parser.add_argument('--journal_code', default=None)
+        parser.add_argument('--issue_id', default=None, type=int)
+        parser.add_argument('--published_after', default=None, help='A date, eg. 2017-01-31')
+        parser.add_argument('--published_before', default=None, help='A date, eg. 2017-12-31')
+        parser.add_argument('--workers', default=os.cpu_count(), type=int)
+        parser.add_argument('--force', action='store_true', default=False,
+                            help='Re-render galleys even if their current version is already stored.')
+        parser.add_argument('--checkpoint', default=None,
+                            help='File recording the galleys already rendered by this run. Defaults to a file '
+                                 'named for the filters and --force, so runs with other filters start afresh.')
+        parser.add_argument('--restart', action='store_true', default=False,
+                            help='Ignore an existing checkpoint and start again.')
+        parser.add_argument('--slowest', default=10, type=int, help='Number of slowest galleys to report.')
+
+    def handle(self, *args, **options):
+        """ Renders each galley matching the filters in a worker process, recording progress to a checkpoint.
+
+        :param args: None
+        :param options: Dictionary of the arguments above
+        :return: None
+        """
+        checkpoint = options.get('checkpoint') or self.default_checkpoint(options)
+
+        if options.get('restart') and os.path.isfile(checkpoint):
+            os.unlink(checkpoint)
+
+        done = self.read_checkpoint(checkpoint)
+        galley_ids = [galley_id for galley_id in self.galley_ids(options) if galley_id not in done]
+
+        print('{0} galleys to render, {1} already done by a previous run.'.format(len(galley_ids), len(done)))
+
+        if not galley_ids:
+            return
+
+        files.mkdirs(os.path.dirname(checkpoint))
+
+        # worker processes are forked, they must open their own database connections rather than share ours
+        connections.close_all()
+
+        rendered, skipped, failures, timings = 0, 0, [], []
+        start = time.time()
+
+        with ProcessPoolExecutor(max_workers=options.get('workers')) as executor, open(checkpoint, 'a') as progress:
+            futures = [executor.submit(renders.timed_render, galley_id, options.get('force'))
+                       for galley_id in galley_ids]
+
+            for count, future in enumerate(as_completed(futures), 1):
+                galley_id, article_id, seconds, was_rendered, error = future.result()
+
+                if error:
+                    failures.append((galley_id, article_id, error))
+                else:
+                    progress.write('{0}\n'.format(galley_id))
+                    progress.flush()
+                    timings.append((seconds, galley_id, article_id))
+
+                    if was_rendered:
+                        rendered += 1
+                    else:
+                        skipped += 1
+
+                if count % 100 == 0:
+                    print('{0}/{1} galleys, {2:.1f} per second'.format(count, len(galley_ids),
+                                                                       count / (time.time() - start)))
+
+        elapsed = time.time() - start
+
+        print('Rendered {0}, skipped {1} already current, {2} failed in {3:.1f}s ({4:.1f} galleys per second).'.format(
+            rendered, skipped, len(failures), elapsed, len(galley_ids) / elapsed))
+
+        if timings:
+            print('Slowest galleys:')
+            for seconds, galley_id, article_id in sorted(timings, reverse=True)[:options.get('slowest')]:
+                print('    galley {0} (article {1}): {2:.2f}s'.format(galley_id, article_id, seconds))
+
+        if failures:
+            print('Failures, run the command again to retry these:')
+            for galley_id, article_id, error in failures:
+                print('    galley {0} (article {1}): {2}'.format(galley_id, article_id, error))
+        else:
+            os.unlink(checkpoint)
+
+    @staticmethod
+    def galley_ids(options):
+        galleys = core_models.Galley.objects.filter(file__mime_type__in=renders.XML_MIMETYPES)
+
+        if options.get('journal_code'):
+            galleys = galleys.filter(article__journal__code=options.get('journal_code'))
+
+        if options.get('issue_id'):
+            galleys = galleys.filter(article__issues__pk=options.get('issue_id'))
+
+        if options.get('published_after'):
+            galleys = galleys.filter(article__date_published__gte=dateparser.parse(options.get('published_after')))
+
+        if options.get('published_before'):
+            galleys = galleys.filter(article__date_published__lte=dateparser.parse(options.get('published_before')))
+
+        return list(galleys.order_by('pk').values_list('pk', flat=True).distinct())
+
+    @staticmethod
+    def default_checkpoint(options):
+        filters = [options.get(option) for option in ('journal_code', 'issue_id', 'published_after',
+                                                      'published_before', 'force')]
+        key = hashlib.sha1(json.dumps(filters).encode('utf-8')).hexdigest()[:12]
+
+        return os.path.join(settings.BASE_DIR, 'files', 'temp', 'render_galleys-{0}.checkpoint'.format(key))
+
+    @staticmethod
+    def read_checkpoint(checkpoint):
+        if not os.path.isfile(checkpoint):
+            return set()
+
+        with open(checkpoint, 'r') as progress:
+            return {int(line) for line in progress if line.strip()}
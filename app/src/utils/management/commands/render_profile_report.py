@@ -0,0 +1,79 @@
+from django.core.management.base import BaseCommand
+
+from core import render_profiling
+
+
+class Command(BaseCommand):
+    """ Switches render profiling on or off and reports the slowest galleys and XSLT templates it has recorded."""
+
+    help = "Enables XML render profiling and reports the slowest galleys and XSLT templates."
+
+    def add_arguments(self, parser):
+        """Adds arguments to Django's management command-line parser.
+
+        :param parser: the parser to which the required arguments will be added
+        :return: None
+        """
+        parser.add_argument('--enable', choices=render_profiling.PROFILING_MODES, default=None,
+                            help='Start profiling renders, xslt mode also profiles individual XSLT templates.')
+        parser.add_argument('--minutes', default=60, type=int,
+                            help='How long profiling stays enabled for.')
+        parser.add_argument('--disable', action='store_true', default=False)
+        parser.add_argument('--days', default=render_profiling.PROFILE_DAYS, type=int,
+                            help='Number of days of profiles to report on, at most {0} are kept.'.format(
+                                render_profiling.PROFILE_DAYS))
+        parser.add_argument('--journal_code', default=None)
+        parser.add_argument('--limit', default=20, type=int)
+
+    def handle(self, *args, **options):
+        """ Changes the profiling mode if asked to, otherwise prints a report.
+
+        :param args: None
+        :param options: Dictionary of the arguments above
+        :return: None
+        """
+        if options.get('enable'):
+            render_profiling.set_profiling_mode(options.get('enable'), minutes=options.get('minutes'))
+            print('Render profiling ({0}) enabled for {1} minutes.'.format(options.get('enable'),
+                                                                           options.get('minutes')))
+            return
+
+        if options.get('disable'):
+            render_profiling.set_profiling_mode(None)
+            print('Render profiling disabled.')
+            return
+
+        print('Render profiling is currently {0}.'.format(render_profiling.profiling_mode() or 'disabled'))
+
+        entries = render_profiling.read_profiles(days=options.get('days'))
+
+        if options.get('journal_code'):
+            entries = (entry for entry in entries if entry.get('journal') in (None, options.get('journal_code')))
+
+        summary = render_profiling.summarise(entries)
+        limit = options.get('limit')
+
+        print('\nSlowest galleys (mean render time)')
+        print('{0:>10} {1:>10} {2:>8} {3:>10} {4:>12} {5:>10} {6:>10} {7:>10}  {8}'.format(
+            'Galley', 'Article', 'Renders', 'Mean (ms)', 'Parse (ms)', 'Max (ms)', 'In (KB)', 'Out (KB)', 'XSLT'))
+
+        for galley in summary['galleys'][:limit]:
+            print('{0:>10} {1:>10} {2:>8} {3:>10.1f} {4:>12.1f} {5:>10.1f} {6:>10.1f} {7:>10.1f}  {8}'.format(
+                galley['galley'], galley['article'] or '', galley['renders'], galley['mean_ms'],
+                galley['parse_ms'] / galley['renders'], galley['max_ms'], (galley['input_size'] or 0) / 1024,
+                (galley['output_size'] or 0) / 1024, galley['xsl']))
+
+        if summary['templates']:
+            print('\nMost expensive XSLT templates (libxslt ticks, summed over all profiled renders)')
+            print('{0:>12} {1:>10} {2:>8}  {3}'.format('Time', 'Calls', 'Renders', 'Template'))
+
+            for template in summary['templates'][:limit]:
+                print('{0:>12} {1:>10} {2:>8}  {3} {4}({5})'.format(
+                    template['time'], template['calls'], template['renders'],
+                    template['match'] or 'name={0}'.format(template['name']),
+                    'mode={0} '.format(template['mode']) if template['mode'] else '', template['xsl']))
+
+        lookups = summary['lookups']
+        if lookups['count']:
+            print('\nGalley content lookups: {0}, median {1:.1f}ms, 95th percentile {2:.1f}ms'.format(
+                lookups['count'], lookups['median_ms'], lookups['p95_ms']))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from utils import background
+
+
+class Command(BaseCommand):
+    """ Runs background jobs that were lost when the process that queued them stopped."""
+
+    help = "Runs recorded background jobs, such as renders, typesetting, EPUBs and search indexing, that were not " \
+           "finished by the process that queued them. This is also run by execute_cron_tasks."
+
+    def add_arguments(self, parser):
+        """Adds arguments to Django's management command-line parser.
+
+        :param parser: the parser to which the required arguments will be added
+        :return: None
+        """
+        parser.add_argument('--grace', default=background.JOB_GRACE_SECONDS, type=int,
+                            help='Only run jobs that were queued more than this many seconds ago.')
+
+    def handle(self, *args, **options):
+        """ Runs the lost jobs one after another.
+
+        :param args: None
+        :param options: Dictionary of the arguments above
+        :return: None
+        """
+        ran = background.run_jobs(grace=options.get('grace'))
+        print('Ran {0} background jobs.'.format(ran))
@@ -94,4 +94,5 @@ class Command(BaseCommand):
                 print('No article found with ID {0}'.format(folder))
 
         cache.clear()
-        print('Cache cleared.')
+        print('Cache cleared. Run render_galleys --journal_code {0} to prerender the updated galleys.'.format(
+            journal.code))
@@ -36,7 +36,10 @@ class ThemeEngineMiddleware(object):
 
 class Loader(BaseLoader):
 
-    @function_cache.cache(120)
+    @function_cache.cache(120, key=lambda self, journal: journal,
+                          tags=lambda self, journal: [function_cache.tag('journal', journal),
+                                                      function_cache.tag('settings', journal)],
+                          local=True)
     def query_theme_dirs(self, journal):
         return setting_handler.get_setting('general', 'journal_theme', journal).value
 
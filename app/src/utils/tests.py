@@ -3,17 +3,32 @@ __author__ = "Martin Paul Eve & Andy Byers"
 __license__ = "AGPL v3"
 __maintainer__ = "Birkbeck Centre for Technology and Publishing"
 
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
 from django.test import TestCase
 from django.utils import timezone
 from django.core import mail
+from django.core.cache import cache
 from django.contrib.contenttypes.models import ContentType
 
 from utils.testing import setup
-from utils import transactional_emails
+from utils import transactional_emails, function_cache, background
 from journal import models as journal_models
 from review import models as review_models
 from submission import models as submission_models
 
+# calls made by recorded background jobs, which must be module level functions
+background_calls = []
+
+
+def record_background_call(value):
+    background_calls.append(value)
+
 
 class UtilsTests(TestCase):
 
@@ -96,3 +111,162 @@ class UtilsTests(TestCase):
         transactional_emails.send_article_decision(**kwargs)
 
         self.assertEqual(expected_recipient_one, mail.outbox[0].to[0])
+
+
+class FunctionCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        function_cache._near.clear()
+        self.calls = []
+
+    def test_none_results_are_only_cached_when_asked(self):
+        @function_cache.cache(60, cache_none=True)
+        def lookup(value):
+            self.calls.append(value)
+            return None
+
+        @function_cache.cache(60)
+        def uncached_lookup(value):
+            self.calls.append(value)
+            return None
+
+        self.assertIsNone(lookup(1))
+        self.assertIsNone(lookup(1))
+        self.assertIsNone(uncached_lookup(2))
+        self.assertIsNone(uncached_lookup(2))
+        self.assertEqual(self.calls, [1, 2, 2])
+
+    def test_model_arguments_are_keyed_by_pk(self):
+        setup.create_press()
+        setup.create_journals()
+        journals = list(journal_models.Journal.objects.all()[:2])
+
+        @function_cache.cache(60)
+        def journal_id(journal):
+            self.calls.append(journal.pk)
+            return journal.pk
+
+        self.assertEqual(journal_id(journals[0]), journals[0].pk)
+        self.assertEqual(journal_id(journals[1]), journals[1].pk)
+        self.assertEqual(journal_id(journal_models.Journal.objects.get(pk=journals[0].pk)), journals[0].pk)
+        self.assertEqual(self.calls, [journals[0].pk, journals[1].pk])
+
+    def test_key_function_and_invalidate(self):
+        @function_cache.cache(60, key=lambda value, ignored: value)
+        def double(value, ignored):
+            self.calls.append(value)
+            return value * 2
+
+        self.assertEqual(double(2, 'a'), 4)
+        self.assertEqual(double(2, 'b'), 4)
+        double.invalidate(2, 'c')
+        self.assertEqual(double(2, 'd'), 4)
+        self.assertEqual(self.calls, [2, 2])
+
+    def test_namespaces_are_separate(self):
+        @function_cache.cache(60, namespace='first')
+        def first():
+            return 1
+
+        @function_cache.cache(60, namespace='second')
+        def second():
+            return 2
+
+        self.assertEqual((first(), second()), (1, 2))
+        self.assertNotEqual(first.cache_key(), second.cache_key())
+
+    def test_tags_invalidate_only_their_entries(self):
+        @function_cache.cache(60, tags=lambda value: [function_cache.tag('article', value)])
+        def article_value(value):
+            self.calls.append(value)
+            return value
+
+        article_value(1)
+        article_value(2)
+        function_cache.bump_tags(function_cache.tag('article', 1))
+        article_value(1)
+        article_value(2)
+
+        self.assertEqual(self.calls, [1, 2, 1])
+
+    def test_hits_and_misses_are_counted(self):
+        @function_cache.cache(60, namespace='counted')
+        def counted():
+            return 1
+
+        function_cache.reset_stats(['counted'])
+        for _ in range(3):
+            counted()
+        function_cache.flush_stats()
+
+        totals = function_cache.shared_stats(['counted'])['counted']
+        self.assertEqual((totals['hits'], totals['misses']), (2, 1))
+
+    def test_local_results_skip_the_shared_cache(self):
+        @function_cache.cache(60, namespace='local', tags=[function_cache.tag('settings', 1)], local=True)
+        def local_value():
+            self.calls.append(1)
+            return {'value': 1}
+
+        function_cache.reset_stats(['local'])
+        first = local_value()
+        cache.clear()
+
+        self.assertIs(local_value(), first)
+
+        function_cache.bump_tags(function_cache.tag('settings', 1))
+        local_value()
+        function_cache.flush_stats()
+
+        totals = function_cache.shared_stats(['local'])['local']
+        self.assertEqual(self.calls, [1, 1])
+        self.assertEqual((totals['local_hits'], totals['local_misses']), (1, 2))
+
+
+class BackgroundJobTests(TestCase):
+
+    def setUp(self):
+        self.job_folder = background.JOB_FOLDER
+        background.JOB_FOLDER = tempfile.mkdtemp()
+        del background_calls[:]
+
+    def tearDown(self):
+        shutil.rmtree(background.JOB_FOLDER, ignore_errors=True)
+        background.JOB_FOLDER = self.job_folder
+
+    def test_finished_jobs_forget_their_record(self):
+        background.submit_once('tests', ('value', 1), record_background_call, 1, durable=True).result()
+
+        self.assertEqual(background_calls, [1])
+        self.assertEqual(os.listdir(background.JOB_FOLDER), [])
+
+    def test_lost_jobs_are_run_once(self):
+        background.record_job('tests', ('value', 2), record_background_call, 2)
+
+        self.assertEqual(background.run_jobs(grace=0), 1)
+        self.assertEqual(background.run_jobs(grace=0), 0)
+        self.assertEqual(background_calls, [2])
+
+    def test_jobs_of_exited_processes_are_run_without_waiting(self):
+        path = background.record_job('tests', ('value', 4), record_background_call, 4)
+        self.assertEqual(background.run_jobs(), 0)
+
+        exited = subprocess.Popen([sys.executable, '-c', 'pass'])
+        exited.wait()
+
+        with open(path, 'r+') as record_file:
+            job = json.load(record_file)
+            job['pid'] = exited.pid
+            record_file.seek(0)
+            record_file.truncate()
+            json.dump(job, record_file)
+
+        self.assertEqual(background.run_jobs(), 1)
+        self.assertEqual(background_calls, [4])
+
+    def test_nested_functions_cannot_be_recorded(self):
+        def nested(value):
+            pass
+
+        self.assertRaises(ValueError, background.record_job, 'tests', ('value', 3), nested, 3)